@@ -40,6 +40,84 @@ void dandere2x_utilities::wait_for_file(const std::string &name) {
     }
 }
 
+std::string dandere2x_utilities::vector_file_extension(const std::string &vector_format) {
+    if (vector_format == "text")
+        return ".txt";
+
+    if (vector_format == "binary")
+        return ".bin";
+
+    if (vector_format == "stream")
+        return ".stream";
+
+    throw std::logic_error("no valid vector format selected");
+}
+
+// Python reads this with np.fromfile, see dandere2xlib/utils/vector_file.py
+// magic (4 bytes, "D2XV") | version (uint16) | vector_size (uint16) | vector_count (uint32) | values (int32)...
+static void write_little_endian(std::ostream &out, uint32_t value, int byte_count) {
+    for (int i = 0; i < byte_count; i++) {
+        out.put((char) ((value >> (8 * i)) & 0xFF));
+    }
+}
+
+static bool ends_with(const std::string &value, const std::string &suffix) {
+    return value.size() >= suffix.size() && value.compare(value.size() - suffix.size(), suffix.size(), suffix) == 0;
+}
+
+static void write_binary_vectors(std::ostream &out, const std::vector<int> &values, int vector_size) {
+    out.write("D2XV", 4);
+    write_little_endian(out, 1, 2);
+    write_little_endian(out, (uint32_t) vector_size, 2);
+    write_little_endian(out, (uint32_t) (values.size() / vector_size), 4);
+
+    for (int value : values) {
+        write_little_endian(out, (uint32_t) value, 4);
+    }
+}
+
+bool dandere2x_utilities::is_vector_stream(const std::string &vector_extension) {
+    return vector_extension == ".stream";
+}
+
+// magic (4 bytes, "D2XR") | frame (uint32), followed by the fade, predictive and residual vectors in the binary form.
+void dandere2x_utilities::begin_vector_record(int frame) {
+    std::cout.write("D2XR", 4);
+    write_little_endian(std::cout, (uint32_t) frame, 4);
+}
+
+void dandere2x_utilities::end_vector_record() {
+    std::cout.flush();
+}
+
+void dandere2x_utilities::write_vectors(const std::string &output, const std::vector<int> &values, int vector_size) {
+    if (ends_with(output, ".stream")) {
+        write_binary_vectors(std::cout, values, vector_size);
+        return;
+    }
+
+    std::string temp_file = output + ".temp";
+
+    if (ends_with(output, ".bin")) {
+        std::ofstream out(temp_file, std::ios::binary);
+        write_binary_vectors(out, values, vector_size);
+        out.close();
+    } else {
+        std::ofstream out(temp_file);
+        for (size_t i = 0; i < values.size(); i++) {
+            out << values[i];
+            // Every vector ends with std::endl, it's components are separated by "\n"
+            if ((i + 1) % vector_size == 0)
+                out << std::endl;
+            else
+                out << "\n";
+        }
+        out.close();
+    }
+
+    std::rename(temp_file.c_str(), output.c_str());
+}
+
 bool dandere2x_utilities::debug_enabled() {
         return false;
 }
@@ -11,6 +11,8 @@
 #include <chrono>
 #include <thread>
 #include <unistd.h>
+#include <vector>
+#include <cstdint>
 
 // Need to include <windows.h> for mingw64 for sleep.
 #ifdef __MINGW64__
@@ -28,6 +30,21 @@ namespace dandere2x_utilities {
 
     void wait_for_file(const std::string &name);
 
+    std::string vector_file_extension(const std::string &vector_format);
+
+    // Writes (to a temp file, then renames) the flattened vectors in the format denoted by the output's extension,
+    // either newline separated text (".txt") or a header followed by little-endian int32's (".bin").
+    // For ".stream", the binary form is written to stdout instead, as part of the frame's vector record.
+    void write_vectors(const std::string &output, const std::vector<int> &values, int vector_size);
+
+    bool is_vector_stream(const std::string &vector_extension);
+
+    // Starts frame's record on stdout, which is followed by it's fade, predictive and residual vectors (in that
+    // order), see dandere2xlib/utils/vector_file.py.
+    void begin_vector_record(int frame);
+
+    void end_vector_record();
+
 }
 
 #endif //CPP_REWORK_DANDERE2X_UTILITIES_H
@@ -19,6 +19,7 @@ void driver_difference(const string &workspace,
                        const int block_size,
                        const int quality_setting,
                        const int bleed,
+                       const string &vector_extension,
                        AbstractBlockMatch *search_library,
                        AbstractEvaluator *evaluation_library) {
 
@@ -31,6 +32,9 @@ void driver_difference(const string &workspace,
     string debug_frame_prefix = workspace + separator() + "debug" + separator() + "debug_";
     string fade_prefix = workspace + separator() + "fade_data" + separator() + "fade_";
 
+    // Written by dandere2x's python side (see scene_cut.py) before the frame itself.
+    string scene_cut_prefix = workspace + separator() + "scene_cuts" + separator() + "cut_";
+
     auto frame1_path = image_prefix + to_string(1) + ".png";
 
     wait_for_file(frame1_path);
@@ -40,9 +44,9 @@ void driver_difference(const string &workspace,
         LOG(INFO) << "Current Frame: " << x << endl;
 
         // File Declarations
-        string p_data_file = p_data_prefix + to_string(x) + ".txt";
-        string residual_file = residual_data_prefix + to_string(x) + ".txt";
-        string fade_file = fade_prefix + to_string(x) + ".txt";
+        string p_data_file = p_data_prefix + to_string(x) + vector_extension;
+        string residual_file = residual_data_prefix + to_string(x) + vector_extension;
+        string fade_file = fade_prefix + to_string(x) + vector_extension;
         string debug_file = debug_frame_prefix + to_string(x) + ".png";
 
         // Load next frame files
@@ -50,13 +54,30 @@ void driver_difference(const string &workspace,
         wait_for_file(frame_2_path);
 
         auto frame_2 = make_shared<Frame>(frame_2_path);
+
+        // When streaming, this frame's vectors are written to stdout as one record rather than as three files.
+        if (is_vector_stream(vector_extension))
+            begin_vector_record(x);
+
+        // Nothing carries over a scene cut, so skip matching and have the frame redrawn.
+        if (file_exists(scene_cut_prefix + to_string(x + 1))) {
+            LOG(INFO) << "Scene cut - skipping block matching" << endl;
+            write_vectors(fade_file, {}, 3);
+            write_vectors(p_data_file, {}, 4);
+            write_vectors(residual_file, {}, 4);
+            if (is_vector_stream(vector_extension))
+                end_vector_record();
+            frame_1 = frame_2;
+            continue;
+        }
+
         auto frame_2_compressed = make_shared<Frame>(frame_2_path, quality_setting);
 
         FadeFrame fade = FadeFrame(evaluation_library, frame_1, frame_2, frame_2_compressed, block_size);
         fade.run();
         fade.write(fade_file);
 
-//        FadeFrame::write_empty_file(fade_file);
+//        FadeFrame::write_empty_file(fade_file, 3);
 
         search_library->set_images(frame_1, frame_2);
         PredictiveFrame predict = PredictiveFrame(evaluation_library, search_library,
@@ -64,6 +85,9 @@ void driver_difference(const string &workspace,
         predict.run();
         predict.write(p_data_file, residual_file);
 
+        if (is_vector_stream(vector_extension))
+            end_vector_record();
+
         if (debug_enabled()) {
             predict.debug_predictive(debug_file);
         }
@@ -7,6 +7,10 @@ using namespace std::chrono;
 
 #include <string>
 #include <iostream>
+#ifdef _WIN32
+#include <io.h>
+#include <fcntl.h>
+#endif
 #include "frame/external_headers/stb_image_write.h"
 #include "frame/external_headers/stb_image.h"
 #include "evaluator/MSE_Function.h"
@@ -60,6 +64,7 @@ int main(int argc, char **argv) {
     int block_size = 20;
     int quality_setting = 100;
     int bleed = 1;
+    string vector_format = "text";
 
     // If not debug, load the passed variables.
     if (!debug) {
@@ -70,9 +75,22 @@ int main(int argc, char **argv) {
         evaluator_arg = argv[5];
         quality_setting = atoi(argv[6]);
         bleed = atoi(argv[7]);
+
+        // Optional, older callers only pass 7 arguments and expect text vector files.
+        if (argc > 8)
+            vector_format = argv[8];
     }
     // Reset log file now that args have been properly parsed.
     c.parseFromText("*GLOBAL:\n Filename = " + workspace + dandere2x_utilities::separator() + "dandere2x_cpp.log");
+
+    // When streaming vectors, stdout carries nothing but vector records, so logs only go to the log file.
+    string vector_extension = vector_file_extension(vector_format);
+    if (dandere2x_utilities::is_vector_stream(vector_extension)) {
+        c.parseFromText("*GLOBAL:\n TO_STANDARD_OUTPUT = false");
+#ifdef _WIN32
+        _setmode(_fileno(stdout), _O_BINARY);
+#endif
+    }
     el::Loggers::reconfigureAllLoggers(c);
 
     LOG(INFO) << "Dandere2xCPP 2021 v0.1";
@@ -82,11 +100,12 @@ int main(int argc, char **argv) {
     LOG(INFO) << "frame_count: " << frame_count << endl;
     LOG(INFO) << "block_size: " << block_size << endl;
     LOG(INFO) << "quality setting: " << quality_setting << endl;
+    LOG(INFO) << "vector format: " << vector_format << endl;
 
     // Start the main driver after having loaded the arguments
     AbstractBlockMatch *matcher = get_block_matcher(block_matching_arg);
     AbstractEvaluator *evaluator = get_evaluator(evaluator_arg);
-    driver_difference(workspace, frame_count, block_size, quality_setting, bleed, matcher, evaluator);
+    driver_difference(workspace, frame_count, block_size, quality_setting, bleed, vector_extension, matcher, evaluator);
 
     free(matcher); // Free used memory
     return 0;
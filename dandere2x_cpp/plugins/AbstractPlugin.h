@@ -34,6 +34,7 @@ Purpose: An abstract class describing inherited d2x_cpp classes.
 #include <memory>
 #include "../frame/Frame.h"
 #include "block_plugins/Block.h"
+#include "../dandere2x_utilities.h"
 
 using namespace std;
 
@@ -64,9 +65,7 @@ public:
     // pre-maturely reading). Checks if the "sum" is less than zero for each block, which denotes
     void write_blocks(const string &output, const vector<vector<shared_ptr<Block>>> &blocks) {
         // Write the predictive vectors out
-
-        string temp_file = output + ".temp";
-        std::ofstream out(temp_file);
+        vector<int> values;
 
         for (const vector<shared_ptr<Block>> &row: blocks) {
             for (const shared_ptr<Block> &block: row) {
@@ -75,25 +74,18 @@ public:
                     continue;
 
                 if (block->sum != -1) { // -1 denotes an invalid block.
-                    out <<
-                        block->x_start << "\n" <<
-                        block->y_start << "\n" <<
-                        block->x_end << "\n" <<
-                        block->y_end
-                        << std::endl;
+                    values.push_back(block->x_start);
+                    values.push_back(block->y_start);
+                    values.push_back(block->x_end);
+                    values.push_back(block->y_end);
                 }
             }
         }
-        out.close();
-        std::rename((temp_file).c_str(), output.c_str());
+        dandere2x_utilities::write_vectors(output, values, 4);
     }
 
-    static void write_empty_file(const string &output) {
-        string temp_file = output + ".temp";
-        std::ofstream out(temp_file);
-
-        out.close();
-        std::rename((temp_file).c_str(), output.c_str());
+    static void write_empty_file(const string &output, const int vector_size) {
+        dandere2x_utilities::write_vectors(output, {}, vector_size);
     }
 
 protected:
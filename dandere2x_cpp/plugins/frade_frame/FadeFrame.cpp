@@ -24,18 +24,15 @@ void FadeFrame::update_frame() {
 }
 
 void FadeFrame::write(const string &fade_file) {
-    std::ofstream out(fade_file + ".temp");
+    vector<int> values;
 
     for (auto &fade_block : fade_blocks) {
-        out <<
-            fade_block.x << "\n" <<
-            fade_block.y << "\n" <<
-            fade_block.scalar <<
-            std::endl;
+        values.push_back(fade_block.x);
+        values.push_back(fade_block.y);
+        values.push_back((int) fade_block.scalar);
     }
 
-    out.close();
-    std::rename((fade_file + ".temp").c_str(), fade_file.c_str());
+    dandere2x_utilities::write_vectors(fade_file, values, 3);
 }
 
 // todo, comment
@@ -86,8 +86,8 @@ void PredictiveFrame::run() {
 
     // Don't conduct block matches if the PSNR is terribly low.
     if (psnr < 10) {
-        std::cout << "PSNR " << psnr << std::endl;
-        std::cout << "PSNR is low - not going to match blocks" << std::endl;
+        LOG(INFO) << "PSNR " << psnr << std::endl;
+        LOG(INFO) << "PSNR is low - not going to match blocks" << std::endl;
     }
     else{
         match_blocks();
@@ -8,10 +8,14 @@ from typing import Type
 from dandere2x.dandere2x_service_request import Dandere2xServiceRequest, UpscalingEngineType
 from dandere2x.dandere2x_logger import set_dandere2x_logger
 from dandere2x.dandere2x_service.core.dandere2x_cpp import Dandere2xCppWrapper
+from dandere2x.dandere2x_service.core.dandere2x_py import Dandere2xPyWrapper, is_python_block_matching_arg
 from dandere2x.dandere2x_service.core.merge import Merge
 from dandere2x.dandere2x_service.core.min_disk_usage import MinDiskUsage
 from dandere2x.dandere2x_service.core.residual import Residual
 from dandere2x.dandere2x_service.core.status_thread import Status
+from dandere2x.dandere2x_service.core.block_cache import BlockCache
+from dandere2x.dandere2x_service.core.residual_batcher import ResidualBatcher
+from dandere2x.dandere2x_service.core.vector_cache import VectorCache
 from dandere2x.dandere2x_service.core.waifu2x.abstract_upscaler import AbstractUpscaler
 from dandere2x.dandere2x_service.core.waifu2x.waifu2x_caffe import Waifu2xCaffe
 from dandere2x.dandere2x_service.core.waifu2x.waifu2x_converter_cpp import Waifu2xConverterCpp
@@ -19,7 +23,9 @@ from dandere2x.dandere2x_service.core.waifu2x.waifu2x_ncnn_vulkan import Waifu2x
 from dandere2x.dandere2x_service.core.waifu2x.realsr_ncnn_vulkan import RealSRNCNNVulkan
 from dandere2x.dandere2x_service.dandere2x_service_context import Dandere2xServiceContext
 from dandere2x.dandere2x_service.dandere2x_service_controller import Dandere2xController
-from dandere2x.dandere2xlib.utils.dandere2x_utils import file_exists, wait_on_file
+from dandere2x.dandere2xlib.utils.dandere2x_utils import file_exists, get_a_valid_input_resolution, wait_on_file
+from dandere2x.dandere2xlib.utils.frame_store import create_frame_store
+from dandere2x.dandere2xlib.utils.scene_cut import SceneCutManifest
 from dandere2x.dandere2xlib.wrappers.ffmpeg.progressive_noise_adder import ProgressiveNoiseAdder
 
 
@@ -45,6 +51,15 @@ def _get_upscale_engine(selected_engine: UpscalingEngineType) -> Type[AbstractUp
         raise Exception
 
 
+def _get_block_matching_engine(block_matching_arg: str):
+    """ The "python_*" block matching args run in-package with dandere2x_py, the rest are passed to dandere2x_cpp. """
+
+    if is_python_block_matching_arg(block_matching_arg):
+        return Dandere2xPyWrapper
+
+    return Dandere2xCppWrapper
+
+
 class Dandere2xServiceThread(threading.Thread):
 
     def __init__(self, service_request: Dandere2xServiceRequest):
@@ -69,19 +84,37 @@ class Dandere2xServiceThread(threading.Thread):
         self.threads_active = False
 
         # Child-threads
-        self.progressive_noise_adder = ProgressiveNoiseAdder(self.context.input_frames_dir,
-                                                             self.context.noised_input_frames_dir,
-                                                             self.context.frame_count)
-
-        self.min_disk_demon = MinDiskUsage(self.context, self.controller)
+        self.progressive_noise_adder = ProgressiveNoiseAdder(self.context.noised_input_frames_dir,
+                                                             self.context.frame_count,
+                                                             strength=self.context.noise_strength,
+                                                             seed=self.context.noise_seed,
+                                                             workers=self.context.noise_workers,
+                                                             controller=self.controller)
+
+        self.scene_cut_manifest = SceneCutManifest(self.context.scene_cuts_dir)
+        self.min_disk_demon = MinDiskUsage(self.context, self.controller, self.scene_cut_manifest,
+                                           self.progressive_noise_adder)
         self.status_thread = Status(self.context, self.controller)
-        self.dandere2x_cpp_thread = Dandere2xCppWrapper(self.context, self.controller)
+        self.vector_cache = VectorCache(self.context)
+        selected_block_matcher = _get_block_matching_engine(self.context.dandere2x_cpp_block_matching_arg)
+        self.dandere2x_cpp_thread = selected_block_matcher(self.context, self.controller, self.vector_cache)
 
         selected_waifu2x = _get_upscale_engine(service_request.upscale_engine)
         self.waifu2x = selected_waifu2x(context=self.context, controller=self.controller)
 
-        self.residual_thread = Residual(self.context, self.controller)
-        self.merge_thread = Merge(context=self.context, controller=self.controller)
+        self.block_cache = self.__create_block_cache()
+        self.residual_batcher = None
+        if self.context.residual_batching_enabled:
+            self.residual_batcher = ResidualBatcher(self.context,
+                                                    max_pixels=self.context.residual_batching_max_pixels,
+                                                    max_frames=self.context.residual_batching_max_frames,
+                                                    max_wait=self.context.residual_batching_max_wait)
+
+        self.residual_thread = Residual(self.context, self.controller, self.vector_cache, self.scene_cut_manifest,
+                                        self.block_cache, self.residual_batcher)
+        self.merge_thread = Merge(context=self.context, controller=self.controller, vector_cache=self.vector_cache,
+                                  scene_cut_manifest=self.scene_cut_manifest, block_cache=self.block_cache,
+                                  batcher=self.residual_batcher)
 
     def run(self):
         """
@@ -92,6 +125,7 @@ class Dandere2xServiceThread(threading.Thread):
         self.log.info("called.")
         self.__create_directories(workspace=self.context.service_request.workspace,
                                   directories_list=self.context.directories)
+        self.__create_frame_stores()
 
         self.log.info("Dandere2x Threads Set.. going live with the following context file.")
         self.context.log_all_variables()
@@ -104,14 +138,16 @@ class Dandere2xServiceThread(threading.Thread):
         extract_initial_frames.join()
 
         self.dandere2x_cpp_thread.start()
+        self.vector_cache.start()
         self.merge_thread.start()
         self.residual_thread.start()
         self.waifu2x.start()
         self.status_thread.start()
         self.min_disk_demon.start()
 
-        while self.controller.get_current_frame() < self.context.frame_count - 1:
-            time.sleep(1)
+        self.controller.wait_for_frame(self.context.frame_count - 1)
+        if not self.controller.is_alive():
+            self.log.error("Dandere2x session stopped early: %s" % self.controller.get_error())
 
         self.progressive_noise_adder.join()
         self.min_disk_demon.join()
@@ -148,6 +184,46 @@ class Dandere2xServiceThread(threading.Thread):
 
         self.log.info("Time to upscale a single frame: %s ", str(round(time.time() - one_frame_time, 2)))
 
+    def __create_block_cache(self):
+        """ The cache of upscaled residual blocks, if enabled. It's shared in memory by residual and merge. """
+        if not self.context.block_cache_enabled:
+            return None
+
+        if self.context.residual_worker_type == "process":
+            self.log.error("The block cache can't be shared with residual's process workers, "
+                           "use residual_worker_type: \"thread\" or disable the block cache.")
+            raise ValueError("block_cache requires thread residual workers")
+
+        return BlockCache(self.context,
+                          memory_bytes=self.context.block_cache_memory_megabytes * 1024 * 1024,
+                          disk_bytes=self.context.block_cache_disk_megabytes * 1024 * 1024,
+                          disk_dir=self.context.block_cache_dir)
+
+    def __create_frame_stores(self):
+        """
+        Unless the workspace storage is plain files, the extracted (and, for dandere2x_py, the noised) frames are kept
+        in frame stores rather than as png's. A store needs a slot for every frame that can be extracted ahead of
+        merging, plus a couple for the frames residual / block matching are still reading.
+        """
+        if self.context.workspace_storage == "files":
+            return
+
+        if self.context.workspace_storage == "memory" and self.context.residual_worker_type == "process":
+            self.log.error("An in memory workspace can't be shared with residual's process workers, "
+                           "use residual_worker_type: \"thread\" or workspace_storage: \"mmap\".")
+            raise ValueError("workspace_storage 'memory' requires thread residual workers")
+
+        width, height = get_a_valid_input_resolution(self.context.width, self.context.height,
+                                                     self.context.service_request.block_size)
+        slots = min(self.context.max_frames_ahead + 2, self.context.frame_count + 1)
+
+        create_frame_store(self.context.workspace_storage, self.context.input_frames_dir, width, height, slots)
+
+        # dandere2x_cpp reads the noised frames from disk itself, so they're only stored for dandere2x_py.
+        if is_python_block_matching_arg(self.context.dandere2x_cpp_block_matching_arg):
+            create_frame_store(self.context.workspace_storage, self.context.noised_input_frames_dir,
+                               width, height, slots)
+
     def __create_directories(self, workspace: str, directories_list: list):
         """
         In dandere2x's context file, there's a list of directories.
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    This file is part of the Dandere2x project.
+    Dandere2x is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+    Dandere2x is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+    You should have received a copy of the GNU General Public License
+    along with Dandere2x.  If not, see <https://www.gnu.org/licenses/>.
+""""""
+========= Copyright aka_katto 2018, All rights reserved. ============
+Original Author: aka_katto
+Purpose: dandere2x_cpp lays a frame's residual tiles out in a square
+         of int(sqrt(n) + 1) tiles a side, which can leave up to a
+         whole row and column of empty tiles, and pays no attention to
+         the tiles the upscaler itself splits an image into (i.e
+         waifu2x-ncnn-vulkan's -t), so a residual image just over a
+         multiple of it costs a row / column of mostly empty tiles.
+
+         The residual image's layout is planned here instead, from the
+         amount of tiles in it. The residual vectors still carry
+         dandere2x_cpp's square positions, both residual.py and
+         merge.py re-map them into the planned layout, which only
+         depends on the amount of tiles (and the settings), so both
+         sides always agree on it.
+====================================================================="""
+import logging
+import math
+from dataclasses import dataclass
+from functools import lru_cache
+
+import numpy as np
+
+from dandere2x.dandere2x_service.dandere2x_service_context import Dandere2xServiceContext
+from dandere2x.dandere2x_service_request import UpscalingEngineType
+
+SQUARE = "square"
+PLANNED = "planned"
+
+# The output_options section and option of each upscaler that sets the size of the tiles it upscales in.
+_ENGINE_TILE_OPTIONS = {UpscalingEngineType.VULKAN: ("waifu2x_ncnn_vulkan", "-t"),
+                        UpscalingEngineType.REALSR: ("realsr_ncnn_vulkan", "-t"),
+                        UpscalingEngineType.CONVERTER_CPP: ("waifu2x_converter", "--block-size"),
+                        UpscalingEngineType.CAFFE: ("waifu2x_caffe", "-crop_size")}
+
+# Roughly how much (in pixels) an upscaler pads each of it's tiles with, on every side, i.e waifu2x's cunet model.
+ENGINE_TILE_PADDING = 18
+
+
+@dataclass(frozen=True)
+class AtlasLayout:
+    """
+    A grid of columns x rows tiles, filled column by column like dandere2x_cpp fills it's square, i.e tile index i
+    is at (i // rows, i % rows).
+    """
+    columns: int
+    rows: int
+
+    @staticmethod
+    def square(tile_count: int):
+        """ dandere2x_cpp's layout, which is what the positions in the residual vectors are in. """
+        dimension = int(math.sqrt(tile_count) + 1)
+        return AtlasLayout(dimension, dimension)
+
+    def index_of(self, positions: np.ndarray) -> np.ndarray:
+        """ The tile index of every (x, y) position in positions. """
+        return positions[:, 0] * self.rows + positions[:, 1]
+
+    def position_of(self, indices: np.ndarray) -> np.ndarray:
+        """ The (x, y) position of every tile index in indices. """
+        return np.stack([indices // self.rows, indices % self.rows], axis=1)
+
+
+@dataclass(frozen=True)
+class AtlasPlacement:
+    """
+    Where a frame's residual tiles are in a residual image, that is, tiles [start, start + n) of atlas_layout,
+    given the square layout the frame's positions were made in.
+    """
+    start: int
+    frame_layout: AtlasLayout
+    atlas_layout: AtlasLayout
+
+    def remap(self, tile_positions: np.ndarray) -> np.ndarray:
+        """ Maps (x, y) positions in the frame's square layout to their (x, y) in the residual image. """
+        return self.atlas_layout.position_of(self.start + self.frame_layout.index_of(tile_positions))
+
+    def remap_vectors(self, residual_vectors: np.ndarray) -> np.ndarray:
+        remapped = residual_vectors.copy()
+        remapped[:, 2:4] = self.remap(residual_vectors[:, 2:4])
+        return remapped
+
+
+def get_engine_tile_size(context: Dandere2xServiceContext):
+    """ The size of the tiles the selected upscaler works in, or None if it isn't set (or is left to the upscaler). """
+    section, option = _ENGINE_TILE_OPTIONS.get(context.service_request.upscale_engine, (None, None))
+    value = context.service_request.output_options.get(section, {}).get("output_options", {}).get(option)
+
+    try:
+        # ncnn-vulkan's -t is per gpu, i.e "200,100", the first gpu's will do.
+        tile_size = int(str(value).split(",")[0])
+    except ValueError:
+        return None
+
+    return tile_size if tile_size > 0 else None
+
+
+def get_atlas_layout(context: Dandere2xServiceContext, tile_count: int) -> AtlasLayout:
+    """ The layout of a residual image with tile_count tiles in it. """
+    if context.residual_atlas_layout == SQUARE:
+        return AtlasLayout.square(tile_count)
+
+    if context.residual_atlas_layout == PLANNED:
+        return plan_atlas_layout(tile_count, context.service_request.block_size + context.bleed * 2,
+                                 get_engine_tile_size(context))
+
+    log = logging.getLogger(name=context.service_request.input_file)
+    log.error("No valid residual atlas layout selected: %s" % context.residual_atlas_layout)
+    raise ValueError("residual_atlas_layout must be 'square' or 'planned'")
+
+
+def get_frame_placement(context: Dandere2xServiceContext, tile_count: int) -> AtlasPlacement:
+    """ Where the tiles of a residual image made for a single frame (of tile_count tiles) are. """
+    return AtlasPlacement(start=0, frame_layout=AtlasLayout.square(tile_count),
+                          atlas_layout=get_atlas_layout(context, tile_count))
+
+
+@lru_cache(maxsize=4096)
+def plan_atlas_layout(tile_count: int, tile_size: int, engine_tile_size=None) -> AtlasLayout:
+    """
+    Picks the columns x rows layout of tile_count (tile_size sized) tiles which costs the upscaler the least, where
+    the cost is the pixels it processes once the image is split into engine_tile_size tiles, each padded by
+    ENGINE_TILE_PADDING on every side, that is
+
+        (width + 2 * padding * tiles across) * (height + 2 * padding * tiles down)
+
+    So, fewer empty tiles, without straddling an engine tile boundary for a couple of tiles. Layouts more than about
+    four times as long as they're wide aren't considered, and the most square layout wins a tie.
+    """
+    if tile_count <= 0:
+        return AtlasLayout(1, 1)
+
+    limit = 2 * math.ceil(math.sqrt(tile_count))
+    columns = np.arange(1, limit + 1)
+    rows = -(-tile_count // columns)
+
+    widths, heights = columns * tile_size, rows * tile_size
+    if engine_tile_size is None:
+        tiles_across, tiles_down = 1, 1
+    else:
+        tiles_across, tiles_down = -(-widths // engine_tile_size), -(-heights // engine_tile_size)
+
+    cost = (widths + 2 * ENGINE_TILE_PADDING * tiles_across) * (heights + 2 * ENGINE_TILE_PADDING * tiles_down)
+    cost[rows > limit] = np.iinfo(cost.dtype).max
+
+    best = np.lexsort((np.abs(widths - heights), cost))[0]
+    return AtlasLayout(int(columns[best]), int(rows[best]))
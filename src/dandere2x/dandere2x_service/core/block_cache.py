@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    This file is part of the Dandere2x project.
+    Dandere2x is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+    Dandere2x is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+    You should have received a copy of the GNU General Public License
+    along with Dandere2x.  If not, see <https://www.gnu.org/licenses/>.
+""""""
+========= Copyright aka_katto 2018, All rights reserved. ============
+Original Author: aka_katto
+Purpose: Anime repeats a lot of pixel-identical residual blocks, both
+         within a frame and across frames (backgrounds after a pan,
+         mouth flaps, credits). The block cache remembers the upscaled
+         version of every residual block it's seen, keyed by a hash of
+         the block's (block_size + bleed * 2) tile, so a block that's
+         been upscaled once is never sent to the upscaler again.
+
+         Residual plans each frame against the cache, leaving the
+         cached blocks out of the residual image, and merge fills them
+         back in from the cache (and adds the newly upscaled blocks).
+====================================================================="""
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import numpy as np
+
+from dandere2x.dandere2x_service.dandere2x_service_context import Dandere2xServiceContext
+from dandere2x.dandere2x_service_request import UpscalingEngineType
+from dandere2x.dandere2xlib.wrappers.frame.frame import gather_blocks, scatter_blocks
+
+# The output_options section of each upscaler, whose settings (model, tta, ...) change what a block upscales to.
+_ENGINE_OPTIONS = {UpscalingEngineType.VULKAN: "waifu2x_ncnn_vulkan",
+                   UpscalingEngineType.CONVERTER_CPP: "waifu2x_converter",
+                   UpscalingEngineType.CAFFE: "waifu2x_caffe",
+                   UpscalingEngineType.REALSR: "realsr_ncnn_vulkan"}
+
+# Fixed, so a tile hashes the same in every session (the disk cache outlives the session).
+_HASH_SEED = 0x64327862
+_hash_weights = {}  # tile length -> (2, length) uint64 weights
+_hash_weights_lock = threading.Lock()
+_HASH_CHUNK_BYTES = 4 * 1024 * 1024  # of uint64 temporaries, per hash_tiles call
+
+
+def hash_tiles(tiles: np.ndarray) -> np.ndarray:
+    """
+    Hashes every tile in tiles (an array of shape (n, ...) of uint8) at once, returning an (n, 2) uint64 array, two
+    independent 64 bit hashes per tile.
+
+    Each hash is the sum of every byte of the tile times a random odd weight for it's position, modulo 2^64. That's
+    not cryptographic, but two different tiles only collide by chance, and it's a couple of vectorized numpy
+    operations rather than a python call per tile. The tiles are hashed _HASH_CHUNK_BYTES worth at a time, so the
+    uint64 temporaries stay the same size however big the frame is.
+    """
+    length = int(np.prod(tiles.shape[1:]))
+    flat = tiles.reshape(len(tiles), length)
+
+    with _hash_weights_lock:
+        if length not in _hash_weights:
+            rng = np.random.default_rng((_HASH_SEED, length))
+            weights = rng.integers(0, 2 ** 64, size=(2, length), dtype=np.uint64, endpoint=False)
+            _hash_weights[length] = weights | np.uint64(1)
+        weights = _hash_weights[length]
+
+    hashes = np.empty((len(flat), 2), dtype=np.uint64)
+    chunk = max(1, _HASH_CHUNK_BYTES // (length * 8))
+    for start in range(0, len(flat), chunk):
+        widened = flat[start:start + chunk].astype(np.uint64)
+        hashes[start:start + chunk, 0] = (widened * weights[0]).sum(axis=1)
+        hashes[start:start + chunk, 1] = (widened * weights[1]).sum(axis=1)
+
+    return hashes
+
+
+@dataclass
+class ResidualPlan:
+    """
+    How a frame's residual blocks were split between the residual image and the cache. Made by BlockCache.plan
+    (from residual.py), and consumed by merge.py.
+
+        residual_vectors: The residual vectors of blocks that are upscaled, re-laid out so that identical blocks
+                          share a single tile of the residual image.
+        tile_vectors: A residual vector per tile of the residual image, i.e what the residual image is made from.
+        new_keys / new_tiles: The key of every tile in the residual image, and it's (x, y) position in tiles.
+        cached_keys / cached_positions: The key of every block filled in from the cache, and the (x, y) (in input
+                                        frame coordinates) of where it goes.
+    """
+    residual_vectors: np.ndarray
+    tile_vectors: np.ndarray
+    new_keys: list
+    new_tiles: np.ndarray
+    cached_keys: list
+    cached_positions: np.ndarray
+
+
+class BlockCache:
+    """
+    A least recently used cache of upscaled residual blocks, bounded by memory, with evicted blocks optionally
+    spilled to (and later promoted back from) a disk cache that's bounded by size too.
+
+    A block residual.py plans to take from the cache is pinned until merge.py has filled it in, so it can't be
+    evicted in between, which means the memory bound can be briefly exceeded by the blocks of frames in flight.
+
+    Blocks only become cached once merge.py has added them, so a block is reused by a later frame only if that frame
+    is planned after the frame that upscaled it is merged. Repeats within a single frame are always upscaled once.
+
+    usage:
+    plan = block_cache.plan(x, residual_vectors, residual_tiles)  # residual.py
+    ... make the residual image from plan.tile_vectors ...
+
+    plan = block_cache.take_plan(x)  # merge.py
+    ... merge using plan.residual_vectors ...
+    block_cache.fill(out_image, plan)
+    block_cache.add(plan, upscaled_residual_image)
+    """
+
+    def __init__(self, context: Dandere2xServiceContext, memory_bytes: int, disk_bytes: int, disk_dir: str):
+        self.log = logging.getLogger(name=context.service_request.input_file)
+
+        self.block_size = context.service_request.block_size
+        self.scale_factor = int(context.service_request.scale_factor)
+        self.bleed = context.bleed
+        self.upscaled_block_size = self.block_size * self.scale_factor
+
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+
+        # Blocks upscaled with other settings are kept apart, under their own directory. It's created (or what's in
+        # it is picked up) on first use, as the default is inside the workspace, which doesn't exist yet.
+        self.settings_key = self.get_settings_key(context)
+        self.disk_dir = None
+        if disk_bytes > 0:
+            self.disk_dir = os.path.join(disk_dir, self.settings_key) + os.path.sep
+        self._disk_opened = False
+
+        self._lock = threading.Lock()
+        self._plans_condition = threading.Condition(self._lock)
+        self._memory = OrderedDict()  # key -> upscaled block, least recently used first
+        self._memory_used = 0
+        self._disk = OrderedDict()  # key -> bytes used on disk, least recently used first
+        self._disk_used = 0
+        self._pins = {}  # key -> how many planned frames still need it
+        self._plans = {}  # frame -> ResidualPlan, until merge takes it
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.repeats = 0
+        self.evictions = 0
+
+    @staticmethod
+    def get_settings_key(context: Dandere2xServiceContext) -> str:
+        """ A digest of every setting that changes what a tile upscales to. """
+        service_request = context.service_request
+        engine_options = service_request.output_options.get(_ENGINE_OPTIONS.get(service_request.upscale_engine), {})
+        settings = {"engine": str(service_request.upscale_engine),
+                    "engine_options": engine_options,
+                    "denoise_level": service_request.denoise_level,
+                    "scale_factor": service_request.scale_factor,
+                    "block_size": service_request.block_size,
+                    "bleed": context.bleed,
+                    "residual_image_format": os.path.splitext(context.temp_image)[1]}
+
+        return hashlib.sha1(json.dumps(settings, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+    def plan(self, frame: int, residual_vectors: np.ndarray, residual_tiles: np.ndarray) -> ResidualPlan:
+        """
+        Splits frame's residual blocks into those the cache already has (which are pinned until merged) and those
+        that need upscaling, given the (block_size + bleed * 2) tile of every residual vector. The plan is kept
+        until merge.py takes it.
+        """
+        keys = hash_tiles(residual_tiles)
+        unique_keys, first_index, inverse = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+        unique_keys = [tuple(key) for key in unique_keys.tolist()]
+        inverse = inverse.ravel()
+
+        with self._lock:
+            if self.disk_dir is not None and not self._disk_opened:
+                self._open_disk()
+            cached = np.array([self._pin(key) for key in unique_keys], dtype=bool)
+            self.hits += int(cached.sum())
+            self.misses += int((~cached).sum())
+            self.repeats += len(keys) - len(unique_keys)
+
+        # Every block that isn't cached is assigned a tile, in the same layout dandere2x_cpp uses.
+        new = np.flatnonzero(~cached)
+        dim = int(np.sqrt(len(new)) + 1)
+        tile_of = np.full(len(unique_keys), -1)
+        tile_of[new] = np.arange(len(new))
+        new_tiles = np.stack([np.arange(len(new)) // dim, np.arange(len(new)) % dim], axis=1)
+
+        is_new = tile_of[inverse] != -1
+        upscaled = residual_vectors[is_new].copy()
+        upscaled[:, 2:4] = new_tiles[tile_of[inverse[is_new]]]
+
+        tile_vectors = residual_vectors[first_index[new]].copy()
+        tile_vectors[:, 2:4] = new_tiles
+
+        plan = ResidualPlan(residual_vectors=upscaled,
+                            tile_vectors=tile_vectors,
+                            new_keys=[unique_keys[index] for index in new],
+                            new_tiles=new_tiles,
+                            cached_keys=[unique_keys[index] for index in inverse[~is_new]],
+                            cached_positions=residual_vectors[~is_new, 0:2])
+
+        with self._plans_condition:
+            self._plans[frame] = plan
+            self._plans_condition.notify_all()
+
+        return plan
+
+    def take_plan(self, frame: int) -> ResidualPlan:
+        """ Blocks until residual.py has planned frame, and returns (and forgets) it's plan. """
+        with self._plans_condition:
+            self._plans_condition.wait_for(lambda: frame in self._plans)
+            return self._plans.pop(frame)
+
+    def fill(self, out_image, plan: ResidualPlan) -> None:
+        """ Write every block plan took from the cache into out_image (an upscaled frame), then unpin them. """
+        if not plan.cached_keys:
+            return
+
+        with self._lock:
+            blocks = np.stack([self._memory[key] for key in plan.cached_keys])
+            # A frame pins each block once, however many times it uses it.
+            for key in set(plan.cached_keys):
+                self._unpin(key)
+            self._evict()
+
+        scatter_blocks(out_image.frame,
+                       plan.cached_positions[:, 0] * self.scale_factor,
+                       plan.cached_positions[:, 1] * self.scale_factor,
+                       self.upscaled_block_size, blocks)
+
+    def add(self, plan: ResidualPlan, upscaled_residual, tile_positions: np.ndarray = None) -> None:
+        """
+        Cache the upscaled version of every tile in plan's residual image. If the tiles were moved elsewhere (i.e
+        laid out differently, or into a batch with other frames' tiles), tile_positions is where each of
+        plan.new_tiles ended up.
+        """
+        if not plan.new_keys:
+            return
+
+        if tile_positions is None:
+            tile_positions = plan.new_tiles
+
+        pitch = (self.block_size + self.bleed * 2) * self.scale_factor
+        blocks = gather_blocks(upscaled_residual.frame,
+                               tile_positions[:, 0] * pitch + self.bleed * self.scale_factor,
+                               tile_positions[:, 1] * pitch + self.bleed * self.scale_factor,
+                               self.upscaled_block_size)
+
+        with self._lock:
+            for key, block in zip(plan.new_keys, blocks):
+                if key not in self._memory:
+                    block = block.copy()
+                    self._memory[key] = block
+                    self._memory_used += block.nbytes
+            self._evict()
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits,
+                    "disk_hits": self.disk_hits,
+                    "misses": self.misses,
+                    "repeats_in_frame": self.repeats,
+                    "hit_rate": self.hits / lookups if lookups else 0.0,
+                    "evictions": self.evictions,
+                    "memory_used": self._memory_used,
+                    "disk_used": self._disk_used}
+
+    def log_stats(self) -> None:
+        stats = self.get_stats()
+        self.log.info("Block cache: %.1f%% hit rate (%d hits, %d from disk, %d misses, %d repeats within a frame), "
+                      "%d evictions, %.1f MB in memory, %.1f MB on disk."
+                      % (stats["hit_rate"] * 100, stats["hits"], stats["disk_hits"], stats["misses"],
+                         stats["repeats_in_frame"], stats["evictions"], stats["memory_used"] / 1e6,
+                         stats["disk_used"] / 1e6))
+
+    def _pin(self, key) -> bool:
+        """ Pin key if it's cached (promoting it from disk if need be), returns whether it was. """
+        if key in self._memory:
+            self._memory.move_to_end(key)
+        elif key in self._disk and self._promote(key):
+            self.disk_hits += 1
+        else:
+            return False
+
+        self._pins[key] = self._pins.get(key, 0) + 1
+        return True
+
+    def _unpin(self, key) -> None:
+        self._pins[key] -= 1
+        if self._pins[key] == 0:
+            del self._pins[key]
+
+    def _promote(self, key) -> bool:
+        disk_file = self._disk_file(key)
+        self._disk_used -= self._disk.pop(key)
+
+        try:
+            block = np.load(disk_file)
+            os.remove(disk_file)
+        except (OSError, ValueError):
+            self.log.warning("Could not load cached block %s, it'll be upscaled again." % disk_file)
+            return False
+
+        self._memory[key] = block
+        self._memory_used += block.nbytes
+        return True
+
+    def _evict(self) -> None:
+        """ Drop (or spill to disk) the least recently used unpinned blocks, until memory is within it's bound. """
+        if self._memory_used <= self.memory_bytes:
+            return
+
+        for key in list(self._memory):
+            if self._memory_used <= self.memory_bytes:
+                break
+            if key in self._pins:
+                continue
+
+            block = self._memory.pop(key)
+            self._memory_used -= block.nbytes
+            self.evictions += 1
+
+            if self.disk_dir is not None:
+                self._spill(key, block)
+
+    def _spill(self, key, block: np.ndarray) -> None:
+        disk_file = self._disk_file(key)
+        try:
+            np.save(disk_file, block)
+        except OSError:
+            self.log.warning("Could not save cached block %s to disk." % disk_file)
+            return
+
+        self._disk[key] = os.path.getsize(disk_file)
+        self._disk_used += self._disk[key]
+
+        while self._disk_used > self.disk_bytes and self._disk:
+            evicted, size = self._disk.popitem(last=False)
+            self._disk_used -= size
+            try:
+                os.remove(self._disk_file(evicted))
+            except OSError:
+                pass
+
+    def _open_disk(self) -> None:
+        """ Pick up the blocks a previous session (with the same settings) left on disk, oldest first. """
+        self._disk_opened = True
+        os.makedirs(self.disk_dir, exist_ok=True)
+
+        entries = []
+        with os.scandir(self.disk_dir) as directory:
+            for entry in directory:
+                name, extension = os.path.splitext(entry.name)
+                if extension != ".npy" or len(name) != 32:
+                    continue
+                stat = entry.stat()
+                entries.append((stat.st_mtime, (int(name[:16], 16), int(name[16:], 16)), stat.st_size))
+
+        for _, key, size in sorted(entries):
+            self._disk[key] = size
+            self._disk_used += size
+
+        self.log.info("Block cache found %d blocks on disk in %s" % (len(self._disk), self.disk_dir))
+
+    def _disk_file(self, key) -> str:
+        return self.disk_dir + "%016x%016x.npy" % key
@@ -20,8 +20,10 @@ import logging
 import subprocess
 import threading
 
+from dandere2x.dandere2x_service.core.vector_cache import FrameVectors, VectorCache
 from dandere2x.dandere2x_service.dandere2x_service_context import Dandere2xServiceContext
 from dandere2x.dandere2x_service.dandere2x_service_controller import Dandere2xController
+from dandere2x.dandere2xlib.utils.vector_file import STREAM_VECTOR_FORMAT, read_vector_record
 from dandere2x.dandere2xlib.utils.yaml_utils import load_executable_paths_yaml
 
 
@@ -30,10 +32,12 @@ class Dandere2xCppWrapper(threading.Thread):
     A wrapper for the dandere2x_cpp module. It simply calls the module using information used from the context.
     """
 
-    def __init__(self, context: Dandere2xServiceContext, controller: Dandere2xController):
+    def __init__(self, context: Dandere2xServiceContext, controller: Dandere2xController, vector_cache: VectorCache):
         threading.Thread.__init__(self, name="Dandere2xCpp")
         self.context = context
         self.controller = controller
+        self.vector_cache = vector_cache
+        self.streamed = context.dandere2x_cpp_vector_format == STREAM_VECTOR_FORMAT
 
         self.dandere2x_cpp_subprocess = None
         self.log = logging.getLogger()
@@ -46,7 +50,8 @@ class Dandere2xCppWrapper(threading.Thread):
                              self.context.dandere2x_cpp_block_matching_arg,
                              self.context.dandere2x_cpp_evaluator_arg,
                              str(self.context.service_request.quality_minimum),
-                             str(self.context.bleed)]
+                             str(self.context.bleed),
+                             self.context.dandere2x_cpp_vector_format]
 
     def join(self, timeout=None):
         self.log.info("Thread joined")
@@ -58,13 +63,43 @@ class Dandere2xCppWrapper(threading.Thread):
 
         console_output = open(self.context.log_dir + "dandere2x_cpp.txt", "w")
         console_output.write(str(self.exec_command))
-        self.dandere2x_cpp_subprocess = subprocess.run(self.exec_command, shell=False, stderr=console_output,
-                                                      stdout=console_output)
 
+        if self.streamed:
+            returncode = self.__run_streamed(console_output)
+        else:
+            self.dandere2x_cpp_subprocess = subprocess.run(self.exec_command, shell=False, stderr=console_output,
+                                                          stdout=console_output)
+            returncode = self.dandere2x_cpp_subprocess.returncode
 
-        if self.dandere2x_cpp_subprocess.returncode == 0:
+        if returncode == 0:
             logger.info("D2xcpp finished correctly.")
-        elif self.dandere2x_cpp_subprocess.returncode != 0:
+        else:
             logger.error("D2xcpp ended unexpectedly.")
             logger.error("Dandere2x will stop the current session.")
+            self.controller.report_error(Exception("D2xcpp ended unexpectedly."))
             raise Exception
+
+    def __run_streamed(self, console_output) -> int:
+        """
+        With the "stream" vector format, dandere2x_cpp writes each frame's vectors to it's stdout as a record (see
+        vector_file.py) rather than as files, which are handed straight to the vector cache as they arrive.
+        """
+        self.dandere2x_cpp_subprocess = subprocess.Popen(self.exec_command, shell=False, stderr=console_output,
+                                                         stdout=subprocess.PIPE, bufsize=0)
+
+        try:
+            with self.dandere2x_cpp_subprocess.stdout as stream:
+                record = read_vector_record(stream)
+                while record is not None:
+                    frame, fade_vectors, predictive_vectors, residual_vectors = record
+                    self.vector_cache.put(frame, FrameVectors(predictive_vectors, residual_vectors, fade_vectors))
+                    record = read_vector_record(stream)
+        except Exception as e:
+            # Left running, dandere2x_cpp would block on it's full stdout, and residual and merge on it's vectors.
+            self.log.error("Could not read dandere2x_cpp's vector stream, dandere2x will stop the current session.")
+            self.dandere2x_cpp_subprocess.kill()
+            self.dandere2x_cpp_subprocess.wait()
+            self.controller.report_error(e)
+            raise
+
+        return self.dandere2x_cpp_subprocess.wait()
@@ -0,0 +1,356 @@
+"""
+    This file is part of the Dandere2x project.
+    Dandere2x is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+    Dandere2x is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+    You should have received a copy of the GNU General Public License
+    along with Dandere2x.  If not, see <https://www.gnu.org/licenses/>.
+""""""
+
+========= Copyright aka_katto 2018, All rights reserved. ============
+Original Author: aka_katto
+Purpose: An in-package (numpy) version of dandere2x_cpp's driver, for
+         hosts where the native binary isn't built. It produces the
+         exact same fade / pframe / residual files, in the same order,
+         so the rest of dandere2x can't tell the two apart.
+
+         Per frame, it mirrors driver_difference:
+            1. Fade   - apply flat scalars to blocks of frame_1.
+            2. Match  - stationary check every block at once, then
+                        search (exhaustive or diamond) the rest, with
+                        rows of blocks spread over a process pool.
+            3. Redraw - the same 95% rule as PredictiveFrame::write.
+====================================================================="""
+import io
+import logging
+import math
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+from numpy.lib.stride_tricks import sliding_window_view
+
+from dandere2x.dandere2x_service.core.vector_cache import FrameVectors, VectorCache
+from dandere2x.dandere2x_service.dandere2x_service_context import Dandere2xServiceContext
+from dandere2x.dandere2x_service.dandere2x_service_controller import Dandere2xController
+from dandere2x.dandere2xlib.utils.dandere2x_utils import get_process_pool_context
+from dandere2x.dandere2xlib.utils.evaluators import AbstractEvaluator, get_evaluator, mse_blocks, frame_psnr
+from dandere2x.dandere2xlib.utils.frame_store import get_frame_store
+from dandere2x.dandere2xlib.utils.scene_cut import SceneCutManifest
+from dandere2x.dandere2xlib.utils.vector_file import STREAM_VECTOR_FORMAT, get_vector_reader, write_vector_file
+from dandere2x.dandere2xlib.wrappers.frame.frame import Frame, gather_blocks, scatter_blocks, add_scalars_saturated
+
+EXHAUSTIVE_SEARCH = "python_exhaustive"
+DIAMOND_SEARCH = "python_diamond"
+
+# Large and small diamond search patterns, as (dx, dy) offsets from the current center.
+_LARGE_DIAMOND = np.array([[0, 0], [2, 0], [-2, 0], [0, 2], [0, -2], [1, 1], [1, -1], [-1, 1], [-1, -1]])
+_SMALL_DIAMOND = np.array([[0, 0], [1, 0], [-1, 0], [0, 1], [0, -1]])
+
+
+def is_python_block_matching_arg(block_matching_arg: str) -> bool:
+    return block_matching_arg in (EXHAUSTIVE_SEARCH, DIAMOND_SEARCH)
+
+
+class Dandere2xPyWrapper(threading.Thread):
+    """
+    A drop-in replacement for Dandere2xCppWrapper, selected by setting dandere2x_cpp's block_matching_arg to
+    "python_exhaustive" or "python_diamond".
+    """
+
+    def __init__(self, context: Dandere2xServiceContext, controller: Dandere2xController, vector_cache: VectorCache):
+        threading.Thread.__init__(self, name="Dandere2xPy")
+        self.context = context
+        self.controller = controller
+        self.vector_cache = vector_cache
+        self.log = logging.getLogger(name=context.service_request.input_file)
+
+        self.block_size = context.service_request.block_size
+        self.quality = context.service_request.quality_minimum
+        self.bleed = context.bleed
+        self.algorithm = context.dandere2x_cpp_block_matching_arg
+        self.search_radius = context.dandere2x_py_search_radius
+        self.workers = context.dandere2x_py_workers or os.cpu_count()
+        self.streamed = context.dandere2x_cpp_vector_format == STREAM_VECTOR_FORMAT
+        self.vector_reader = None if self.streamed else get_vector_reader(context.dandere2x_cpp_vector_format)
+        self.evaluator_arg = context.dandere2x_cpp_evaluator_arg
+        self.evaluator = get_evaluator(self.evaluator_arg)
+
+        if not is_python_block_matching_arg(self.algorithm):
+            self.log.error("Unsupported block matching arg for dandere2x_py: %s" % self.algorithm)
+            raise ValueError("block_matching_arg must be python_exhaustive or python_diamond")
+
+        # Made up front, from the service thread, rather than in run with the rest of the session's threads going.
+        self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=get_process_pool_context())
+
+    def join(self, timeout=None):
+        self.log.info("Thread joined")
+        threading.Thread.join(self, timeout)
+
+    def run(self):
+        self.log.info("Run called, using %s with %d workers." % (self.algorithm, self.workers))
+
+        try:
+            with self.executor as executor:
+                self.__driver_difference(executor)
+        except Exception as e:
+            self.log.error("Dandere2xPy ended unexpectedly, dandere2x will stop the current session.")
+            self.controller.report_error(e)
+            raise
+
+        self.log.info("Dandere2xPy finished correctly.")
+
+    def __driver_difference(self, executor: ProcessPoolExecutor):
+        con = self.context
+
+        frame_1 = self.__load_frame(1)
+
+        for x in range(1, con.frame_count):
+            frame_2 = self.__load_frame(x + 1)
+
+            # Like driver_difference, scene cuts skip matching entirely (the marker is written before the frame).
+            if os.path.isfile(con.scene_cuts_dir + SceneCutManifest.MARKER_PREFIX + str(x + 1)):
+                no_vectors = np.zeros((0, 4), dtype=np.int64)
+                self.__write_vectors(x, np.zeros((0, 3), dtype=np.int64), no_vectors, no_vectors)
+                frame_1 = frame_2
+                continue
+
+            frame_2_compressed = compress_frame(frame_2, self.quality)
+
+            fade_vectors = fade_frame(frame_1, frame_2, frame_2_compressed, self.block_size, self.evaluator)
+            predictive_vectors, residual_vectors = predict_frame(frame_1, frame_2, frame_2_compressed,
+                                                                 self.block_size, self.bleed, self.evaluator,
+                                                                 self.algorithm, self.search_radius, executor)
+            self.__write_vectors(x, fade_vectors, predictive_vectors, residual_vectors)
+
+            # frame_2 was updated in place with the matched blocks, i.e it's now what merge.py will produce.
+            frame_1 = frame_2
+
+    def __write_vectors(self, x: int, fade_vectors: np.ndarray, predictive_vectors: np.ndarray,
+                        residual_vectors: np.ndarray):
+        if self.streamed:
+            self.vector_cache.put(x, FrameVectors(predictive_vectors, residual_vectors, fade_vectors))
+            return
+
+        con = self.context
+        reader = self.vector_reader
+        write_vector_file(reader.file_name(con.fade_data_dir + "fade_", x), fade_vectors)
+        write_vector_file(reader.file_name(con.pframe_data_dir + "pframe_", x), predictive_vectors)
+        write_vector_file(reader.file_name(con.residual_data_dir + "residual_", x), residual_vectors)
+
+    def __load_frame(self, frame: int) -> np.ndarray:
+        # Frames are updated in place while matching, so a frame store's (read-only) frame is copied.
+        frame_store = get_frame_store(self.context.noised_input_frames_dir)
+        if frame_store is not None:
+            return np.array(frame_store.get(frame))
+
+        loaded = Frame()
+        loaded.load_from_string_controller(self.context.noised_input_frames_dir + "frame" + str(frame) + ".png",
+                                           self.controller)
+        return np.ascontiguousarray(loaded.frame[:, :, :3])
+
+
+def compress_frame(frame: np.ndarray, quality: int) -> np.ndarray:
+    """ The frame after a round trip through a jpeg at 'quality', i.e the quality bar blocks are evaluated against. """
+    buffer = io.BytesIO()
+    Image.fromarray(frame).save(buffer, format="JPEG", quality=quality)
+    buffer.seek(0)
+    return np.asarray(Image.open(buffer).convert("RGB"))
+
+
+def block_grid(width: int, height: int, block_size: int):
+    """ The upper left corner of every whole block, ordered column by column like dandere2x_cpp's loops. """
+    xs, ys = np.meshgrid(np.arange(width // block_size) * block_size,
+                         np.arange(height // block_size) * block_size, indexing="ij")
+    return xs.ravel(), ys.ravel()
+
+
+def fade_frame(current: np.ndarray, next_frame: np.ndarray, next_compressed: np.ndarray,
+               block_size: int, evaluator: AbstractEvaluator) -> np.ndarray:
+    """
+    Find the blocks of 'current' that become 'next_frame' by adding a flat scalar to them, apply those scalars to
+    'current' in place, and return the (x, y, scalar) vectors.
+    """
+    xs, ys = block_grid(current.shape[1], current.shape[0], block_size)
+    current_blocks = gather_blocks(current, xs, ys, block_size)
+    next_blocks = gather_blocks(next_frame, xs, ys, block_size)
+
+    channel_count = current.shape[2]
+    means = (next_blocks.sum(axis=(1, 2, 3), dtype=np.int64) - current_blocks.sum(axis=(1, 2, 3), dtype=np.int64)) \
+        / (block_size * block_size * channel_count)
+    scalars = (np.sign(means) * np.floor(np.abs(means) + 0.5)).astype(np.int64)  # std::round, not banker's rounding
+
+    candidates = np.flatnonzero(scalars)
+    faded_blocks = current_blocks[candidates]
+    add_scalars_saturated(faded_blocks, scalars[candidates])
+
+    compressed_blocks = gather_blocks(next_compressed, xs[candidates], ys[candidates], block_size)
+    accepted = evaluator.evaluate(faded_blocks, next_blocks[candidates], compressed_blocks)
+
+    faded = candidates[accepted]
+    scatter_blocks(current, xs[faded], ys[faded], block_size, faded_blocks[accepted])
+
+    return np.stack([xs[faded], ys[faded], scalars[faded]], axis=1)
+
+
+def predict_frame(current: np.ndarray, next_frame: np.ndarray, next_compressed: np.ndarray,
+                  block_size: int, bleed: int, evaluator: AbstractEvaluator, algorithm: str, search_radius: int,
+                  executor: ProcessPoolExecutor):
+    """
+    Match every block of 'next_frame' to a block of 'current', returning the (predictive, residual) vectors. If the
+    frame isn't a redraw, 'next_frame' is updated in place with the matched blocks.
+    """
+    height, width = current.shape[0], current.shape[1]
+    xs, ys = block_grid(width, height, block_size)
+    source_xs, source_ys = xs.copy(), ys.copy()
+    matched = np.zeros(len(xs), dtype=bool)
+
+    # Don't conduct block matches if the PSNR is terribly low.
+    if frame_psnr(current, next_frame) >= 10:
+        next_blocks = gather_blocks(next_frame, xs, ys, block_size)
+        compressed_blocks = gather_blocks(next_compressed, xs, ys, block_size)
+        matched = evaluator.evaluate(gather_blocks(current, xs, ys, block_size), next_blocks, compressed_blocks)
+
+        if search_radius > 0:
+            _search_unmatched_blocks(current, next_blocks, compressed_blocks, xs, ys, source_xs, source_ys, matched,
+                                     block_size, evaluator, algorithm, search_radius, executor)
+
+    # The same rule as PredictiveFrame::write - if too few blocks matched, redraw the entire frame.
+    missing_count = len(xs) - np.count_nonzero(matched)
+    if int(width * height * 0.95) < missing_count * (block_size + bleed) * (block_size + bleed):
+        empty = np.zeros((0, 4), dtype=np.int64)
+        return empty, empty
+
+    predictive_vectors = np.stack([xs, ys, source_xs, source_ys], axis=1)[matched]
+
+    # Lay the missing blocks out in a square, filling it column by column.
+    missing = np.flatnonzero(~matched)
+    dimension = int(math.sqrt(len(missing)) + 1)
+    positions = np.arange(len(missing))
+    residual_vectors = np.stack([xs[missing], ys[missing], positions // dimension, positions % dimension], axis=1)
+
+    scatter_blocks(next_frame, xs[matched], ys[matched], block_size,
+                   gather_blocks(current, source_xs[matched], source_ys[matched], block_size))
+
+    return predictive_vectors, residual_vectors
+
+
+def _search_unmatched_blocks(current, next_blocks, compressed_blocks, xs, ys, source_xs, source_ys, matched,
+                             block_size, evaluator, algorithm, search_radius, executor):
+    """ Search for every unmatched block, one process pool task per row of blocks. Updates the arrays in place. """
+    height = current.shape[0]
+    futures = []
+
+    for row_y in np.unique(ys[~matched]):
+        row = np.flatnonzero((ys == row_y) & ~matched)
+
+        # Workers only need the rows of 'current' the search can reach.
+        band_top = max(0, row_y - search_radius)
+        band_bottom = min(height, row_y + block_size + search_radius)
+
+        futures.append((row, executor.submit(_search_row, current[band_top:band_bottom], band_top,
+                                             next_blocks[row], compressed_blocks[row], xs[row], row_y,
+                                             block_size, evaluator, algorithm, search_radius)))
+
+    for row, future in futures:
+        row_source_xs, row_source_ys, row_matched = future.result()
+        source_xs[row] = row_source_xs
+        source_ys[row] = row_source_ys
+        matched[row] = row_matched
+
+
+def _search_row(band, band_top, next_blocks, compressed_blocks, block_xs, block_y, block_size, evaluator,
+                algorithm, search_radius):
+    """
+    Process pool task - find the best match in 'band' (rows [band_top, band_top + len(band)) of the current frame)
+    for every block of one row of the next frame. Like dandere2x_cpp, the search minimizes mse, then the evaluator
+    decides if the best candidate is good enough. Returns the matched blocks' sources, and which blocks matched.
+    """
+    windows = sliding_window_view(band, (block_size, block_size), axis=(0, 1))
+    block_ys = np.full(len(block_xs), block_y)
+
+    def cost(index, candidate_xs, candidate_ys):
+        """
+        The mse of block index[i] against the candidate at (candidate_xs[i], candidate_ys[i]), or inf for candidates
+        that are out of bounds or outside the search radius.
+        """
+        valid = (candidate_xs >= 0) & (candidate_xs < windows.shape[1]) & \
+                (candidate_ys >= band_top) & (candidate_ys - band_top < windows.shape[0]) & \
+                (np.abs(candidate_xs - block_xs[index]) <= search_radius) & \
+                (np.abs(candidate_ys - block_ys[index]) <= search_radius)
+
+        costs = np.full(len(index), np.inf)
+        candidates = np.moveaxis(windows[candidate_ys[valid] - band_top, candidate_xs[valid]], 1, -1)
+        costs[valid] = mse_blocks(candidates, next_blocks[index[valid]])
+        return costs
+
+    if algorithm == EXHAUSTIVE_SEARCH:
+        best_xs, best_ys, best_costs = _exhaustive_search(cost, block_xs, block_ys, search_radius)
+    else:
+        best_xs, best_ys, best_costs = _diamond_search(cost, block_xs, block_ys, search_radius)
+
+    found = np.isfinite(best_costs)
+    matched = np.zeros(len(block_xs), dtype=bool)
+    best_blocks = np.moveaxis(windows[best_ys[found] - band_top, best_xs[found]], 1, -1)
+    matched[found] = evaluator.evaluate(best_blocks, next_blocks[found], compressed_blocks[found])
+
+    return best_xs, best_ys, matched
+
+
+def _exhaustive_search(cost, block_xs, block_ys, search_radius):
+    offsets = range(-search_radius, search_radius + 1)
+    displacements = [(dx, dy) for dx in offsets for dy in offsets]
+    # Check the smallest displacements first, so ties go to the least movement.
+    displacements.sort(key=lambda d: abs(d[0]) + abs(d[1]))
+
+    index = np.arange(len(block_xs))
+    best_xs, best_ys = block_xs.copy(), block_ys.copy()
+    best_costs = np.full(len(block_xs), np.inf)
+
+    for dx, dy in displacements:
+        costs = cost(index, block_xs + dx, block_ys + dy)
+        better = costs < best_costs
+        best_xs[better] = block_xs[better] + dx
+        best_ys[better] = block_ys[better] + dy
+        best_costs[better] = costs[better]
+
+    return best_xs, best_ys, best_costs
+
+
+def _diamond_search(cost, block_xs, block_ys, search_radius):
+    index = np.arange(len(block_xs))
+    centers_x, centers_y = block_xs.copy(), block_ys.copy()
+    center_costs = cost(index, centers_x, centers_y)
+
+    # Walk the large diamond until every block's center is it's own best match (capped, for a constant worst case).
+    searching = index
+    for _ in range(search_radius * 2):
+        if len(searching) == 0:
+            break
+        searching = _diamond_step(cost, _LARGE_DIAMOND, searching, centers_x, centers_y, center_costs)
+
+    # Then refine once with the small diamond.
+    _diamond_step(cost, _SMALL_DIAMOND, index, centers_x, centers_y, center_costs)
+    return centers_x, centers_y, center_costs
+
+
+def _diamond_step(cost, pattern, index, centers_x, centers_y, center_costs):
+    """ Move the centers of the blocks in 'index' to the best point of 'pattern' around them, returning which moved. """
+    pattern_costs = np.stack([cost(index, centers_x[index] + dx, centers_y[index] + dy) for dx, dy in pattern[1:]])
+    best = np.argmin(pattern_costs, axis=0)
+    best_costs = pattern_costs[best, np.arange(len(index))]
+
+    moved = best_costs < center_costs[index]
+    moved_index = index[moved]
+    centers_x[moved_index] += pattern[1:][best[moved], 0]
+    centers_y[moved_index] += pattern[1:][best[moved], 1]
+    center_costs[moved_index] = best_costs[moved]
+
+    return moved_index
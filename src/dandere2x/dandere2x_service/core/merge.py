@@ -33,15 +33,26 @@ Comments / Notes: This is probably the most difficult to understand
                   this method to supplement the confusing nature 
 ====================================================================="""
 import logging
+import math
 import threading
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
+
+from dandere2x.dandere2x_service.core.atlas_layout import get_frame_placement
+from dandere2x.dandere2x_service.core.block_cache import BlockCache
+from dandere2x.dandere2x_service.core.residual_batcher import ResidualBatcher
 from dandere2x.dandere2x_service.core.residual_plugins.fade import fade_image
+from dandere2x.dandere2x_service.core.vector_cache import VectorCache
 from dandere2x.dandere2x_service.dandere2x_service_context import Dandere2xServiceContext
 from dandere2x.dandere2x_service.dandere2x_service_controller import Dandere2xController
-from dandere2x.dandere2xlib.utils.dandere2x_utils import get_lexicon_value, get_list_from_file_and_wait, wait_on_file
+from dandere2x.dandere2xlib.utils.dandere2x_utils import get_lexicon_value
+from dandere2x.dandere2xlib.utils.scene_cut import SceneCutManifest
 from dandere2x.dandere2xlib.wrappers.ffmpeg.pipe_thread import Pipe
-from dandere2x.dandere2xlib.wrappers.frame.asyncframe import AsyncFrameRead, AsyncFrameWrite
+from dandere2x.dandere2xlib.wrappers.frame.asyncframe import AsyncFrameWrite
 from dandere2x.dandere2xlib.wrappers.frame.frame import Frame
+from dandere2x.dandere2xlib.wrappers.frame.frame_pool import FramePool
+from dandere2x.dandere2xlib.wrappers.frame.frame_prefetcher import FramePrefetcher
 from dandere2x.dandere2x_service.core.residual_plugins.pframe import pframe_image
 
 class Merge(threading.Thread):
@@ -53,7 +64,12 @@ class Merge(threading.Thread):
           as signalling to other parts of Dandere2x we've finished upscaling.
     """
 
-    def __init__(self, context: Dandere2xServiceContext, controller: Dandere2xController):
+    # How often (in frames) the block cache's hit rate is logged.
+    BLOCK_CACHE_STATS_INTERVAL = 500
+
+    def __init__(self, context: Dandere2xServiceContext, controller: Dandere2xController,
+                 vector_cache: VectorCache, scene_cut_manifest: SceneCutManifest, block_cache: BlockCache = None,
+                 batcher: ResidualBatcher = None):
         # Threading Specific
         threading.Thread.__init__(self, name="MergeThread")
 
@@ -61,10 +77,36 @@ class Merge(threading.Thread):
         self.controller = controller
         # load variables from context
         self.log = logging.getLogger(name=context.service_request.input_file)
+        self.vector_cache = vector_cache
+        self.scene_cut_manifest = scene_cut_manifest
+        self.block_cache = block_cache
+
+        # With batching, the upscaled residuals of a batch's first frame hold the tiles of the batch's other frames.
+        self.batcher = batcher
+        self.batch_upscaled_residuals = None
 
         # setup the pipe for merging
         self.pipe = Pipe(self.context.service_request.output_file, context=context, controller=controller)
 
+        # The merged frames are rotated through a pool of buffers, which is made once the output resolution is known.
+        self.frame_pool = None
+
+        """
+        The upscaled residuals are loaded in order, several frames ahead of merging, by a persistent pool of threads
+        (decoding releases the GIL), so merge doesn't wait on disk + png decoding for each frame.
+        """
+        self.upscaled_prefetcher = FramePrefetcher(
+            lambda x: self.context.residual_upscaled_dir + "output_" + get_lexicon_value(6, x) + ".png",
+            first=1, last=self.context.frame_count - 1,
+            lookahead=context.upscaled_prefetch_lookahead, workers=context.upscaled_prefetch_workers,
+            controller=controller)
+
+        # Large frames can be merged a horizontal stripe at a time on a pool of threads, see make_merge_image.
+        self.merge_stripes = max(1, context.merge_stripes)
+        self.stripe_executor = None
+        if self.merge_stripes > 1:
+            self.stripe_executor = ThreadPoolExecutor(max_workers=self.merge_stripes, thread_name_prefix="MergeStripe")
+
     def join(self, timeout=None):
         self.log.info("Join called.")
         self.pipe.join()
@@ -81,60 +123,89 @@ class Merge(threading.Thread):
             self.context.merged_dir + "merged_" + str(1) + ".png",
             self.controller)
 
+        """
+        Every merged frame is written into a pooled buffer. A merged frame is owned by both merge (as it's the next
+        iteration's frame_previous) and the pipe (until it's written), so the pool needs enough buffers for the pipe's
+        buffer, the frame the pipe is currently writing, frame_previous, and the frame being merged.
+        """
+        pipe_capacity = self.pipe.get_buffer_capacity(frame_previous.frame.nbytes)
+        self.frame_pool = FramePool(frame_previous.width, frame_previous.height, pipe_capacity + 3)
+
         # Load and pipe the 'first' image before we start the for loop procedure, since all the other images will
         # inductively build off this first frame.
-        frame_previous = Frame()
-        frame_previous.load_from_string_controller(
-            self.context.merged_dir + "merged_" + str(1) + ".png", self.controller)
-        self.pipe.save(frame_previous)
+        first_frame = self.frame_pool.acquire()
+        first_frame.copy_image(frame_previous)
+        frame_previous = first_frame
 
-        current_upscaled_residuals = Frame()
-        current_upscaled_residuals.load_from_string_controller(
-            self.context.residual_upscaled_dir + "output_" + get_lexicon_value(6, 1) + ".png",
-            self.controller)
+        self.frame_pool.retain(frame_previous)
+        self.pipe.save(frame_previous, self.frame_pool)
 
-        last_frame = False
         for x in range(1, self.context.frame_count):
             ########################################
             # Pre-loop logic checks and conditions #
             ########################################
 
-            # Check if we're at the last image, which affects the behaviour of the loop.
-            if x == self.context.frame_count - 1:
-                last_frame = True
-
-            # Pre-load the next iteration of the loop image ahead of time, if we're not on the last frame.
-            if not last_frame:
-                """ 
-                By asynchronously loading frames ahead of time, this provides a small but meaningful
-                boost in performance when spanned over N frames. There's some code over head but 
-                it's well worth it. 
-                """
-                background_frame_load = AsyncFrameRead(
-                    self.context.residual_upscaled_dir + "output_" + get_lexicon_value(6, x + 1) + ".png",
-                    self.controller)
-                background_frame_load.start()
+            # Blocks until the prefetcher has loaded this frame's upscaled residuals (usually it already has).
+            current_upscaled_residuals = self.upscaled_prefetcher.get(x)
+            if current_upscaled_residuals is None:
+                self.log.info("Session was killed while waiting on upscaled residuals, exiting merge.")
+                break
 
             ######################
             # Core Logic of Loop #
             ######################
 
-            # Load the needed vectors to create the merged image.
+            # Every frame residual.py publishes goes through the batcher, batched or not.
+            slot = None
+            if self.batcher is not None:
+                slot = self.batcher.take_slot(x)
+
+            if self.scene_cut_manifest.is_cut(x + 1):
+                # On a scene cut, the upscaled 'residual' is the entire frame, so it simply replaces frame_previous.
+                current_frame = self.frame_pool.acquire()
+                current_frame.copy_image(current_upscaled_residuals)
+            else:
+                # Load the needed vectors to create the merged image.
+                # These are read (once) by the vector cache, and shared with residual.py.
+                frame_vectors = self.vector_cache.get(x)
+                residual_vectors = frame_vectors.residual_vectors
+
+                # With a block cache, only some of the residual blocks were upscaled, the rest are in the cache.
+                plan = None
+                if self.block_cache is not None:
+                    plan = self.block_cache.take_plan(x)
+                    residual_vectors = plan.residual_vectors
 
-            prediction_data_list = get_list_from_file_and_wait(
-                self.context.pframe_data_dir + "pframe_" + str(x) + ".txt")
-            residual_data_list = get_list_from_file_and_wait(
-                self.context.residual_data_dir + "residual_" + str(x) + ".txt")
-            fade_data_list = get_list_from_file_and_wait(self.context.fade_data_dir + "fade_" + str(x) + ".txt")
+                # Where this frame's tiles are in the upscaled residuals (the vectors are in dandere2x_cpp's layout).
+                if slot is not None:
+                    if slot.carrier == x:
+                        self.batch_upscaled_residuals = current_upscaled_residuals
+                    current_upscaled_residuals = self.batch_upscaled_residuals
+                    placement = slot.placement
+                else:
+                    placement = get_frame_placement(self.context, len(residual_vectors) if plan is None
+                                                    else len(plan.tile_vectors))
+                residual_vectors = placement.remap_vectors(residual_vectors)
 
-            # Create the actual image itself.
-            current_frame = self.make_merge_image(self.context, current_upscaled_residuals, frame_previous,
-                                                  prediction_data_list, residual_data_list, fade_data_list)
+                # Create the actual image itself.
+                current_frame = self.make_merge_image(self.context, current_upscaled_residuals, frame_previous,
+                                                      frame_vectors.predictive_vectors,
+                                                      residual_vectors,
+                                                      frame_vectors.fade_vectors, out_image=self.frame_pool.acquire(),
+                                                      stripe_executor=self.stripe_executor,
+                                                      stripes=self.merge_stripes)
+
+                if plan is not None:
+                    self.block_cache.fill(current_frame, plan)
+                    self.block_cache.add(plan, current_upscaled_residuals,
+                                         tile_positions=placement.remap(plan.new_tiles))
+            self.vector_cache.release(x, VectorCache.MERGE)
             ###############
             # Saving Area #
             ###############
-            # Directly write the image to the ffmpeg pipe line.
-            self.pipe.save(current_frame)
+            # Directly write the image to the ffmpeg pipe line, handing off a reference to the pipe.
+            self.frame_pool.retain(current_frame)
+            self.pipe.save(current_frame, self.frame_pool)
 
             # Manually write the image if we're preserving frames (this is for enthusiasts / debugging).
 
@@ -145,24 +216,30 @@ class Merge(threading.Thread):
             #######################################
             # Assign variables for next iteration #
             #######################################
-            if not last_frame:
-                # We need to wait until the next upscaled image exists before we move on.
-                while not background_frame_load.load_complete:
-                    wait_on_file(self.context.residual_upscaled_dir + "output_" + get_lexicon_value(6, x + 1) + ".png")
             """
             Now that we're all done with the current frame, the current `current_frame` is now the frame_previous
             (with respect to the next iteration). We could obviously manually load frame_previous = Frame(n-1) each
             time, but this is an optimization that makes a substantial difference over N frames.
             """
+            self.frame_pool.release(frame_previous)
             frame_previous = current_frame
-            current_upscaled_residuals = background_frame_load.loaded_image
             self.controller.update_frame_count(x)
 
+            if self.block_cache is not None and x % self.BLOCK_CACHE_STATS_INTERVAL == 0:
+                self.block_cache.log_stats()
+
+        if self.block_cache is not None:
+            self.block_cache.log_stats()
+        self.upscaled_prefetcher.shutdown()
+        if self.stripe_executor is not None:
+            self.stripe_executor.shutdown()
+        self.frame_pool.release(frame_previous)
         self.pipe.kill()
 
     @staticmethod
     def make_merge_image(context: Dandere2xServiceContext, frame_residual: Frame, frame_previous: Frame,
-                         list_predictive: list, list_residual: list, list_fade: list):
+                         predictive_vectors: np.ndarray, residual_vectors: np.ndarray, fade_vectors: np.ndarray,
+                         out_image: Frame = None, stripe_executor: ThreadPoolExecutor = None, stripes: int = 1):
         """
         This section can best be explained through pictures. A visual way of expressing what 'merging'
         is doing is this section in the wiki.
@@ -176,13 +253,19 @@ class Merge(threading.Thread):
             - Predictive vectors mapping frame(x) -> frame(x+1)
 
         Output:
-            - frame(x+1)
+            - frame(x+1), written into out_image if given (i.e a pooled buffer), otherwise into a new Frame.
+
+        If a stripe_executor is given, the frame is split into `stripes` horizontal stripes (on block boundaries)
+        which are merged concurrently. Every vector writes to exactly one block, so each stripe only needs the
+        vectors whose destination is inside it, while the sources (frame_previous and frame_residual) are never
+        written to, so a vector can read from any stripe.
         """
-        out_image = Frame()
-        out_image.create_new(frame_previous.width, frame_previous.height)
+        if out_image is None:
+            out_image = Frame()
+            out_image.create_new(frame_previous.width, frame_previous.height)
 
-        # If list_predictive is empty, then the residual frame is simply the newly produced image.
-        if not list_predictive:
+        # If there are no predictive vectors, then the residual frame is simply the newly produced image.
+        if len(predictive_vectors) == 0:
             out_image.copy_image(frame_residual)
             return out_image
 
@@ -191,14 +274,57 @@ class Merge(threading.Thread):
         are also copied. This allows us to ignore copying vectors (x,y) -> (x,y), which prevents redundant copying,
         thus saving valuable computational time.
         """
-        out_image.copy_image(frame_previous)
+        if stripe_executor is None or stripes <= 1:
+            out_image.copy_image(frame_previous)
+            Merge._merge_vectors(context, out_image, frame_previous, frame_residual,
+                                 predictive_vectors, residual_vectors, fade_vectors)
+            return out_image
+
+        block_size = context.service_request.block_size
+        scale_factor = int(context.service_request.scale_factor)
+        rows_per_stripe = max(1, math.ceil(frame_previous.height / scale_factor / block_size / stripes))
+
+        # Vectors are in input frame coordinates, with their destination's y in column 1.
+        def stripe_of(vectors: np.ndarray) -> np.ndarray:
+            return vectors[:, 1] // block_size // rows_per_stripe
+
+        predictive_stripes = stripe_of(predictive_vectors)
+        residual_stripes = stripe_of(residual_vectors)
+        fade_stripes = stripe_of(fade_vectors)
+
+        futures = []
+        for stripe in range(stripes):
+            y_start = min(stripe * rows_per_stripe * block_size * scale_factor, frame_previous.height)
+            y_end = frame_previous.height if stripe == stripes - 1 else \
+                min((stripe + 1) * rows_per_stripe * block_size * scale_factor, frame_previous.height)
 
+            futures.append(stripe_executor.submit(Merge._merge_stripe, context, out_image, frame_previous,
+                                                  frame_residual, y_start, y_end,
+                                                  predictive_vectors[predictive_stripes == stripe],
+                                                  residual_vectors[residual_stripes == stripe],
+                                                  fade_vectors[fade_stripes == stripe]))
+        for future in futures:
+            future.result()
+
+        return out_image
+
+    @staticmethod
+    def _merge_stripe(context: Dandere2xServiceContext, out_image: Frame, frame_previous: Frame,
+                      frame_residual: Frame, y_start: int, y_end: int, predictive_vectors: np.ndarray,
+                      residual_vectors: np.ndarray, fade_vectors: np.ndarray):
+        """ Merge rows [y_start, y_end) of out_image, given only the vectors whose destination is in those rows. """
+        np.copyto(out_image.frame[y_start:y_end], frame_previous.frame[y_start:y_end])
+        Merge._merge_vectors(context, out_image, frame_previous, frame_residual,
+                             predictive_vectors, residual_vectors, fade_vectors)
+
+    @staticmethod
+    def _merge_vectors(context: Dandere2xServiceContext, out_image: Frame, frame_previous: Frame,
+                       frame_residual: Frame, predictive_vectors: np.ndarray, residual_vectors: np.ndarray,
+                       fade_vectors: np.ndarray):
         ###################
         # Plugins Section #
         ###################
 
         # Note: Run the residual_plugins in the SAME order it was ran in dandere2x_cpp. If not, it won't work correctly.
-        out_image = fade_image(context, out_image, list_fade)
-        out_image = pframe_image(context, out_image, frame_previous, frame_residual, list_residual, list_predictive)
-
-        return out_image
+        fade_image(context, out_image, fade_vectors)
+        pframe_image(context, out_image, frame_previous, frame_residual, residual_vectors, predictive_vectors)
@@ -30,7 +30,11 @@ from colorlog import logging
 from dandere2x.dandere2x_service.dandere2x_service_context import Dandere2xServiceContext
 from dandere2x.dandere2x_service.dandere2x_service_controller import Dandere2xController
 from dandere2x.dandere2xlib.utils.dandere2x_utils import get_lexicon_value
+from dandere2x.dandere2xlib.utils.frame_store import get_frame_store
+from dandere2x.dandere2xlib.utils.scene_cut import SceneCutManifest
+from dandere2x.dandere2xlib.utils.vector_file import STREAM_VECTOR_FORMAT, get_vector_reader
 from dandere2x.dandere2xlib.wrappers.ffmpeg.progressive_frame_extractor import ProgressiveFrameExtractor
+from dandere2x.dandere2xlib.wrappers.ffmpeg.progressive_noise_adder import ProgressiveNoiseAdder
 
 
 class MinDiskUsage(threading.Thread):
@@ -43,21 +47,30 @@ class MinDiskUsage(threading.Thread):
       we no longer need the relevant files.
     """
 
-    def __init__(self, context: Dandere2xServiceContext, controller: Dandere2xController):
+    def __init__(self, context: Dandere2xServiceContext, controller: Dandere2xController,
+                 scene_cut_manifest: SceneCutManifest, noise_adder: ProgressiveNoiseAdder):
         # Threading Specific
         threading.Thread.__init__(self, name="Min Disk Thread")
 
         self.log = logging.getLogger(name=context.service_request.input_file)
         self.context = context
         self.controller = controller
+        self.scene_cut_manifest = scene_cut_manifest
         self.max_frames_ahead = self.context.max_frames_ahead
         self.frame_count = context.frame_count
+        # Streamed vectors never touch the disk, so there are no vector files to delete.
+        self.vector_reader = None
+        if context.dandere2x_cpp_vector_format != STREAM_VECTOR_FORMAT:
+            self.vector_reader = get_vector_reader(context.dandere2x_cpp_vector_format)
         self.progressive_frame_extractor = ProgressiveFrameExtractor(input_video=self.context.service_request.input_file,
                                                                      extracted_frames_dir=self.context.input_frames_dir,
                                                                      compressed_frames_dir=self.context.compressed_static_dir,
                                                                      compressed_quality=self.context.service_request.quality_minimum,
                                                                      block_size=self.context.service_request.block_size,
-                                                                     output_options_original=self.context.service_request.output_options)
+                                                                     output_options_original=self.context.service_request.output_options,
+                                                                     scene_cut_manifest=scene_cut_manifest,
+                                                                     noise_adder=noise_adder,
+                                                                     controller=controller)
         self.start_frame = 1
 
     def join(self, timeout=None):
@@ -79,10 +92,7 @@ class MinDiskUsage(threading.Thread):
             self.log.debug("Processing frame x: " + str(x))
 
             # wait for signal to get ahead of MinDiskUsage
-            while x >= self.controller.get_current_frame():
-                time.sleep(.00001)
-
-            if not self.is_alive():
+            if not self.controller.wait_for_frame(x + 1):
                 return
 
             # when it does get ahead, extract the next frame
@@ -121,16 +131,26 @@ class MinDiskUsage(threading.Thread):
 
         index_to_remove = str(remove_before - 2)
 
-        prediction_data_file_r = pframe_data_dir + "pframe_" + index_to_remove + ".txt"
-        residual_data_file_r = residual_data_dir + "residual_" + index_to_remove + ".txt"
-        fade_data_file_r = fade_data_dir + "fade_" + index_to_remove + ".txt"
         input_image_r = input_frames_dir + "frame" + index_to_remove + ".png"
         noised_image = noised_image_dir + "frame" + index_to_remove + ".png"
         upscaled_file_r = residual_upscaled_dir + "output_" + get_lexicon_value(6, int(remove_before)) + ".png"
 
         # "mark" them-------
-        remove = [prediction_data_file_r, residual_data_file_r, noised_image,
-                  fade_data_file_r, input_image_r, upscaled_file_r]
+        remove = [upscaled_file_r]
+
+        # Frames kept in a frame store were never saved as files (bar the first input frame, which is left be).
+        if get_frame_store(noised_image_dir) is None:
+            remove.append(noised_image)
+        if get_frame_store(input_frames_dir) is None:
+            remove.append(input_image_r)
+
+        if self.scene_cut_manifest.is_cut(int(index_to_remove)):
+            remove.append(self.scene_cut_manifest.marker_file(int(index_to_remove)))
+
+        if self.vector_reader is not None:
+            remove += [self.vector_reader.file_name(pframe_data_dir + "pframe_", int(index_to_remove)),
+                       self.vector_reader.file_name(residual_data_dir + "residual_", int(index_to_remove)),
+                       self.vector_reader.file_name(fade_data_dir + "fade_", int(index_to_remove))]
 
         # remove
         threading.Thread(target=self.__delete_files_from_list, args=(remove,), daemon=True, name="mindiskusage").start()
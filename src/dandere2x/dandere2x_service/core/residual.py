@@ -19,24 +19,42 @@ Purpose:
 ====================================================================="""
 
 import logging
-import math
+import os
 import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError
 
+import numpy as np
+
+from dandere2x.dandere2x_service.core.atlas_layout import get_frame_placement
+from dandere2x.dandere2x_service.core.block_cache import BlockCache
+from dandere2x.dandere2x_service.core.residual_batcher import ResidualBatcher, ResidualTiles
+from dandere2x.dandere2x_service.core.vector_cache import VectorCache
 from dandere2x.dandere2x_service.dandere2x_service_context import Dandere2xServiceContext
 from dandere2x.dandere2x_service.dandere2x_service_controller import Dandere2xController
-from dandere2x.dandere2xlib.utils.dandere2x_utils import get_lexicon_value, get_list_from_file_and_wait
-from dandere2x.dandere2xlib.wrappers.frame.frame import Frame, DisplacementVector
+from dandere2x.dandere2xlib.utils.dandere2x_utils import get_lexicon_value, get_process_pool_context, rename_file
+from dandere2x.dandere2xlib.utils.frame_store import get_frame_store
+from dandere2x.dandere2xlib.utils.scene_cut import SceneCutManifest
+from dandere2x.dandere2xlib.wrappers.frame.frame import Frame, DisplacementVector, gather_blocks
 
 
 class Residual(threading.Thread):
 
-    def __init__(self, context: Dandere2xServiceContext, controller: Dandere2xController):
+    def __init__(self, context: Dandere2xServiceContext, controller: Dandere2xController,
+                 vector_cache: VectorCache, scene_cut_manifest: SceneCutManifest, block_cache: BlockCache = None,
+                 batcher: ResidualBatcher = None):
         # Threading Specific
         threading.Thread.__init__(self, name="ResidualThread")
 
         self.con = context
         self.controller = controller
         self.log = logging.getLogger(name=context.service_request.input_file)
+        self.vector_cache = vector_cache
+        self.scene_cut_manifest = scene_cut_manifest
+        self.block_cache = block_cache
+        self.batcher = batcher
+        self.workers = max(1, context.residual_workers)
+        self.worker_type = context.residual_worker_type
 
     def join(self, timeout=None):
         self.log.info("Method called.")
@@ -46,54 +64,99 @@ class Residual(threading.Thread):
     def run(self):
         self.log.info("Run called.")
 
+        """
+        A residual image depends only on frame(x+1) and it's vectors, so several frames are made at once by a pool of
+        workers. Each worker saves it's image to a temporary file, and the images are published (renamed into
+        residual_images) here, strictly in frame order, since the upscalers consume them in lexicon order. With a
+        batcher, workers hand back their tiles instead, which are packed into shared residual images as they're
+        published.
+        """
+        executor = self._create_executor()
+        in_flight = deque()  # (frame, future) in the order they were submitted
+
         for x in range(1, self.con.frame_count):
+            is_scene_cut = self.scene_cut_manifest.is_cut(x + 1)
 
-            # Files needed to create a residual image
-            f1 = Frame()
-            f1.load_from_string_controller(self.con.input_frames_dir + "frame" + str(x + 1) + ".png",
-                                           self.controller)
-            # Load the neccecary lists to compute this iteration of residual making
-            residual_data = get_list_from_file_and_wait(self.con.residual_data_dir + "residual_" + str(x) + ".txt")
+            if is_scene_cut:
+                # Nothing carries over a scene cut, so upscale the entire frame without waiting on any vectors.
+                residual_vectors, predictive_vectors = None, None
+            else:
+                # Load the neccecary lists to compute this iteration of residual making
+                frame_vectors = self._get_vectors(x)
+                residual_vectors = frame_vectors.residual_vectors
+                predictive_vectors = frame_vectors.predictive_vectors
 
-            prediction_data = get_list_from_file_and_wait(self.con.pframe_data_dir + "pframe_" + str(x) + ".txt")
+            in_flight.append((x, executor.submit(make_residual_file, self.con, x, residual_vectors,
+                                                 predictive_vectors, is_scene_cut, self.block_cache,
+                                                 self.batcher is not None)))
 
-            # Create the output files..
-            debug_output_file = self.con.debug_dir + "debug" + str(x + 1) + ".png"
-            output_file = self.con.residual_images_dir + "output_" + get_lexicon_value(6, x) + ".png"
+            # Bound how far ahead the workers get of the frames being published.
+            while len(in_flight) > self.workers * 2:
+                self._publish(*in_flight.popleft())
 
-            # Save to a temp folder so waifu2x-vulkan doesn't try reading it, then move it
-            out_image = self.make_residual_image(self.con, f1, residual_data, prediction_data)
+        while in_flight:
+            self._publish(*in_flight.popleft())
 
-            if out_image.get_res() == (1, 1):
-                """
-                If out_image is (1,1) in size, then frame_x and frame_x+1 are identical.
+        if self.batcher is not None:
+            self.batcher.flush()
+            self.batcher.log_stats()
 
-                We still need to save an outimage for sake of having N output images for N input images, so we
-                save these meaningless files anyways.
+        executor.shutdown()
 
-                However, these 1x1 can slow whatever waifu2x implementation down, so we 'cheat' d2x 
-                but 'fake' upscaling them, so that they don't need to be processed by waifu2x.
-                """
+    def _create_executor(self):
+        if self.worker_type == "thread":
+            return ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="ResidualWorker")
 
-                # Location of the 'fake' upscaled image.
-                out_image = Frame()
-                out_image.create_new(2, 2)
-                output_file = self.con.residual_upscaled_dir + "output_" + get_lexicon_value(6, x) + ".png"
-                out_image.save_image(output_file)
+        if self.worker_type == "process":
+            return ProcessPoolExecutor(max_workers=self.workers, mp_context=get_process_pool_context())
 
+        self.log.error("No valid residual worker type selected: %s" % self.worker_type)
+        raise ValueError("residual_worker_type must be 'thread' or 'process'")
+
+    def _get_vectors(self, x: int):
+        """
+        Waits on frame x's vectors. When block matching is what's holding residual back, this is where it waits, so
+        the open batch (if any) is closed here once it's been open for as long as the batcher allows too.
+        """
+        if self.batcher is not None:
+            while True:
+                frame_vectors = self.vector_cache.get(x, timeout=self.batcher.time_left())
+                if frame_vectors is not None:
+                    return frame_vectors
+
+                self.batcher.flush()
+
+        return self.vector_cache.get(x)
+
+    def _publish(self, x: int, future) -> None:
+        if self.batcher is None:
+            temp_file = future.result()
+        else:
+            # Don't hold an open batch back (and merge with it) for longer than the batcher allows.
+            try:
+                temp_file = future.result(timeout=self.batcher.time_left())
+            except TimeoutError:
+                self.batcher.flush()
+                temp_file = future.result()
+
+            if isinstance(temp_file, ResidualTiles):
+                self.batcher.add(x, temp_file)
+                temp_file = None
             else:
-                # This image has things to upscale, continue normally
-                out_image.save_image_temp(out_location=output_file, temp_location=self.con.temp_image)
+                self.batcher.skip(x, flush=temp_file is not None)
+
+        if temp_file is not None:
+            output_file = self.con.residual_images_dir + "output_" + get_lexicon_value(6, x) + ".png"
+            rename_file(temp_file, output_file)
+
+        self.vector_cache.release(x, VectorCache.RESIDUAL)
 
-            # With this change the wrappers must be modified to not try deleting the non existing residual file
-            if self.con.debug is True:
-                self.debug_image(block_size=self.con.service_request.block_size, frame_base=f1,
-                                 list_predictive=prediction_data, list_residuals=residual_data,
-                                 output_location=debug_output_file)
+    # How far (in pixels) the bleeded frame residual blocks are taken from extends past the frame.
+    BLEED_BUFFER = 5
 
     @staticmethod
-    def make_residual_image(context: Dandere2xServiceContext, raw_frame: Frame, list_residual: list,
-                            list_predictive: list):
+    def make_residual_image(context: Dandere2xServiceContext, raw_frame: Frame, residual_vectors: np.ndarray,
+                            predictive_vectors: np.ndarray, bleed_frame: Frame = None):
         """
         This section can best be explained through pictures. A visual way of expressing what 'make_residual_image'
         is doing is this section in the wiki.
@@ -106,20 +169,22 @@ class Residual(threading.Thread):
 
         Output:
             - frame(x)_residual
+
+        bleed_frame is raw_frame.create_bleeded_image(Residual.BLEED_BUFFER), if the caller already made it.
         """
 
         # Some conditions to check before making a residual image, in both cases, we don't need to do any actual
         # processing in the function call, if these conditions hold true.
-        if not list_residual and list_predictive:
+        if len(residual_vectors) == 0 and len(predictive_vectors) != 0:
             """
-            If there are no items in 'list_residuals' but have list_predictives then the two frames are identical,
+            If there are no residual vectors but there are predictive vectors then the two frames are identical,
             so no residual image needed.
             """
             residual_image = Frame()
             residual_image.create_new(1, 1)
             return residual_image
 
-        if not list_residual and not list_predictive:
+        if len(residual_vectors) == 0 and len(predictive_vectors) == 0:
             """ 
             If there are neither any predictive or inversions, then the frame is a brand new frame with no resemblence
             to previous frame. In this case, copy the entire frame over.
@@ -129,35 +194,47 @@ class Residual(threading.Thread):
             residual_image.copy_image(raw_frame)
             return residual_image
 
-        buffer = 5
+        buffer = Residual.BLEED_BUFFER
         block_size = context.service_request.block_size
         bleed = context.bleed
+        tile_size = block_size + bleed * 2
         """
         First make a 'bleeded' version of input_frame, as we need to create a buffer in the event the 'bleed'
         ends up going out of bounds. In other words, crop the image into an even larger image, so that if if we need
         to access out of bounds pixels, and place black pixels where it would be out of bounds. 
         """
-        bleed_frame = raw_frame.create_bleeded_image(buffer)
+        if bleed_frame is None:
+            bleed_frame = raw_frame.create_bleeded_image(buffer)
 
-        # size of output image is determined based off how many residuals there are
-        image_size = int(math.sqrt(len(list_residual) / 4) + 1) * (block_size + bleed * 2)
+        # size of output image is determined based off how many residuals there are, see atlas_layout.py
+        placement = get_frame_placement(context, len(residual_vectors))
+        tile_positions = placement.remap(residual_vectors[:, 2:4])
         residual_image = Frame()
-        residual_image.create_new(image_size, image_size)
-
-        for x in range(int(len(list_residual) / 4)):
-            # load every element in the list into a vector
-            vector = DisplacementVector(int(list_residual[x * 4 + 0]),
-                                        int(list_residual[x * 4 + 1]),
-                                        int(list_residual[x * 4 + 2]),
-                                        int(list_residual[x * 4 + 3]))
+        residual_image.create_new(placement.atlas_layout.columns * tile_size, placement.atlas_layout.rows * tile_size)
 
-            # apply that vector to the image by copying over their respective blocks.
-            residual_image.copy_block(bleed_frame, block_size + bleed * 2,
-                                      vector.x_1 + buffer - bleed, vector.y_1 + buffer + - bleed,
-                                      vector.x_2 * (block_size + bleed * 2), vector.y_2 * (block_size + bleed * 2))
+        """
+        Every (block_size + bleed * 2) tile is gathered at once from a strided view of the bleeded frame, then
+        written into the atlas through a tiled view of it, as opposed to a copy_block call per residual.
+        """
+        residual_image.copy_blocks(bleed_frame, tile_size,
+                                   residual_vectors[:, 0] + buffer - bleed, residual_vectors[:, 1] + buffer - bleed,
+                                   tile_positions[:, 0] * tile_size, tile_positions[:, 1] * tile_size)
 
         return residual_image
 
+    @staticmethod
+    def get_residual_tiles(context: Dandere2xServiceContext, bleed_frame: Frame, residual_vectors: np.ndarray):
+        """
+        The (block_size + bleed * 2) tile every residual vector puts into the residual image, as an array of shape
+        (n, tile_size, tile_size, 3) viewing bleed_frame (made with Residual.BLEED_BUFFER).
+        """
+        bleed = context.bleed
+        tile_size = context.service_request.block_size + bleed * 2
+
+        return gather_blocks(bleed_frame.frame,
+                             residual_vectors[:, 0] + Residual.BLEED_BUFFER - bleed,
+                             residual_vectors[:, 1] + Residual.BLEED_BUFFER - bleed, tile_size)
+
     @staticmethod
     def debug_image(block_size, frame_base, list_predictive, list_residuals, output_location):
         """
@@ -219,3 +296,88 @@ class Residual(threading.Thread):
                                  vector.x_1, vector.y_1)
 
         out_image.save_image(output_location)
+
+
+def make_residual_file(context: Dandere2xServiceContext, x: int, residual_vectors: np.ndarray,
+                       predictive_vectors: np.ndarray, is_scene_cut: bool, block_cache: BlockCache = None,
+                       batched: bool = False):
+    """
+    Makes frame x's residual image and saves it into a temporary file (which Residual renames into residual_images
+    once every frame before it has been), returning the temporary file's path.
+
+    If batched, a frame with residual blocks isn't saved, it's tiles are returned (as ResidualTiles) to be packed into
+    a residual image with other frames' tiles by Residual's batcher. Whole frames (scene cuts, or frames with nothing
+    in common with the previous frame) are still saved.
+
+    If frame(x+1) is identical to frame(x), there's nothing to upscale, so a 'fake' upscaled image is saved directly
+    and None is returned. This runs on Residual's workers, which may be separate processes.
+
+    With a block cache, blocks that have already been upscaled are left out of the residual image (merge fills them
+    in from the cache), and so are repeats of a block within the frame.
+    """
+    f1 = Frame()
+    frame_store = get_frame_store(context.input_frames_dir)
+    if frame_store is not None:
+        f1.load_from_array(frame_store.get(x + 1))
+    else:
+        f1.load_from_string_controller(context.input_frames_dir + "frame" + str(x + 1) + ".png")
+
+    # Save to a temp folder so waifu2x-vulkan doesn't try reading it, then move it
+    temp_file = context.temp_image_folder + "residual_" + str(x) + os.path.splitext(context.temp_image)[1]
+
+    if is_scene_cut:
+        f1.save_image(temp_file)
+        return temp_file
+
+    # The vectors of the tiles that go into the residual image.
+    tile_vectors = residual_vectors
+    bleed_frame = None
+
+    if block_cache is not None:
+        bleed_frame = f1.create_bleeded_image(Residual.BLEED_BUFFER)
+        plan = block_cache.plan(x, residual_vectors, Residual.get_residual_tiles(context, bleed_frame,
+                                                                                residual_vectors))
+        tile_vectors = plan.tile_vectors
+
+    if batched and len(tile_vectors) != 0 and len(predictive_vectors) != 0:
+        # Residual packs these into a residual image shared with the frames around it, see ResidualBatcher.
+        if bleed_frame is None:
+            bleed_frame = f1.create_bleeded_image(Residual.BLEED_BUFFER)
+
+        result = ResidualTiles(tiles=Residual.get_residual_tiles(context, bleed_frame, tile_vectors),
+                               tile_positions=tile_vectors[:, 2:4])
+
+    else:
+        out_image = Residual.make_residual_image(context, f1, tile_vectors, predictive_vectors,
+                                                 bleed_frame=bleed_frame)
+        result = temp_file
+
+        if out_image.get_res() == (1, 1):
+            """
+            If out_image is (1,1) in size, then frame_x and frame_x+1 are identical.
+
+            We still need to save an outimage for sake of having N output images for N input images, so we
+            save these meaningless files anyways.
+
+            However, these 1x1 can slow whatever waifu2x implementation down, so we 'cheat' d2x 
+            but 'fake' upscaling them, so that they don't need to be processed by waifu2x.
+            """
+
+            # Location of the 'fake' upscaled image.
+            out_image = Frame()
+            out_image.create_new(2, 2)
+            out_image.save_image(context.residual_upscaled_dir + "output_" + get_lexicon_value(6, x) + ".png")
+            result = None
+
+        else:
+            # This image has things to upscale, continue normally
+            out_image.save_image(temp_file)
+
+    # With this change the wrappers must be modified to not try deleting the non existing residual file
+    if context.debug is True:
+        Residual.debug_image(block_size=context.service_request.block_size, frame_base=f1,
+                             list_predictive=predictive_vectors.ravel().tolist(),
+                             list_residuals=residual_vectors.ravel().tolist(),
+                             output_location=context.debug_dir + "debug" + str(x + 1) + ".png")
+
+    return result
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    This file is part of the Dandere2x project.
+    Dandere2x is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+    Dandere2x is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+    You should have received a copy of the GNU General Public License
+    along with Dandere2x.  If not, see <https://www.gnu.org/licenses/>.
+""""""
+========= Copyright aka_katto 2018, All rights reserved. ============
+Original Author: aka_katto
+Purpose: On low motion content most residual images are a handful of
+         blocks, and the upscaler spends more time per image (loading,
+         tiling, uploading, saving) than actually upscaling them.
+
+         The residual batcher packs the residual tiles of several
+         consecutive frames into a single residual image, which is
+         saved as the first of those frame's residual image. The other
+         frames get a 'fake' upscaled image (like identical frames do),
+         and merge takes their tiles from the first frame's upscaled
+         image instead.
+====================================================================="""
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass
+
+import numpy as np
+
+from dandere2x.dandere2x_service.core.atlas_layout import AtlasLayout, AtlasPlacement, get_atlas_layout
+from dandere2x.dandere2x_service.dandere2x_service_context import Dandere2xServiceContext
+from dandere2x.dandere2xlib.utils.dandere2x_utils import get_lexicon_value, rename_file
+from dandere2x.dandere2xlib.wrappers.frame.frame import Frame, scatter_blocks
+
+
+@dataclass
+class ResidualTiles:
+    """
+    A frame's residual tiles, before they're put into a residual image.
+
+        tiles: The (block_size + bleed * 2) tiles, of shape (n, tile_size, tile_size, 3).
+        tile_positions: The (x, y) (in tiles) of every tile in the frame's square layout, the last two columns of
+                        the residual vectors that were used to make the tiles.
+    """
+    tiles: np.ndarray
+    tile_positions: np.ndarray
+
+
+@dataclass
+class BatchSlot:
+    """ Where a frame's tiles ended up in a batch, so merge can find them in the batch's upscaled image. """
+    carrier: int  # the frame whose residual image holds the batch
+    placement: AtlasPlacement
+
+
+class ResidualBatcher:
+    """
+    Packs consecutive frames' residual tiles into shared residual images. A batch is closed (and saved) once adding
+    the next frame would take it over max_pixels, once it holds max_frames frames, or once it has been open for
+    max_wait seconds, so the upscaler isn't kept waiting on a slow trickle of frames.
+
+    Every frame residual.py publishes has to go through the batcher, in order, even the ones it can't batch (scene
+    cuts and entirely new frames, which are upscaled whole), so merge knows where every frame's tiles are.
+
+    usage:
+    batcher.add(x, residual_tiles)  # residual.py
+    batcher.skip(x + 1, flush=True)  # frame x + 1 has a residual image of it's own
+
+    slot = batcher.take_slot(x)  # merge.py, None if frame x wasn't batched
+    """
+
+    def __init__(self, context: Dandere2xServiceContext, max_pixels: int, max_frames: int, max_wait: float):
+        self.context = context
+        self.log = logging.getLogger(name=context.service_request.input_file)
+
+        self.tile_size = context.service_request.block_size + context.bleed * 2
+        self.max_pixels = max_pixels
+        self.max_wait = max_wait
+
+        """
+        Merge can't start on a batch until the batch is closed, and extraction won't get more than max_frames_ahead
+        frames ahead of merge, so a batch has to leave room for residual's in flight frames (and the frame after, which
+        block matching needs) or it'd never fill.
+        """
+        room = context.max_frames_ahead - max(1, context.residual_workers) * 2 - 2
+        self.max_frames = max(1, min(max_frames, room))
+
+        self._frames = []  # (frame, ResidualTiles) in the open batch
+        self._tile_count = 0
+        self._opened = None  # time.monotonic() the open batch got it's first frame
+
+        self._condition = threading.Condition()
+        self._slots = {}  # frame -> BatchSlot or None, until merge takes it
+
+        self.batches = 0
+        self.batched_frames = 0
+
+    def add(self, frame: int, residual_tiles: ResidualTiles) -> None:
+        """ Add frame's tiles to the open batch, first closing the open batch if frame wouldn't fit in it. """
+        if self._frames and self._batch_pixels(self._tile_count + len(residual_tiles.tiles)) > self.max_pixels:
+            self.flush()
+
+        if not self._frames:
+            self._opened = time.monotonic()
+
+        self._frames.append((frame, residual_tiles))
+        self._tile_count += len(residual_tiles.tiles)
+
+        if len(self._frames) >= self.max_frames:
+            self.flush()
+
+    def skip(self, frame: int, flush: bool) -> None:
+        """
+        Record that frame isn't batched. If frame has a residual image of it's own, flush has to be True, so that
+        the open batch is saved before it (the upscalers expect residual images in order).
+        """
+        if flush:
+            self.flush()
+
+        self._set_slots({frame: None})
+
+    def time_left(self):
+        """ Seconds until the open batch has to be closed, or None if there's no open batch. """
+        if not self._frames:
+            return None
+
+        return max(0.0, self._opened + self.max_wait - time.monotonic())
+
+    def flush(self) -> None:
+        """ Close the open batch, saving it as the residual image of it's first frame. """
+        if not self._frames:
+            return
+
+        carrier = self._frames[0][0]
+        batch_layout = get_atlas_layout(self.context, self._tile_count)
+        batch_image = Frame()
+        batch_image.create_new(batch_layout.columns * self.tile_size, batch_layout.rows * self.tile_size)
+
+        slots = {}
+        start = 0
+        for frame, residual_tiles in self._frames:
+            slot = BatchSlot(carrier=carrier,
+                             placement=AtlasPlacement(start=start,
+                                                      frame_layout=AtlasLayout.square(len(residual_tiles.tiles)),
+                                                      atlas_layout=batch_layout))
+            positions = slot.placement.remap(residual_tiles.tile_positions)
+            scatter_blocks(batch_image.frame, positions[:, 0] * self.tile_size, positions[:, 1] * self.tile_size,
+                           self.tile_size, residual_tiles.tiles)
+
+            slots[frame] = slot
+            start += len(residual_tiles.tiles)
+
+        # Merge needs to know where the tiles are before any of the batch's images can exist.
+        self._set_slots(slots)
+
+        temp_file = self.context.temp_image_folder + "residual_batch_" + str(carrier) + \
+            os.path.splitext(self.context.temp_image)[1]
+        batch_image.save_image(temp_file)
+        rename_file(temp_file, self.context.residual_images_dir + "output_" + get_lexicon_value(6, carrier) + ".png")
+
+        # Like identical frames, the rest of the batch's frames get 'fake' upscaled images.
+        for frame, _ in self._frames[1:]:
+            fake_image = Frame()
+            fake_image.create_new(2, 2)
+            fake_image.save_image(self.context.residual_upscaled_dir + "output_" + get_lexicon_value(6, frame) + ".png")
+
+        self.batches += 1
+        self.batched_frames += len(self._frames)
+        self._frames = []
+        self._tile_count = 0
+        self._opened = None
+
+    def take_slot(self, frame: int):
+        """ Blocks until residual.py has published frame, and returns (and forgets) where it's tiles are. """
+        with self._condition:
+            self._condition.wait_for(lambda: frame in self._slots)
+            return self._slots.pop(frame)
+
+    def log_stats(self) -> None:
+        self.log.info("Residual batcher: %d frames batched into %d residual images."
+                      % (self.batched_frames, self.batches))
+
+    def _set_slots(self, slots: dict) -> None:
+        with self._condition:
+            self._slots.update(slots)
+            self._condition.notify_all()
+
+    def _batch_pixels(self, tile_count: int) -> int:
+        layout = get_atlas_layout(self.context, tile_count)
+        return layout.columns * layout.rows * self.tile_size ** 2
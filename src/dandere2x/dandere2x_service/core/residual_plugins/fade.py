@@ -1,5 +1,7 @@
 from dataclasses import dataclass
 
+import numpy as np
+
 # A simple struct to hold the data to produce a fade.
 from dandere2x.dandere2xlib.wrappers.frame.frame import Frame
 
@@ -11,7 +13,7 @@ class FadeData:
     scalar: int
 
 
-def fade_image(context, frame_base: Frame, list_correction: list):
+def fade_image(context, frame_base: Frame, fade_vectors: np.ndarray):
     """
     Apply a flat scalar to the respective blocks in the image. See "fade.cpp" in dandere2x_cpp for more in depth
     documentation. Roughly
@@ -21,7 +23,7 @@ def fade_image(context, frame_base: Frame, list_correction: list):
     Although frame_residuals needs to also be transformed
 
     Method Tasks:
-        - Load all the vectors and their scalars into a list
+        - Load all the vectors and their scalars into an array
         - Apply the scalar to all the vectors in the image
     """
 
@@ -29,19 +31,11 @@ def fade_image(context, frame_base: Frame, list_correction: list):
     scale_factor = int(context.service_request.scale_factor)
     block_size = int(context.service_request.block_size)
 
-    fade_data_size = 3
-
-    for x in range(int(len(list_correction) / fade_data_size)):
-        # load vector
-        vector = FadeData(int(list_correction[x * fade_data_size + 0]),
-                          int(list_correction[x * fade_data_size + 1]),
-                          int(list_correction[x * fade_data_size + 2]))
-        # apply vector
-        frame_base.fade_block(vector.x * scale_factor,
-                              vector.y * scale_factor,
-                              block_size * scale_factor,
-                              vector.scalar)
+    # Every vector is of the form (x, y, scalar), and all of them are applied in a single batched call.
 
-    # out_image.frame = np.clip(out_image.frame, 0, 255)
+    frame_base.fade_blocks(fade_vectors[:, 0] * scale_factor,
+                           fade_vectors[:, 1] * scale_factor,
+                           block_size * scale_factor,
+                           fade_vectors[:, 2])
 
     return frame_base
@@ -1,25 +1,30 @@
+import numpy as np
+
 from dandere2x.dandere2x_service.dandere2x_service_context import Dandere2xServiceContext
 
 # This is the inversion (sort of) function of what Dandere2x_cpp's pframe does (which is more commented).
 # Dandere2x_CPP tells us how to take apart an image using vectors, this tells us how to put the upscaled version
 # back together.
-from dandere2x.dandere2xlib.wrappers.frame.frame import Frame, DisplacementVector
+from dandere2x.dandere2xlib.wrappers.frame.frame import Frame
 
 
 def pframe_image(context: Dandere2xServiceContext,
                  frame_next: Frame, frame_previous: Frame, frame_residual: Frame,
-                 list_residual: list, list_predictive: list):
+                 residual_vectors: np.ndarray, predictive_vectors: np.ndarray):
     """
     Create a new image using residuals and predictive vectors.
     Roughly, we can describe this method as
 
-        frame_next = Transfrom(frame_previous, list_predictive) + frame_residuals.
+        frame_next = Transfrom(frame_previous, predictive_vectors) + frame_residuals.
 
     Although frame_residuals needs to also be transformed.
 
+    Every vector is of the form (x_1, y_1, x_2, y_2), and all the vectors of an array are applied in a single
+    batched copy_blocks call rather than one copy_block call per vector.
+
     Method Tasks:
-        - Move blocks from frame_previous into frame_next using list_predictive
-        - Move blocks from frame_residual into frame_next using list_residuals
+        - Move blocks from frame_previous into frame_next using predictive_vectors
+        - Move blocks from frame_residual into frame_next using residual_vectors
     """
 
     # load context
@@ -27,42 +32,27 @@ def pframe_image(context: Dandere2xServiceContext,
     block_size = context.service_request.block_size
     bleed = context.bleed
 
-    for x in range(int(len(list_predictive) / 4)):
-        """
-        Neat optimization trick - there's no need for pframe to copy over a block if the vectors
-        point to the same place. In merge.py we just need to load the previous frame into the current frame
-        to reach this optimization.
-        """
-
-        if int(list_predictive[x * 4 + 0]) != int(list_predictive[x * 4 + 1]) \
-                or \
-                int(list_predictive[x * 4 + 2]) != int(list_predictive[x * 4 + 3]):
-            # load the vector
-            vector = DisplacementVector(int(list_predictive[x * 4 + 0]),
-                                        int(list_predictive[x * 4 + 1]),
-                                        int(list_predictive[x * 4 + 2]),
-                                        int(list_predictive[x * 4 + 3]))
-
-            # apply the vector
-            frame_next.copy_block(frame_previous, block_size * scale_factor,
-                                  vector.x_2 * scale_factor,
-                                  vector.y_2 * scale_factor,
-                                  vector.x_1 * scale_factor,
-                                  vector.y_1 * scale_factor)
-
-    for x in range(int(len(list_residual) / 4)):
-
-        # load every element in the list into a vector
-        vector = DisplacementVector(int(list_residual[x * 4 + 0]),
-                                    int(list_residual[x * 4 + 1]),
-                                    int(list_residual[x * 4 + 2]),
-                                    int(list_residual[x * 4 + 3]))
-
-        # apply that vector to the image
-        frame_next.copy_block(frame_residual, block_size * scale_factor,
-                              (vector.x_2 * (block_size + bleed * 2)) * scale_factor + (bleed * scale_factor),
-                              (vector.y_2 * (block_size + bleed * 2)) * scale_factor + (bleed * scale_factor),
-                              vector.x_1 * scale_factor,
-                              vector.y_1 * scale_factor)
+    """
+    Neat optimization trick - there's no need for pframe to copy over a block if the vectors
+    point to the same place. In merge.py we just need to load the previous frame into the current frame
+    to reach this optimization.
+    """
+    moving = (predictive_vectors[:, 0] != predictive_vectors[:, 2]) | \
+             (predictive_vectors[:, 1] != predictive_vectors[:, 3])
+    predictive_vectors = predictive_vectors[moving]
+
+    frame_next.copy_blocks(frame_previous, block_size * scale_factor,
+                           predictive_vectors[:, 2] * scale_factor,
+                           predictive_vectors[:, 3] * scale_factor,
+                           predictive_vectors[:, 0] * scale_factor,
+                           predictive_vectors[:, 1] * scale_factor)
+
+    # residual blocks are laid out in frame_residual on a grid of (block_size + bleed * 2) sized cells.
+    residual_pitch = (block_size + bleed * 2) * scale_factor
+    frame_next.copy_blocks(frame_residual, block_size * scale_factor,
+                           residual_vectors[:, 2] * residual_pitch + (bleed * scale_factor),
+                           residual_vectors[:, 3] * residual_pitch + (bleed * scale_factor),
+                           residual_vectors[:, 0] * scale_factor,
+                           residual_vectors[:, 1] * scale_factor)
 
     return frame_next
@@ -50,8 +50,8 @@ class Status(threading.Thread):
 
             now = time.time()
 
-            while x >= self.controller.get_current_frame():
-                time.sleep(.00001)
+            if not self.controller.wait_for_frame(x + 1):
+                return
 
             later = time.time()
             difference = float(later - now)
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    This file is part of the Dandere2x project.
+    Dandere2x is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+    Dandere2x is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+    You should have received a copy of the GNU General Public License
+    along with Dandere2x.  If not, see <https://www.gnu.org/licenses/>.
+""""""
+========= Copyright aka_katto 2018, All rights reserved. ============
+Original Author: aka_katto 
+Purpose: Both residual.py and merge.py need the same pframe / residual 
+         vectors for every frame. Rather than each of them waiting on 
+         and parsing the same files, the vector cache reads every 
+         frame's vectors once (a few frames ahead of whoever is 
+         furthest along), and hands the same arrays to both. 
+         
+         With the "stream" vector format there are no files, and the 
+         block matcher puts each frame's vectors in directly instead.
+====================================================================="""
+import logging
+import threading
+from dataclasses import dataclass
+
+import numpy as np
+
+from dandere2x.dandere2x_service.dandere2x_service_context import Dandere2xServiceContext
+from dandere2x.dandere2xlib.utils.vector_file import STREAM_VECTOR_FORMAT, get_vector_reader
+
+
+@dataclass
+class FrameVectors:
+    """ The vectors dandere2x_cpp produced for a single frame. Treat these as read-only, as they're shared. """
+    predictive_vectors: np.ndarray
+    residual_vectors: np.ndarray
+    fade_vectors: np.ndarray
+
+
+class VectorCache(threading.Thread):
+    """
+    Reads each frame's vectors once, and keeps them until every consumer has released them.
+
+    usage:
+    vectors = vector_cache.get(x)
+    ... use vectors.predictive_vectors, vectors.residual_vectors ...
+    vector_cache.release(x, VectorCache.RESIDUAL)
+    """
+
+    RESIDUAL = "residual"
+    MERGE = "merge"
+    CONSUMERS = frozenset([RESIDUAL, MERGE])
+
+    def __init__(self, context: Dandere2xServiceContext):
+        # Threading Specific
+        threading.Thread.__init__(self, name="VectorCache", daemon=True)
+
+        self.context = context
+        self.log = logging.getLogger(name=context.service_request.input_file)
+        self.streamed = context.dandere2x_cpp_vector_format == STREAM_VECTOR_FORMAT
+        self.vector_reader = None if self.streamed else get_vector_reader(context.dandere2x_cpp_vector_format)
+        self.lookahead = context.vector_cache_lookahead
+
+        self._condition = threading.Condition()
+        self._entries = {}  # frame -> FrameVectors
+        self._released = {}  # frame -> set of consumers that are done with it
+        self._highest_requested = 1
+
+    def run(self):
+        self.log.info("Run called.")
+
+        if self.streamed:
+            self.log.info("Vectors are streamed, nothing to read.")
+            return
+
+        for x in range(1, self.context.frame_count):
+            # Only read so far ahead of the furthest along consumer.
+            with self._condition:
+                self._condition.wait_for(lambda: x <= self._highest_requested + self.lookahead)
+
+            self._store(x, self._read_frame_vectors(x))
+
+        self.log.info("All vectors read.")
+
+    def put(self, frame: int, frame_vectors: FrameVectors) -> None:
+        """ Hand over a frame's vectors directly, for block matchers streaming them rather than writing files. """
+        for vectors in (frame_vectors.predictive_vectors, frame_vectors.residual_vectors, frame_vectors.fade_vectors):
+            vectors.flags.writeable = False
+
+        self._store(frame, frame_vectors)
+
+    def _store(self, frame: int, frame_vectors: FrameVectors) -> None:
+        with self._condition:
+            if self._released.get(frame, set()) >= self.CONSUMERS:
+                # Every consumer was done with this frame before it was read (i.e a scene cut).
+                del self._released[frame]
+            else:
+                self._entries[frame] = frame_vectors
+            self._condition.notify_all()
+
+    def get(self, frame: int, timeout: float = None):
+        """
+        Block until the vectors for 'frame' have been read, then return them. Returns None if timeout (in seconds)
+        elapsed first.
+        """
+        with self._condition:
+            if frame > self._highest_requested:
+                self._highest_requested = frame
+                self._condition.notify_all()
+
+            if not self._condition.wait_for(lambda: frame in self._entries, timeout):
+                return None
+
+            return self._entries[frame]
+
+    def release(self, frame: int, consumer: str) -> None:
+        """
+        Mark 'consumer' as done with 'frame', evicting it once every consumer is done with it. Consumers may release
+        frames they never called get on.
+        """
+        with self._condition:
+            released = self._released.setdefault(frame, set())
+            released.add(consumer)
+
+            if frame > self._highest_requested:
+                self._highest_requested = frame
+                self._condition.notify_all()
+
+            if released >= self.CONSUMERS and frame in self._entries:
+                del self._entries[frame]
+                del self._released[frame]
+
+    def _read_frame_vectors(self, frame: int) -> FrameVectors:
+        reader = self.vector_reader
+
+        predictive_vectors = reader.read(reader.file_name(self.context.pframe_data_dir + "pframe_", frame), 4)
+        residual_vectors = reader.read(reader.file_name(self.context.residual_data_dir + "residual_", frame), 4)
+        fade_vectors = reader.read(reader.file_name(self.context.fade_data_dir + "fade_", frame), 3)
+
+        # The arrays are shared between threads, so make accidental in-place edits fail loudly.
+        for vectors in (predictive_vectors, residual_vectors, fade_vectors):
+            vectors.flags.writeable = False
+
+        return FrameVectors(predictive_vectors, residual_vectors, fade_vectors)
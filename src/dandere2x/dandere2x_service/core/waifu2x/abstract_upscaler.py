@@ -19,7 +19,6 @@ Purpose:
 import logging
 import os
 import sys
-import time
 from abc import ABC, abstractmethod
 from threading import Thread
 
@@ -100,13 +99,12 @@ class AbstractUpscaler(Thread, ABC):
 
     def join(self, timeout=None) -> None:
         self.log.info("Join called.")
-        while not self.check_if_done():
-            time.sleep(0.05)
+        self.controller.wait_for_frame(self.context.frame_count - 1)
 
         self.log.info("Join finished.")
 
     def check_if_done(self) -> bool:
-        if self.controller.get_current_frame() >= self.context.frame_count - 1:
+        if self.controller.get_current_frame() >= self.context.frame_count - 1 or not self.controller.is_alive():
             return True
 
         return False
@@ -38,6 +38,7 @@ class Dandere2xServiceContext:
         self.encoded_dir = os.path.join(service_request.workspace, "encoded") + os.path.sep
         self.temp_image_folder = os.path.join(service_request.workspace, "temp_image_folder") + os.path.sep
         self.log_dir = os.path.join(service_request.workspace, "log_dir") + os.path.sep
+        self.scene_cuts_dir = os.path.join(service_request.workspace, "scene_cuts") + os.path.sep
 
         self.directories = {self.input_frames_dir,
                             self.noised_input_frames_dir,
@@ -52,7 +53,8 @@ class Dandere2xServiceContext:
                             self.fade_data_dir,
                             self.encoded_dir,
                             self.temp_image_folder,
-                            self.log_dir}
+                            self.log_dir,
+                            self.scene_cuts_dir}
 
         ffprobe_path = load_executable_paths_yaml()['ffprobe']
         ffmpeg_path = load_executable_paths_yaml()['ffmpeg']
@@ -68,10 +70,40 @@ class Dandere2xServiceContext:
         self.debug = False
         self.step_size = 4
         self.max_frames_ahead = self.service_request.output_options["dandere2x"]["max_frames_ahead"]
+        self.workspace_storage = self.service_request.output_options["dandere2x"]["workspace_storage"]
+        self.vector_cache_lookahead = self.service_request.output_options["dandere2x"]["vector_cache_lookahead"]
+        self.upscaled_prefetch_lookahead = self.service_request.output_options["dandere2x"]["upscaled_prefetch_lookahead"]
+        self.upscaled_prefetch_workers = self.service_request.output_options["dandere2x"]["upscaled_prefetch_workers"]
+        self.residual_workers = self.service_request.output_options["dandere2x"]["residual_workers"]
+        self.residual_worker_type = self.service_request.output_options["dandere2x"]["residual_worker_type"]
+        self.residual_atlas_layout = self.service_request.output_options["dandere2x"]["residual_atlas_layout"]
+        self.merge_stripes = self.service_request.output_options["dandere2x"]["merge_stripes"]
+        self.noise_strength = self.service_request.output_options["dandere2x"]["noise"]["strength"]
+        self.noise_seed = self.service_request.output_options["dandere2x"]["noise"]["seed"]
+        self.noise_workers = self.service_request.output_options["dandere2x"]["noise"]["workers"]
+        self.residual_batching_enabled = self.service_request.output_options["dandere2x"]["residual_batching"]["enabled"]
+        self.residual_batching_max_pixels = \
+            self.service_request.output_options["dandere2x"]["residual_batching"]["max_pixels"]
+        self.residual_batching_max_frames = \
+            self.service_request.output_options["dandere2x"]["residual_batching"]["max_frames"]
+        self.residual_batching_max_wait = \
+            self.service_request.output_options["dandere2x"]["residual_batching"]["max_wait_seconds"]
+        self.block_cache_enabled = self.service_request.output_options["dandere2x"]["block_cache"]["enabled"]
+        self.block_cache_memory_megabytes = \
+            self.service_request.output_options["dandere2x"]["block_cache"]["memory_megabytes"]
+        self.block_cache_disk_megabytes = \
+            self.service_request.output_options["dandere2x"]["block_cache"]["disk_megabytes"]
+        self.block_cache_dir = self.service_request.output_options["dandere2x"]["block_cache"]["disk_dir"] or \
+            os.path.join(service_request.workspace, "block_cache")
 
         # Dandere2xCPP
         self.dandere2x_cpp_block_matching_arg = self.service_request.output_options["dandere2x_cpp"]["block_matching_arg"]
         self.dandere2x_cpp_evaluator_arg = self.service_request.output_options["dandere2x_cpp"]["evaluator_arg"]
+        self.dandere2x_cpp_vector_format = self.service_request.output_options["dandere2x_cpp"]["vector_format"]
+
+        # Dandere2xPy (used instead of Dandere2xCPP for the "python_*" block matching args)
+        self.dandere2x_py_search_radius = self.service_request.output_options["dandere2x_py"]["search_radius"]
+        self.dandere2x_py_workers = self.service_request.output_options["dandere2x_py"]["workers"]
 
 
     def log_all_variables(self):
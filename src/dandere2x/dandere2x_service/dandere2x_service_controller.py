@@ -1,14 +1,51 @@
+import threading
+
+
 class Dandere2xController:
     """
-    A simple thread-safe (not really) way of communicating to different parts of dandere2x what frame / the health
-    status of the current dandere2x instance.
+    A thread-safe way of communicating to different parts of dandere2x what frame / the health status of the
+    current dandere2x instance is.
+
+    Threads that depend on merge's progress should block on wait_for_frame rather than polling get_current_frame.
+    Killing the controller (or reporting an error) wakes every waiting thread.
     """
 
     def __init__(self):
         self._current_frame = 1
+        self._is_alive = True
+        self._error = None
+        self._condition = threading.Condition()
 
     def update_frame_count(self, set_frame: int):
-        self._current_frame = set_frame
+        with self._condition:
+            self._current_frame = set_frame
+            self._condition.notify_all()
 
     def get_current_frame(self):
         return self._current_frame
+
+    def wait_for_frame(self, frame: int, timeout: float = None) -> bool:
+        """
+        Block until the current frame is at least 'frame', the controller is killed, or timeout (in seconds) elapses.
+        Returns whether the current frame reached 'frame'.
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self._current_frame >= frame or not self._is_alive, timeout)
+            return self._current_frame >= frame
+
+    def kill(self):
+        with self._condition:
+            self._is_alive = False
+            self._condition.notify_all()
+
+    def report_error(self, error: Exception):
+        """ Mark the session as failed and wake every waiting thread. """
+        with self._condition:
+            self._error = error
+        self.kill()
+
+    def is_alive(self) -> bool:
+        return self._is_alive
+
+    def get_error(self):
+        return self._error
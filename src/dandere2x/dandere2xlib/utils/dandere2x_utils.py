@@ -8,6 +8,7 @@ Last Modified: April 2, 2019
 """
 
 import logging
+import multiprocessing
 import os
 import shutil
 import sys
@@ -15,9 +16,12 @@ import time
 from sys import platform
 from typing import Tuple
 
+import numpy as np
 from pip._vendor.distlib.compat import raw_input
 from wget import bar_adaptive
 
+from dandere2x.dandere2xlib.utils.file_readiness import get_file_readiness_service
+
 
 def get_operating_system():
     if platform == "linux" or platform == "linux2" or platform == "darwin":  # macos is pretty indistinguishable
@@ -26,6 +30,18 @@ def get_operating_system():
         return 'win32'
 
 
+def get_process_pool_context():
+    """
+    The multiprocessing context dandere2x's process pools are made with. By the time a pool's workers start, the
+    session's other threads are running, and a forked worker can inherit a lock one of them holds (logging, a queue,
+    PIL's) and deadlock, so workers are started by a forkserver (or spawned, where there isn't one) instead.
+    """
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("forkserver")
+
+    return multiprocessing.get_context("spawn")
+
+
 def show_exception_and_exit(exc_type, exc_value, tb):
     """
     To keep Dandere2x window open on death.
@@ -54,15 +70,7 @@ def force_delete_directory(directory):
 
 
 def get_list_from_file_and_wait(text_file: str):
-    logger = logging.getLogger(__name__)
-    exists = exists = os.path.isfile(text_file)
-    count = 0
-    while not exists:
-        if count / 500 == 0:
-            logger.debug(text_file + " does not exist, waiting")
-        exists = os.path.isfile(text_file)
-        count += 1
-        time.sleep(.01)
+    wait_on_file(text_file)
 
     file = None
     try:
@@ -85,32 +93,26 @@ def get_list_from_file_and_wait(text_file: str):
     return text_list
 
 
+def get_array_from_list(text_list: list, vector_size: int) -> np.ndarray:
+    """
+    Converts a list of vector components (as returned by get_list_from_file_and_wait) into an integer array
+    of shape (n, vector_size). Trailing entries that don't form a whole vector (i.e the empty string following
+    the last newline of the file) are dropped.
+    """
+    vector_count = len(text_list) // vector_size
+    if vector_count == 0:
+        return np.zeros((0, vector_size), dtype=np.int64)
+
+    return np.asarray(text_list[:vector_count * vector_size], dtype=np.int64).reshape(vector_count, vector_size)
+
+
 def wait_on_file(file_string: str):
-    logger = logging.getLogger(__name__)
-    exists = os.path.isfile(file_string)
-    count = 0
-    while not exists:
-        if count / 500 == 0:
-            logger.debug(file_string + " does not exist, waiting")
-        exists = os.path.isfile(file_string)
-        count += 1
-        time.sleep(.001)
+    get_file_readiness_service().wait_for_file(file_string)
 
 
 # for renaming function, break when either file exists
 def wait_on_either_file(file_1: str, file_2: str):
-    logger = logging.getLogger(__name__)
-    exists_1 = os.path.isfile(file_1)
-    exists_2 = os.path.isfile(file_2)
-    count = 0
-    while not (exists_1 or exists_2):
-        if count / 500 == 0:
-            logger.debug(file_1 + " does not exist, waiting")
-        exists_1 = os.path.isfile(file_1)
-        exists_2 = os.path.isfile(file_2)
-
-        count += 1
-        time.sleep(.001)
+    get_file_readiness_service().wait_for_any([file_1, file_2])
 
 
 # many times a file may not exist yet, so just have this function wait if it does not.
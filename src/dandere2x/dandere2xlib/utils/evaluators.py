@@ -0,0 +1,159 @@
+"""
+Block similarity metrics, computed in bulk with numpy. These mirror dandere2x_cpp's evaluators (MSE_Function and
+SSIM_Function) so blocks can be scored without the native binary, i.e by dandere2x_py or by offline analysis.
+
+Functions ending in "_blocks" take two (n, block_size, block_size, channels) arrays of blocks (see gather_blocks in
+frame.py) and return one score per block. Functions starting with "frame_" score an entire frame pair at once, by
+viewing both frames as a grid of blocks.
+
+usage:
+evaluator = get_evaluator("ssim")
+accepted = evaluator.evaluate(current_blocks, next_blocks, next_compressed_blocks)
+
+mse_map = frame_block_mse(frame_a, frame_b, block_size=20)  # shape (height // 20, width // 20)
+"""
+
+import logging
+import math
+from abc import ABC, abstractmethod
+
+import numpy as np
+
+# Stabilizing constants, the same as dandere2x_cpp's SSIM_Function.
+_SSIM_C1 = (0.01 * 255) ** 2
+_SSIM_C2 = (0.03 * 255) ** 2
+_INVERSE_MSE_D1 = (0.01 * (255 * 255)) ** 2
+_INVERSE_MSE_D2 = (0.03 * (255 * 255)) ** 2
+
+
+def mse_blocks(blocks_a: np.ndarray, blocks_b: np.ndarray) -> np.ndarray:
+    """ Per block mse, computed like dandere2x_cpp (squared differences summed over channels / block area). """
+    difference = blocks_a.astype(np.int32) - blocks_b
+    return np.einsum("nijc,nijc->n", difference, difference, dtype=np.int64) / (blocks_a.shape[1] * blocks_a.shape[2])
+
+
+def ssim_blocks(blocks_a: np.ndarray, blocks_b: np.ndarray) -> np.ndarray:
+    """ Per block SSIM (each block being a single window), averaged across channels. """
+    mean_a, mean_b, variance_a, variance_b, covariance = _block_moments(blocks_a, blocks_b)
+
+    ssim = ((2 * mean_a * mean_b + _SSIM_C1) * (2 * covariance + _SSIM_C2)) / \
+           ((mean_a ** 2 + mean_b ** 2 + _SSIM_C1) * (variance_a + variance_b + _SSIM_C2))
+
+    return ssim.mean(axis=1)
+
+
+def ssim_mse_blocks(blocks_a: np.ndarray, blocks_b: np.ndarray) -> np.ndarray:
+    """
+    dandere2x_cpp's SSIM-MSE - per channel SSIM weighted by an inverse of that channel's summed squared error,
+    averaged across channels. Higher is more similar.
+    """
+    mean_a, mean_b, variance_a, variance_b, covariance = _block_moments(blocks_a, blocks_b)
+
+    ssim = ((2 * mean_a * mean_b + _SSIM_C1) * (2 * covariance + _SSIM_C2)) / \
+           ((mean_a ** 2 + mean_b ** 2 + _SSIM_C1) * (variance_a + variance_b + _SSIM_C2))
+
+    difference = blocks_a.astype(np.int32) - blocks_b
+    squared_error = np.einsum("nijc,nijc->nc", difference, difference, dtype=np.int64)
+    inverse_mse = (1 + _INVERSE_MSE_D1) / (squared_error + _INVERSE_MSE_D2)
+
+    return (ssim * inverse_mse).mean(axis=1)
+
+
+def frame_block_mse(frame_a: np.ndarray, frame_b: np.ndarray, block_size: int) -> np.ndarray:
+    """ mse_blocks for every whole block of a frame pair, as a (rows, columns) map. """
+    rows, columns = frame_a.shape[0] // block_size, frame_a.shape[1] // block_size
+    return mse_blocks(_frame_blocks(frame_a, block_size), _frame_blocks(frame_b, block_size)).reshape(rows, columns)
+
+
+def frame_block_ssim(frame_a: np.ndarray, frame_b: np.ndarray, block_size: int) -> np.ndarray:
+    """ ssim_blocks for every whole block of a frame pair, as a (rows, columns) map. """
+    rows, columns = frame_a.shape[0] // block_size, frame_a.shape[1] // block_size
+    return ssim_blocks(_frame_blocks(frame_a, block_size), _frame_blocks(frame_b, block_size)).reshape(rows, columns)
+
+
+def frame_psnr(frame_a: np.ndarray, frame_b: np.ndarray) -> float:
+    """ PSNR of two frames, computed like AbstractEvaluator::psnr_two_frames. Identical frames return inf. """
+    difference = frame_a.astype(np.int32) - frame_b
+    mse = np.einsum("ijc,ijc->", difference, difference, dtype=np.int64) / (frame_a.shape[0] * frame_a.shape[1])
+
+    if mse == 0:
+        return math.inf
+
+    return 20 * math.log10(255) - 10 * math.log10(mse)
+
+
+class AbstractEvaluator(ABC):
+    """
+    Decides whether blocks of the current frame are good enough stand-ins for blocks of the next frame. The bar is
+    the next frame's own compressed version - a stand-in has to be at least as close as compression would get.
+    """
+
+    def evaluate(self, current_blocks: np.ndarray, next_blocks: np.ndarray,
+                 next_compressed_blocks: np.ndarray) -> np.ndarray:
+        """ Returns a boolean array, True where current_blocks[i] can replace next_blocks[i]. """
+        return self._is_as_good(self.score(next_blocks, current_blocks), self.score(next_blocks,
+                                                                                     next_compressed_blocks))
+
+    @abstractmethod
+    def score(self, blocks_a: np.ndarray, blocks_b: np.ndarray) -> np.ndarray:
+        pass
+
+    @abstractmethod
+    def _is_as_good(self, scores: np.ndarray, thresholds: np.ndarray) -> np.ndarray:
+        pass
+
+
+class MSEEvaluator(AbstractEvaluator):
+
+    def score(self, blocks_a: np.ndarray, blocks_b: np.ndarray) -> np.ndarray:
+        return mse_blocks(blocks_a, blocks_b)
+
+    def _is_as_good(self, scores: np.ndarray, thresholds: np.ndarray) -> np.ndarray:
+        return scores <= thresholds
+
+
+class SSIMEvaluator(AbstractEvaluator):
+
+    def score(self, blocks_a: np.ndarray, blocks_b: np.ndarray) -> np.ndarray:
+        return ssim_mse_blocks(blocks_a, blocks_b)
+
+    def _is_as_good(self, scores: np.ndarray, thresholds: np.ndarray) -> np.ndarray:
+        return scores >= thresholds
+
+
+def get_evaluator(evaluator_arg: str) -> AbstractEvaluator:
+    """ Maps dandere2x_cpp's evaluator_arg to it's python evaluator. """
+    if evaluator_arg == "mse":
+        return MSEEvaluator()
+
+    if evaluator_arg == "ssim":
+        return SSIMEvaluator()
+
+    log = logging.getLogger(__name__)
+    log.error("No valid evaluator selected: %s" % evaluator_arg)
+    raise ValueError("evaluator_arg must be 'mse' or 'ssim'")
+
+
+def _frame_blocks(frame: np.ndarray, block_size: int) -> np.ndarray:
+    """ Every whole block of frame as an (n, block_size, block_size, channels) array, row by row. """
+    rows, columns = frame.shape[0] // block_size, frame.shape[1] // block_size
+    cropped = frame[:rows * block_size, :columns * block_size]
+    tiled = cropped.reshape(rows, block_size, columns, block_size, -1)
+    return tiled.transpose(0, 2, 1, 3, 4).reshape(rows * columns, block_size, block_size, -1)
+
+
+def _block_moments(blocks_a: np.ndarray, blocks_b: np.ndarray):
+    """
+    Per block, per channel means, variances and covariance - i.e a box filter the size of a block, sampled once
+    per block. Each is returned as an (n, channels) array.
+    """
+    a = blocks_a.astype(np.float64)
+    b = blocks_b.astype(np.float64)
+
+    mean_a = a.mean(axis=(1, 2))
+    mean_b = b.mean(axis=(1, 2))
+    variance_a = (a * a).mean(axis=(1, 2)) - mean_a ** 2
+    variance_b = (b * b).mean(axis=(1, 2)) - mean_b ** 2
+    covariance = (a * b).mean(axis=(1, 2)) - mean_a * mean_b
+
+    return mean_a, mean_b, variance_a, variance_b, covariance
@@ -0,0 +1,240 @@
+"""
+A shared service for waiting on files to appear, as most of dandere2x's threads communicate by one thread writing a file
+(usually into a temporary location, then renaming it into place) and another waiting for it.
+
+On Linux, waiters block on inotify events for the directories they're waiting in, so they wake up as soon as the
+exact file is renamed (or written and closed) into place, rather than repeatedly stat'ing it. On every other platform
+(or if inotify is unavailable), a single thread polls the files currently being waited on.
+"""
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import struct
+import sys
+import threading
+import time
+
+# inotify(7) flags
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO = 0x00000080
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_CLOEXEC = 0o2000000
+
+_EVENT_HEADER = struct.Struct("iIII")
+
+
+class FileReadinessService:
+    """
+    Lets any amount of threads block until a file exists, without each of them polling the file system.
+
+    usage:
+    service = get_file_readiness_service()
+    service.wait_for_file("workspace/residual_data/residual_1.txt")
+    service.wait_for_any(["output_000001.png", "output_000001.png.png"])
+    """
+
+    def __init__(self, poll_interval: float = 0.005):
+        self.log = logging.getLogger(__name__)
+        self.poll_interval = poll_interval
+
+        self._lock = threading.Condition()
+        self._waiters = {}  # path -> set of threading.Event's waiting on it
+
+        self._inotify = _Inotify.create(self._on_file_event, self._on_overflow, self._on_directory_unwatched)
+        if self._inotify is None:
+            self.log.info("inotify unavailable, falling back to polling for file readiness.")
+            threading.Thread(target=self._poll, daemon=True, name="FileReadinessPoller").start()
+
+    def wait_for_file(self, file_path: str, timeout: float = None) -> bool:
+        """ Blocks until file_path exists, returns False if timeout (in seconds) elapsed first. """
+        return self.wait_for_any([file_path], timeout) is not None
+
+    def wait_for_any(self, file_paths: list, timeout: float = None):
+        """ Blocks until any of file_paths exists and returns it, returns None if timeout elapsed first. """
+        file_paths = [os.path.abspath(file_path) for file_path in file_paths]
+        deadline = None if timeout is None else time.time() + timeout
+        event = threading.Event()
+
+        # Registering (and watching) before checking if the file exists ensures there's no window where a file can
+        # appear unnoticed.
+        self._register(file_paths, event)
+        try:
+            while True:
+                watched = self._watch(file_paths)
+
+                for file_path in file_paths:
+                    if os.path.isfile(file_path):
+                        return file_path
+
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return None
+
+                # A directory that can't be watched (i.e it doesn't exist yet) won't wake us, so check back on it.
+                if not watched:
+                    remaining = self.poll_interval if remaining is None else min(remaining, self.poll_interval)
+
+                event.wait(remaining)
+                event.clear()
+        finally:
+            self._unregister(file_paths, event)
+
+    def _register(self, file_paths: list, event: threading.Event) -> None:
+        with self._lock:
+            for file_path in file_paths:
+                self._waiters.setdefault(file_path, set()).add(event)
+
+            self._lock.notify_all()
+
+    def _watch(self, file_paths: list) -> bool:
+        """ Makes sure file_paths' directories are being watched, returns False if any of them can't be. """
+        if self._inotify is None:
+            return True  # the poller is checking every file
+
+        watched = True
+        for directory in {os.path.dirname(file_path) for file_path in file_paths}:
+            watched = self._inotify.watch(directory) and watched
+
+        return watched
+
+    def _unregister(self, file_paths: list, event: threading.Event) -> None:
+        with self._lock:
+            for file_path in file_paths:
+                events = self._waiters.get(file_path)
+                if events is not None:
+                    events.discard(event)
+                    if not events:
+                        del self._waiters[file_path]
+
+    def _on_file_event(self, file_path: str) -> None:
+        with self._lock:
+            for event in self._waiters.get(file_path, ()):
+                event.set()
+
+    def _on_overflow(self) -> None:
+        """ Events were dropped by the kernel, so wake every waiter to re-check their files. """
+        with self._lock:
+            for events in self._waiters.values():
+                for event in events:
+                    event.set()
+
+    def _on_directory_unwatched(self, directory: str) -> None:
+        """ directory is no longer watched, so wake it's waiters to watch it again (or poll it, if it's gone). """
+        with self._lock:
+            for file_path, events in self._waiters.items():
+                if os.path.dirname(file_path) == directory:
+                    for event in events:
+                        event.set()
+
+    def _poll(self) -> None:
+        while True:
+            with self._lock:
+                while not self._waiters:
+                    self._lock.wait()
+                waiting = list(self._waiters.items())
+
+            for file_path, events in waiting:
+                if os.path.isfile(file_path):
+                    for event in list(events):
+                        event.set()
+
+            time.sleep(self.poll_interval)
+
+
+class _Inotify:
+    """ A minimal ctypes binding to Linux's inotify, reporting files moved or written into watched directories. """
+
+    def __init__(self, libc, file_descriptor: int, on_file_event, on_overflow, on_directory_unwatched):
+        self._libc = libc
+        self._file_descriptor = file_descriptor
+        self._on_file_event = on_file_event
+        self._on_overflow = on_overflow
+        self._on_directory_unwatched = on_directory_unwatched
+
+        self._lock = threading.Lock()
+        self._directories = {}  # watch descriptor -> directory
+        self._watched = set()
+
+        threading.Thread(target=self._read_events, daemon=True, name="FileReadinessInotify").start()
+
+    @staticmethod
+    def create(on_file_event, on_overflow, on_directory_unwatched):
+        if not sys.platform.startswith("linux"):
+            return None
+
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            file_descriptor = libc.inotify_init1(_IN_CLOEXEC)
+        except (OSError, AttributeError):
+            return None
+
+        if file_descriptor < 0:
+            return None
+
+        return _Inotify(libc, file_descriptor, on_file_event, on_overflow, on_directory_unwatched)
+
+    def watch(self, directory: str) -> bool:
+        """
+        Watch directory, if it isn't already. Returns False if it can't be watched, i.e it doesn't exist yet, or the
+        watch limit (fs.inotify.max_user_watches) was reached.
+        """
+        with self._lock:
+            if directory in self._watched:
+                return True
+
+            watch_descriptor = self._libc.inotify_add_watch(self._file_descriptor, os.fsencode(directory),
+                                                            _IN_CLOSE_WRITE | _IN_MOVED_TO)
+            if watch_descriptor < 0:
+                logging.getLogger(__name__).debug("Could not watch %s (errno %d)" % (directory, ctypes.get_errno()))
+                return False
+
+            self._directories[watch_descriptor] = directory
+            self._watched.add(directory)
+            return True
+
+    def _read_events(self) -> None:
+        while True:
+            buffer = os.read(self._file_descriptor, 64 * 1024)
+            offset = 0
+
+            while offset < len(buffer):
+                watch_descriptor, mask, cookie, length = _EVENT_HEADER.unpack_from(buffer, offset)
+                name = buffer[offset + _EVENT_HEADER.size: offset + _EVENT_HEADER.size + length].rstrip(b"\0")
+                offset += _EVENT_HEADER.size + length
+
+                if mask & _IN_Q_OVERFLOW:
+                    self._on_overflow()
+                    continue
+
+                with self._lock:
+                    directory = self._directories.get(watch_descriptor)
+                    unwatched = mask & _IN_IGNORED and directory is not None
+                    if unwatched:
+                        # The directory was deleted (i.e the workspace was cleaned up), or replaced.
+                        del self._directories[watch_descriptor]
+                        self._watched.discard(directory)
+
+                if unwatched:
+                    self._on_directory_unwatched(directory)
+                    continue
+
+                if directory is not None and name:
+                    self._on_file_event(os.path.join(directory, os.fsdecode(name)))
+
+
+_service = None
+_service_lock = threading.Lock()
+
+
+def get_file_readiness_service() -> FileReadinessService:
+    """ Returns the process-wide FileReadinessService, creating it on first use. """
+    global _service
+
+    with _service_lock:
+        if _service is None:
+            _service = FileReadinessService()
+
+        return _service
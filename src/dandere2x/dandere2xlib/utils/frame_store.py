@@ -0,0 +1,205 @@
+"""
+Frame stores keep a directory's frames (i.e inputs/frame1.png, frame2.png, ...) decoded, rather than as png files, so
+the python stages exchanging them skip a zlib compress / decompress per frame. A store stands in for the directory it
+was created for, and is looked up by that directory:
+
+    create_frame_store("mmap", context.input_frames_dir, width, height, slots)  # once, by the service
+    store = get_frame_store(context.input_frames_dir)  # None if the directory's frames are just png files
+    store.put(1, frame_array)
+    frame_array = store.get(1)  # blocks until frame 1 is put
+
+Stores are fixed-size rings, frame x lives in slot x % slots until frame x + slots replaces it. This relies on
+MinDiskUsage, which never lets extraction get more than max_frames_ahead frames ahead of merging, so a ring with a
+couple of slots more than that is never overwritten while it's still needed.
+
+Anything outside of python that needs a frame (the upscalers, dandere2x_cpp) still needs the png file.
+
+There are two kinds of store:
+    - "mmap" keeps the frames in a memory mapped file, so other processes can read them too.
+    - "memory" keeps the frames' arrays themselves, without copying or writing them anywhere, but only within this
+      process.
+"""
+
+import logging
+import os
+import struct
+import threading
+from abc import ABC, abstractmethod
+
+import numpy as np
+
+MMAP = "mmap"
+MEMORY = "memory"
+
+_STORE_FILE = "frames.d2xf"
+_HEADER = struct.Struct("<4sHIII")  # magic, version, width, height, slots
+_MAGIC = b"D2XF"
+_VERSION = 1
+_PAGE_SIZE = 4096
+
+_stores = {}  # frames_dir -> AbstractFrameStore opened by this process
+_stores_lock = threading.Lock()
+
+
+def _forget_stores_after_fork():
+    # A forked child may inherit a store's lock mid-use, so it maps the stores again for itself.
+    global _stores_lock
+    _stores_lock = threading.Lock()
+    _stores.clear()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_forget_stores_after_fork)
+
+
+class AbstractFrameStore(ABC):
+
+    @abstractmethod
+    def put(self, frame_number: int, frame_array: np.ndarray) -> None:
+        """
+        Store frame_array as frame_number, replacing frame (frame_number - slots). The store may keep frame_array
+        itself, so it mustn't be modified afterwards.
+        """
+        pass
+
+    @abstractmethod
+    def get(self, frame_number: int) -> np.ndarray:
+        """ Blocks until frame_number is stored, then returns a read-only view of it (no copy is made). """
+        pass
+
+
+class MMapFrameStore(AbstractFrameStore):
+    """
+    A ring of frames in a memory mapped file, so the frames can also be read (zero-copy) from other processes, i.e
+    Residual's process workers. Readiness is tracked by a per-slot frame number in the file itself - threads in the
+    process that created the store are notified, while other processes poll it.
+    """
+
+    POLL_INTERVAL = 0.005
+
+    def __init__(self, store_file: str, width: int = None, height: int = None, slots: int = None):
+        """ Creates store_file if width, height and slots are given, otherwise maps an existing store_file. """
+        self.log = logging.getLogger(__name__)
+        self._condition = threading.Condition()
+
+        if slots is not None:
+            self._mapping = np.memmap(store_file, dtype=np.uint8, mode="w+",
+                                      shape=(self._pixel_offset(slots) + slots * height * width * 3,))
+            self._mapping[:_HEADER.size] = np.frombuffer(_HEADER.pack(_MAGIC, _VERSION, width, height, slots),
+                                                         dtype=np.uint8)
+        else:
+            self._mapping = np.memmap(store_file, dtype=np.uint8, mode="r+")
+            magic, version, width, height, slots = _HEADER.unpack(self._mapping[:_HEADER.size].tobytes())
+
+            if magic != _MAGIC or version != _VERSION:
+                self.log.error("%s is not a version %d frame store." % (store_file, _VERSION))
+                raise ValueError("Invalid frame store file")
+
+        self.width, self.height, self.slots = width, height, slots
+
+        # A new file is zero filled, i.e every slot starts out holding "frame 0".
+        self._frame_numbers = self._mapping[_HEADER.size:_HEADER.size + slots * 8].view(np.int64)
+        self._frames = self._mapping[self._pixel_offset(slots):].reshape(slots, height, width, 3)
+
+    def put(self, frame_number: int, frame_array: np.ndarray) -> None:
+        slot = frame_number % self.slots
+
+        with self._condition:
+            np.copyto(self._frames[slot], frame_array[:, :, :3])
+            self._frame_numbers[slot] = frame_number
+            self._condition.notify_all()
+
+    def get(self, frame_number: int) -> np.ndarray:
+        slot = frame_number % self.slots
+
+        with self._condition:
+            while self._frame_numbers[slot] < frame_number:
+                self._condition.wait(self.POLL_INTERVAL)
+
+            if self._frame_numbers[slot] != frame_number:
+                self.log.error("Frame %d was overwritten by frame %d before being read, the frame store is too small."
+                               % (frame_number, self._frame_numbers[slot]))
+                raise ValueError("Frame store overrun")
+
+        frame_array = self._frames[slot].view(np.ndarray)
+        frame_array.flags.writeable = False
+        return frame_array
+
+    @staticmethod
+    def _pixel_offset(slots: int) -> int:
+        """ Pixel data starts on the first page after the header and every slot's frame number. """
+        return -(-(_HEADER.size + slots * 8) // _PAGE_SIZE) * _PAGE_SIZE
+
+
+class MemoryFrameStore(AbstractFrameStore):
+    """
+    Frames kept in memory, as the arrays that were put, for handing frames between threads of this process without
+    encoding, copying or writing them. Like the other stores it only holds the latest `slots` frames.
+    """
+
+    def __init__(self, slots: int):
+        self.log = logging.getLogger(__name__)
+        self.slots = slots
+
+        self._condition = threading.Condition()
+        self._frames = {}  # frame number -> read-only view of the array put
+        self._highest_put = 0
+
+    def put(self, frame_number: int, frame_array: np.ndarray) -> None:
+        frame_array = frame_array.view()
+        frame_array.flags.writeable = False
+
+        with self._condition:
+            self._frames[frame_number] = frame_array
+            self._highest_put = max(self._highest_put, frame_number)
+
+            # Frames may be put out of order (i.e by several noise workers), so evict everything that's fallen out
+            for evicted in [frame for frame in self._frames if frame <= self._highest_put - self.slots]:
+                del self._frames[evicted]
+
+            self._condition.notify_all()
+
+    def get(self, frame_number: int) -> np.ndarray:
+        with self._condition:
+            self._condition.wait_for(lambda: frame_number in self._frames or
+                                     frame_number <= self._highest_put - self.slots)
+
+            if frame_number not in self._frames:
+                self.log.error("Frame %d was evicted before being read, the frame store is too small." % frame_number)
+                raise ValueError("Frame store overrun")
+
+            return self._frames[frame_number]
+
+
+def create_frame_store(workspace_storage: str, frames_dir: str, width: int, height: int,
+                       slots: int) -> AbstractFrameStore:
+    """ Create the store standing in for frames_dir's files, for the rest of the session. """
+    if workspace_storage == MMAP:
+        frame_store = MMapFrameStore(os.path.join(frames_dir, _STORE_FILE), width, height, slots)
+    elif workspace_storage == MEMORY:
+        frame_store = MemoryFrameStore(slots)
+    else:
+        log = logging.getLogger(__name__)
+        log.error("No valid workspace storage selected: %s" % workspace_storage)
+        raise ValueError("workspace_storage must be 'files', 'mmap' or 'memory'")
+
+    with _stores_lock:
+        _stores[frames_dir] = frame_store
+
+    return frame_store
+
+
+def get_frame_store(frames_dir: str):
+    """
+    The store standing in for frames_dir's files, or None if frames_dir's frames are kept as files. In a process other
+    than the one that created it, this maps the store's file the first time it's asked for.
+    """
+    with _stores_lock:
+        if frames_dir not in _stores:
+            store_file = os.path.join(frames_dir, _STORE_FILE)
+            if not os.path.isfile(store_file):
+                return None
+
+            _stores[frames_dir] = MMapFrameStore(store_file)
+
+        return _stores[frames_dir]
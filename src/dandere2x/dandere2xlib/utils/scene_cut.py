@@ -0,0 +1,113 @@
+"""
+Scene cut detection. On a hard cut, nothing of frame(x) can be reused for frame(x+1), so rather than having
+dandere2x_cpp try (and fail) to match blocks, and residual / merge go through their generic paths, the frame is
+marked as a cut when it's extracted and every stage takes a full-frame fast path for it:
+
+    - dandere2x_cpp / dandere2x_py skip matching and write empty vector files.
+    - residual.py sends the entire frame to the upscaler.
+    - merge.py replaces the previous frame with the upscaled frame.
+
+Cuts are recorded in a SceneCutManifest, both in memory (for the python threads) and as marker files
+(for dandere2x_cpp). A frame is always marked before the frame itself is saved, so by the time any stage can see
+frame(x), whether or not it's a cut is already decided.
+"""
+
+import logging
+import math
+import os
+import threading
+
+import numpy as np
+
+
+class SceneCutManifest:
+    """
+    The per-session record of which frames are scene cuts. Frame x being a cut means frame x shares nothing with
+    frame x - 1.
+    """
+
+    MARKER_PREFIX = "cut_"
+
+    def __init__(self, scene_cuts_dir: str):
+        self.scene_cuts_dir = scene_cuts_dir
+        self._lock = threading.Lock()
+        self._cuts = set()
+
+        # A reused workspace may still have an earlier session's markers, which dandere2x_cpp would take as cuts.
+        if os.path.isdir(scene_cuts_dir):
+            for file_name in os.listdir(scene_cuts_dir):
+                if file_name.startswith(self.MARKER_PREFIX):
+                    os.remove(os.path.join(scene_cuts_dir, file_name))
+
+    def mark(self, frame: int) -> None:
+        with self._lock:
+            self._cuts.add(frame)
+
+        # dandere2x_cpp checks for this marker, see driver.h
+        open(self.marker_file(frame), "w").close()
+
+    def marker_file(self, frame: int) -> str:
+        """ The marker file of frame, which only exists if frame is a cut (MinDiskUsage deletes it with the frame). """
+        return os.path.join(self.scene_cuts_dir, self.MARKER_PREFIX + str(frame))
+
+    def is_cut(self, frame: int) -> bool:
+        with self._lock:
+            return frame in self._cuts
+
+    def __len__(self):
+        with self._lock:
+            return len(self._cuts)
+
+
+class SceneCutDetector:
+    """
+    Decides whether each decoded frame is a hard cut from the one before it, using a heavily downsampled luma plane
+    so it's cheap enough to run on every frame at extraction time. A frame is a cut when both
+
+        - the luma histograms of the two frames differ by more than histogram_threshold (0 being identical
+          histograms, 1 being disjoint), and
+        - the PSNR between the two luma planes is below psnr_threshold.
+
+    Requiring both avoids flagging fades (the histogram shifts but the structure stays) and fast motion (the
+    structure changes but the histogram stays).
+    """
+
+    HISTOGRAM_BINS = 32
+
+    def __init__(self, psnr_threshold: float, histogram_threshold: float, downsample: int):
+        self.log = logging.getLogger(__name__)
+        self.psnr_threshold = psnr_threshold
+        self.histogram_threshold = histogram_threshold
+        self.downsample = downsample
+
+        self._previous_luma = None
+        self._previous_histogram = None
+
+    def is_cut(self, frame_array: np.ndarray) -> bool:
+        """ Returns whether frame_array is a cut from the previous frame passed in. The first frame never is. """
+        luma = self._luma(frame_array)
+        histogram = np.bincount((luma.ravel() * self.HISTOGRAM_BINS / 256).astype(np.intp),
+                                minlength=self.HISTOGRAM_BINS) / luma.size
+
+        is_cut = False
+        if self._previous_luma is not None:
+            histogram_delta = np.abs(histogram - self._previous_histogram).sum() / 2
+            psnr = self._psnr(luma, self._previous_luma)
+            is_cut = histogram_delta > self.histogram_threshold and psnr < self.psnr_threshold
+
+        self._previous_luma = luma
+        self._previous_histogram = histogram
+        return is_cut
+
+    def _luma(self, frame_array: np.ndarray) -> np.ndarray:
+        """ Rec. 601 luma of every downsample'th pixel in both directions. """
+        sampled = frame_array[::self.downsample, ::self.downsample, :3].astype(np.float32)
+        return sampled[:, :, 0] * 0.299 + sampled[:, :, 1] * 0.587 + sampled[:, :, 2] * 0.114
+
+    @staticmethod
+    def _psnr(luma_a: np.ndarray, luma_b: np.ndarray) -> float:
+        mse = float(np.mean((luma_a - luma_b) ** 2))
+        if mse == 0:
+            return math.inf
+
+        return 20 * math.log10(255) - 10 * math.log10(mse)
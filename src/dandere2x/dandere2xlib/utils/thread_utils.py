@@ -1,6 +1,80 @@
+import threading
+import time
+from collections import deque
+
+
 class CancellationToken:
     def __init__(self):
         self.is_cancelled = False
 
     def cancel(self):
         self.is_cancelled = True
+
+
+class ByteBoundedQueue:
+    """
+    A FIFO queue bounded by the total size (in bytes) of the items in it rather than by the amount of items.
+    put() blocks while the queue is full, get() blocks while it's empty, and both sides are woken up by a
+    condition variable rather than by polling. The time each side spends blocked is accumulated, which is useful
+    for telling which side of the queue is the bottleneck.
+
+    An item larger than max_bytes is still accepted once the queue is empty, so a small max_bytes can't deadlock.
+
+    usage:
+    queue = ByteBoundedQueue(max_bytes=500 * 1024 * 1024)
+    queue.put(frame, frame.frame.nbytes)
+    frame = queue.get()  # returns None once the queue is closed and drained.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+
+        self.put_blocked_seconds = 0.0
+        self.get_blocked_seconds = 0.0
+
+        self._condition = threading.Condition()
+        self._items = deque()
+        self._bytes = 0
+        self._closed = False
+
+    def capacity(self, item_bytes: int) -> int:
+        """ Returns how many items of size item_bytes the queue holds before put() blocks. """
+        return max(1, self.max_bytes // item_bytes)
+
+    def put(self, item, item_bytes: int) -> None:
+        with self._condition:
+            if self._items and self._bytes + item_bytes > self.max_bytes:
+                blocked = time.time()
+                while self._items and self._bytes + item_bytes > self.max_bytes:
+                    self._condition.wait()
+                self.put_blocked_seconds += time.time() - blocked
+
+            self._items.append((item, item_bytes))
+            self._bytes += item_bytes
+            self._condition.notify_all()
+
+    def get(self):
+        with self._condition:
+            if not self._items and not self._closed:
+                blocked = time.time()
+                while not self._items and not self._closed:
+                    self._condition.wait()
+                self.get_blocked_seconds += time.time() - blocked
+
+            if not self._items:
+                return None
+
+            item, item_bytes = self._items.popleft()
+            self._bytes -= item_bytes
+            self._condition.notify_all()
+            return item
+
+    def close(self) -> None:
+        """ No more items will be put, getters drain what's left and then receive None. """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def __len__(self):
+        with self._condition:
+            return len(self._items)
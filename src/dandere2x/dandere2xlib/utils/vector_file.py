@@ -0,0 +1,180 @@
+"""
+Readers for the vector files (pframe_N, residual_N and fade_N) that dandere2x_cpp writes for every frame.
+
+Two formats are supported:
+
+    - "text": newline-separated ASCII integers, the original format.
+    - "binary": a 12 byte header followed by the vectors as little-endian int32's, which loads straight into a
+                numpy array.
+
+The binary header is laid out as
+
+    magic (4 bytes, b"D2XV") | version (uint16) | vector_size (uint16) | vector_count (uint32)
+
+Both readers wait on the file to exist (dandere2x_cpp writes to a temp file then renames it into place), and return
+an int64 array of shape (vector_count, vector_size). write_vector_file is the python counterpart of dandere2x_cpp's
+writer, for in-package engines producing the same files.
+
+With the "stream" format there are no files at all. dandere2x_cpp writes one record per frame to it's stdout,
+which read_vector_record reads back:
+
+    magic (4 bytes, b"D2XR") | frame (uint32) | fade vectors | predictive vectors | residual vectors
+
+where each set of vectors is laid out exactly like a binary vector file.
+"""
+
+import logging
+import os
+import struct
+from abc import ABC, abstractmethod
+
+import numpy as np
+
+from dandere2x.dandere2xlib.utils.dandere2x_utils import get_list_from_file_and_wait, get_array_from_list, wait_on_file
+
+BINARY_VECTOR_MAGIC = b"D2XV"
+BINARY_VECTOR_VERSION = 1
+BINARY_VECTOR_HEADER = struct.Struct("<4sHHI")
+
+STREAM_VECTOR_FORMAT = "stream"
+VECTOR_RECORD_MAGIC = b"D2XR"
+VECTOR_RECORD_HEADER = struct.Struct("<4sI")
+
+
+class AbstractVectorReader(ABC):
+
+    # The extension dandere2x_cpp uses for this format's files.
+    extension = None
+
+    def file_name(self, prefix: str, frame: int) -> str:
+        """ i.e file_name("workspace/pframe_data/pframe_", 5) -> "workspace/pframe_data/pframe_5.bin" """
+        return prefix + str(frame) + self.extension
+
+    @abstractmethod
+    def read(self, file_path: str, vector_size: int) -> np.ndarray:
+        """ Wait on file_path to exist, then load it's vectors into an (n, vector_size) array. """
+        pass
+
+
+class TextVectorReader(AbstractVectorReader):
+    extension = ".txt"
+
+    def read(self, file_path: str, vector_size: int) -> np.ndarray:
+        return get_array_from_list(get_list_from_file_and_wait(file_path), vector_size)
+
+
+class BinaryVectorReader(AbstractVectorReader):
+    extension = ".bin"
+
+    def read(self, file_path: str, vector_size: int) -> np.ndarray:
+        wait_on_file(file_path)
+
+        with open(file_path, "rb") as file:
+            magic, version, file_vector_size, vector_count = BINARY_VECTOR_HEADER.unpack(
+                file.read(BINARY_VECTOR_HEADER.size))
+
+            if magic != BINARY_VECTOR_MAGIC or version != BINARY_VECTOR_VERSION or file_vector_size != vector_size:
+                log = logging.getLogger(__name__)
+                log.error("Malformed vector file %s (magic %s, version %d, vector size %d, expected %d)" %
+                          (file_path, magic, version, file_vector_size, vector_size))
+                raise ValueError("malformed vector file " + file_path)
+
+            vectors = np.fromfile(file, dtype="<i4", count=vector_count * vector_size)
+
+        if len(vectors) != vector_count * vector_size:
+            log = logging.getLogger(__name__)
+            log.error("Vector file %s is truncated" % file_path)
+            raise ValueError("truncated vector file " + file_path)
+
+        return vectors.astype(np.int64).reshape(vector_count, vector_size)
+
+
+def write_vector_file(file_path: str, vectors: np.ndarray) -> None:
+    """
+    Write an (n, vector_size) array of vectors in the format denoted by file_path's extension. Like dandere2x_cpp,
+    the file is written to a temp file first then renamed, so readers never see a partially written file.
+    """
+    vector_size = vectors.shape[1]
+    temp_file = file_path + ".temp"
+
+    if file_path.endswith(BinaryVectorReader.extension):
+        with open(temp_file, "wb") as file:
+            file.write(BINARY_VECTOR_HEADER.pack(BINARY_VECTOR_MAGIC, BINARY_VECTOR_VERSION, vector_size,
+                                                 len(vectors)))
+            file.write(np.ascontiguousarray(vectors, dtype="<i4").tobytes())
+    else:
+        with open(temp_file, "w") as file:
+            file.write("".join("\n".join(str(value) for value in vector) + "\n" for vector in vectors.tolist()))
+
+    os.replace(temp_file, file_path)
+
+
+def read_vector_record(stream):
+    """
+    Read the next frame's record from a binary stream, returning (frame, fade_vectors, predictive_vectors,
+    residual_vectors), or None if the stream ended.
+    """
+    header = _read_exactly(stream, VECTOR_RECORD_HEADER.size)
+    if header is None:
+        return None
+
+    magic, frame = VECTOR_RECORD_HEADER.unpack(header)
+    if magic != VECTOR_RECORD_MAGIC:
+        log = logging.getLogger(__name__)
+        log.error("Malformed vector record (magic %s)" % magic)
+        raise ValueError("malformed vector record")
+
+    fade_vectors = _read_stream_vectors(stream, 3)
+    predictive_vectors = _read_stream_vectors(stream, 4)
+    residual_vectors = _read_stream_vectors(stream, 4)
+    return frame, fade_vectors, predictive_vectors, residual_vectors
+
+
+def _read_stream_vectors(stream, vector_size: int) -> np.ndarray:
+    header = _read_exactly(stream, BINARY_VECTOR_HEADER.size)
+    if header is None:
+        log = logging.getLogger(__name__)
+        log.error("Vector stream ended in the middle of a record")
+        raise ValueError("truncated vector stream")
+
+    magic, version, stream_vector_size, vector_count = BINARY_VECTOR_HEADER.unpack(header)
+    if magic != BINARY_VECTOR_MAGIC or version != BINARY_VECTOR_VERSION or stream_vector_size != vector_size:
+        log = logging.getLogger(__name__)
+        log.error("Malformed vectors in stream (magic %s, version %d, vector size %d, expected %d)" %
+                  (magic, version, stream_vector_size, vector_size))
+        raise ValueError("malformed vector stream")
+
+    values = _read_exactly(stream, vector_count * vector_size * 4) if vector_count else b""
+    if values is None:
+        log = logging.getLogger(__name__)
+        log.error("Vector stream ended in the middle of a record")
+        raise ValueError("truncated vector stream")
+
+    return np.frombuffer(values, dtype="<i4").astype(np.int64).reshape(vector_count, vector_size)
+
+
+def _read_exactly(stream, size: int):
+    """ Read exactly size bytes (pipes may return less per read), or None if the stream ends first. """
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    read_total = 0
+
+    while read_total < size:
+        read = stream.readinto(view[read_total:])
+        if not read:
+            return None
+        read_total += read
+
+    return buffer
+
+
+def get_vector_reader(vector_format: str) -> AbstractVectorReader:
+    if vector_format == "text":
+        return TextVectorReader()
+
+    if vector_format == "binary":
+        return BinaryVectorReader()
+
+    log = logging.getLogger(__name__)
+    log.error("Unsupported vector format: %s" % vector_format)
+    raise ValueError("vector_format must be 'text' or 'binary'")
@@ -1,18 +1,23 @@
 import subprocess
 import threading
-import time
 
+import numpy as np
 from colorlog import logging
 
 from dandere2x.dandere2x_service.dandere2x_service_context import Dandere2xServiceContext
 from dandere2x.dandere2x_service.dandere2x_service_controller import Dandere2xController
+from dandere2x.dandere2xlib.utils.thread_utils import ByteBoundedQueue
 from dandere2x.dandere2xlib.utils.yaml_utils import load_executable_paths_yaml, get_options_from_section
+from dandere2x.dandere2xlib.wrappers.frame.frame_pool import FramePool
 
 
 class Pipe(threading.Thread):
     """
     The pipe class allows images (Frame.py) to be processed into a video directly. It does this by "piping"
     images to ffmpeg, thus removing the need for storing the processed images onto the disk.
+
+    Images are either piped as raw rgb24 frames ("rawvideo"), or as quality 100 jpegs ("jpeg"), depending on
+    ffmpeg -> pipe_video -> pipe_format in output_options.yaml.
     """
 
     def __init__(self, output_no_sound: str, context: Dandere2xServiceContext, controller: Dandere2xController):
@@ -27,52 +32,80 @@ class Pipe(threading.Thread):
         # class specific
         self.ffmpeg_pipe_subprocess = None
         self.alive = False
-        self.images_to_pipe = []
-        self.buffer_limit = 20
-        self.lock_buffer = False
+
+        # The buffer's depth is expressed in megabytes, as a fixed amount of frames varies wildly in memory usage
+        # depending on the resolution being upscaled to.
+        buffer_megabytes = self.context.service_request.output_options["ffmpeg"]["pipe_video"].get("buffer_megabytes",
+                                                                                                   512)
+        self.images_to_pipe = ByteBoundedQueue(max_bytes=buffer_megabytes * 1024 * 1024)
+
+        # Older configs describe the image2pipe input within the output_options, so they're treated as "jpeg".
+        self.pipe_format = self.context.service_request.output_options["ffmpeg"]["pipe_video"].get("pipe_format",
+                                                                                                   "jpeg")
+        if self.pipe_format not in ["rawvideo", "jpeg"]:
+            self.log.error("pipe_format %s is not one of 'rawvideo' or 'jpeg'" % self.pipe_format)
+            raise ValueError("invalid pipe_format %s" % self.pipe_format)
 
     def kill(self) -> None:
         self.log.info("Kill called.")
-        self.alive = False
+        self.images_to_pipe.close()
 
     def run(self) -> None:
         self.log.info("Run Called")
 
         self.alive = True
-        self._setup_pipe()
 
-        # keep piping images to ffmpeg while this thread is supposed to be kept alive.
-        while self.alive:
-            if len(self.images_to_pipe) > 0:
-                img = self.images_to_pipe.pop(0).get_pil_image()  # get the first image and remove it from list
-                img.save(self.ffmpeg_pipe_subprocess.stdin, format="jpeg", quality=100)
-            else:
-                time.sleep(0.1)
+        # keep piping images to ffmpeg until the thread is killed. If the thread is killed for whatever reason,
+        # get() continues to return the remainder of the images, so they're still written to the video file.
+        while True:
+            item = self.images_to_pipe.get()
+            if item is None:
+                break
 
-        # if the thread is killed for whatever reason, finish writing the remainder of the images to the video file.
-        while self.images_to_pipe:
-            pil_image = self.images_to_pipe.pop(0).get_pil_image()
-            pil_image.save(self.ffmpeg_pipe_subprocess.stdin, format="jpeg", quality=100)
+            self._write_frame(*item)
 
-        self.ffmpeg_pipe_subprocess.stdin.close()
-        self.ffmpeg_pipe_subprocess.wait()
+        if self.ffmpeg_pipe_subprocess is not None:
+            self.ffmpeg_pipe_subprocess.stdin.close()
+            self.ffmpeg_pipe_subprocess.wait()
+
+        self.log.info("Time spent waiting on frames to pipe: %s sec" %
+                      str(round(self.images_to_pipe.get_blocked_seconds, 2)))
+        self.log.info("Time spent waiting on a full pipe buffer: %s sec" %
+                      str(round(self.images_to_pipe.put_blocked_seconds, 2)))
 
         # ensure thread is dead (can be killed with controller.kill() )
         self.alive = False
 
-    # todo: Implement this without a 'while true'
-    def save(self, frame):
+    def save(self, frame, frame_pool: FramePool = None):
         """
-        Try to add an image to image_to_pipe buffer. If there's too many images in the buffer,
-        simply wait until the buffer clears.
+        Try to add an image to image_to_pipe buffer. If the buffer is full, this blocks until the pipe has
+        written enough images to make room for it.
+
+        If frame_pool is given, the caller hands off one of it's references to frame, which the pipe releases back
+        into frame_pool once the frame has been written.
         """
-        while True:
-            if len(self.images_to_pipe) < self.buffer_limit:
-                self.images_to_pipe.append(frame)
-                break
-            time.sleep(0.05)
+        self.images_to_pipe.put((frame, frame_pool), frame.frame.nbytes)
+
+    def get_buffer_capacity(self, frame_bytes: int) -> int:
+        """ Returns how many frames of size frame_bytes the pipe buffers before save() blocks. """
+        return self.images_to_pipe.capacity(frame_bytes)
+
+    def _write_frame(self, frame, frame_pool: FramePool) -> None:
+        # The pipe is set up lazily, as rawvideo needs to know the resolution of the frames being piped.
+        if self.ffmpeg_pipe_subprocess is None:
+            self._setup_pipe(frame.width, frame.height)
 
-    def _setup_pipe(self) -> None:
+        if self.pipe_format == "rawvideo":
+            # Write the frame's buffer as is, without encoding it or copying it.
+            self.ffmpeg_pipe_subprocess.stdin.write(memoryview(np.ascontiguousarray(frame.frame, dtype=np.uint8)))
+        else:
+            img = frame.get_pil_image()
+            img.save(self.ffmpeg_pipe_subprocess.stdin, format="jpeg", quality=100)
+
+        if frame_pool is not None:
+            frame_pool.release(frame)
+
+    def _setup_pipe(self, width: int, height: int) -> None:
         self.log.info("Setting up pipe Called")
         # load variables..
         output_no_sound = self.output_no_sound
@@ -84,14 +117,25 @@ class Pipe(threading.Thread):
         # constructing the pipe command...
         ffmpeg_pipe_command = [ffmpeg_dir]
 
-        # no walrus operator sad
-        hw_accel = self.context.service_request.output_options["ffmpeg"]["pipe_video"]["-hwaccel"]
-        if hw_accel is not None:
-            ffmpeg_pipe_command.append("-hwaccel")
-            ffmpeg_pipe_command.append(hw_accel)
-
-        ffmpeg_pipe_command.extend(["-r", frame_rate])
-        ffmpeg_pipe_command.extend(['-pix_fmt', self.context.video_settings.pix_fmt])
+        if self.pipe_format == "rawvideo":
+            # Raw frames are of a known size and format, there's nothing for hwaccel to decode.
+            ffmpeg_pipe_command.extend(["-r", frame_rate])
+            ffmpeg_pipe_command.extend(["-f", "rawvideo",
+                                        "-pix_fmt", "rgb24",
+                                        "-s", "%dx%d" % (width, height),
+                                        "-y", "-i", "-"])
+        else:
+            # no walrus operator sad
+            hw_accel = self.context.service_request.output_options["ffmpeg"]["pipe_video"]["-hwaccel"]
+            if hw_accel is not None:
+                ffmpeg_pipe_command.append("-hwaccel")
+                ffmpeg_pipe_command.append(hw_accel)
+
+            ffmpeg_pipe_command.extend(["-r", frame_rate])
+            ffmpeg_pipe_command.extend(['-pix_fmt', self.context.video_settings.pix_fmt])
+
+            if "pipe_format" in self.context.service_request.output_options["ffmpeg"]["pipe_video"]:
+                ffmpeg_pipe_command.extend(["-y", "-f", "image2pipe", "-i", "-"])
 
         options = get_options_from_section(
             self.context.service_request.output_options["ffmpeg"]["pipe_video"]['output_options'],
@@ -99,6 +143,9 @@ class Pipe(threading.Thread):
         for item in options:
             ffmpeg_pipe_command.append(item)
 
+        if self.pipe_format == "rawvideo":
+            ffmpeg_pipe_command.extend(['-pix_fmt', self.context.video_settings.pix_fmt])
+
         ffmpeg_pipe_command.append("-r")
         ffmpeg_pipe_command.append(frame_rate)
 
@@ -1,13 +1,19 @@
+import logging
 import threading
 import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+from dandere2x.dandere2x_service.dandere2x_service_controller import Dandere2xController
 from dandere2x.dandere2xlib.utils.dandere2x_utils import rename_file_wait
+from dandere2x.dandere2xlib.utils.frame_store import get_frame_store
+from dandere2x.dandere2xlib.utils.scene_cut import SceneCutDetector, SceneCutManifest
 from dandere2x.dandere2xlib.utils.yaml_utils import load_executable_paths_yaml
 from dandere2x.dandere2xlib.wrappers.ffmpeg.progressive_frame_extractor._ffmpeg_video_frame_extractor import \
     FFMpegVideoFrameExtractor, D2xFrame
 from dandere2x.dandere2xlib.wrappers.ffmpeg.ffprobe import get_width_height
+from dandere2x.dandere2xlib.wrappers.ffmpeg.progressive_noise_adder import ProgressiveNoiseAdder
 
 
 class ProgressiveFrameExtractor:
@@ -22,10 +28,15 @@ class ProgressiveFrameExtractor:
                  compressed_frames_dir: str,
                  compressed_quality: int,
                  block_size: int,
-                 output_options_original: dict):
+                 output_options_original: dict,
+                 scene_cut_manifest: SceneCutManifest = None,
+                 noise_adder: ProgressiveNoiseAdder = None,
+                 controller: Dandere2xController = None):
         ffprobe_path = load_executable_paths_yaml()['ffprobe']
         ffmpeg_path = load_executable_paths_yaml()['ffmpeg']
 
+        self.log = logging.getLogger(__name__)
+        self.controller = controller
         self.input_video = input_video
         self.extracted_frames_dir = extracted_frames_dir
         self.compressed_frames_dir = compressed_frames_dir
@@ -39,6 +50,29 @@ class ProgressiveFrameExtractor:
 
         self.count = 1
 
+        # Every decoded frame is also handed to the noise adder in memory, rather than it re-reading the saved png.
+        self.noise_adder = noise_adder
+
+        """
+        Frames are png-encoded on a fixed amount of threads. Submitting blocks once `queue_size` frames are waiting to
+        be saved, so extracting many frames at once (i.e extract_initial_frames) neither starts a thread per frame nor
+        holds an unbounded amount of frames in memory.
+        """
+        extractor_options = output_options_original["dandere2x"]["extractor"]
+        self.png_compress_level = extractor_options["png_compress_level"]
+        self.encoder_pool = ThreadPoolExecutor(max_workers=max(1, extractor_options["encoder_workers"]),
+                                               thread_name_prefix="FrameEncoder")
+        self.encoder_slots = threading.BoundedSemaphore(max(1, extractor_options["encoder_queue_size"]))
+
+        # Frames are checked for scene cuts as they're decoded, and marked before they're saved.
+        self.scene_cut_manifest = scene_cut_manifest
+        self.scene_cut_detector = None
+        scene_cut_options = output_options_original["dandere2x"]["scene_cut"]
+        if scene_cut_manifest is not None and scene_cut_options["enabled"]:
+            self.scene_cut_detector = SceneCutDetector(psnr_threshold=scene_cut_options["psnr_threshold"],
+                                                       histogram_threshold=scene_cut_options["histogram_threshold"],
+                                                       downsample=scene_cut_options["downsample"])
+
     def extract_frames_to(self, stop_frame: int):
         for x in range(1, stop_frame):
             self.next_frame()
@@ -53,11 +87,33 @@ class ProgressiveFrameExtractor:
         temp_image = self.extracted_frames_dir + str(uuid.uuid4()) + "frame_temp_%s.png" % self.count
         final_image = self.extracted_frames_dir + "frame%s.png" % self.count
 
-        threading.Thread(target=self.save_asyncable, args=(image, temp_image, final_image,)).start()
+        if self.scene_cut_detector is not None and self.scene_cut_detector.is_cut(image._frame_array):
+            self.scene_cut_manifest.mark(self.count)
+
+        if self.noise_adder is not None:
+            self.noise_adder.add_frame(self.count, image._frame_array)
+
+        # If the inputs are kept in a frame store, only the first frame (which is upscaled whole, by an external
+        # upscaler) needs to exist as a file.
+        frame_store = get_frame_store(self.extracted_frames_dir)
+        if frame_store is not None:
+            frame_store.put(self.count, image._frame_array)
+
+        if frame_store is None or self.count == 1:
+            self.encoder_slots.acquire()
+            self.encoder_pool.submit(self.save_asyncable, image, temp_image, final_image)
 
         self.count += 1
 
-    @staticmethod
-    def save_asyncable(image: D2xFrame, temp_image:str,  final_image: str):
-        image.save(Path(temp_image))
-        rename_file_wait(temp_image, final_image)
\ No newline at end of file
+    def save_asyncable(self, image: D2xFrame, temp_image: str, final_image: str):
+        try:
+            image.save(Path(temp_image), compress_level=self.png_compress_level)
+            rename_file_wait(temp_image, final_image)
+        except Exception as e:
+            # Nothing else would notice, whatever needs this frame would just wait on it forever.
+            self.log.error("Could not save extracted frame %s, dandere2x will stop the current session." % final_image,
+                           exc_info=True)
+            if self.controller is not None:
+                self.controller.report_error(e)
+        finally:
+            self.encoder_slots.release()
\ No newline at end of file
@@ -1,4 +1,4 @@
-from copy import copy
+import sys
 from pprint import pprint
 
 import imageio
@@ -71,19 +71,32 @@ class D2xFrame:
 
     @classmethod
     def from_ndarray(cls, frame_array: numpy.ndarray):
+        """
+        Returns a Frame instance wrapping frame_array itself (no copy is made).
+        """
 
         height = frame_array.shape[0]
         width = frame_array.shape[1]
 
-        instantiated_frame = D2xFrame(width, height)
+        # Instantiated as 0x0 so a full frame isn't allocated just to be replaced.
+        instantiated_frame = D2xFrame(0, 0)
         instantiated_frame._frame_array = frame_array
+        instantiated_frame.__image_width = width
+        instantiated_frame.__image_height = height
 
         return instantiated_frame
 
-    def save(self, output_file: Path):
+    def save(self, output_file: Path, compress_level: int = None):
+        """
+        @param compress_level: zlib compression level (0-9) if saving a png, lower being faster but larger. PIL's
+                               default is used if not given.
+        """
 
-        pil_image = Image.fromarray(self._frame_array.astype(np.uint8))
-        pil_image.save(output_file)
+        pil_image = Image.fromarray(self._frame_array.astype(np.uint8, copy=False))
+        if compress_level is None:
+            pil_image.save(output_file)
+        else:
+            pil_image.save(output_file, compress_level=compress_level)
 
 
 def _check_and_fix_resolution(input_file: str, block_size: int, output_options_original: dict) -> dict:
@@ -148,7 +161,9 @@ class FFMpegVideoFrameExtractor:
         extraction_args.extend(["-c:v", "rawvideo", "-f", "rawvideo",
                                 "-pix_fmt", "rgb24", "-an", "-"])
 
-        self.ffmpeg = subprocess.Popen(extraction_args, stdout=subprocess.PIPE)
+        # Unbuffered, frames are read straight from the pipe into their own arrays (see get_frame).
+        self.ffmpeg = subprocess.Popen(extraction_args, stdout=subprocess.PIPE, bufsize=0)
+        _grow_pipe(self.ffmpeg.stdout.fileno(), self._width * self._height * 3)
 
     @property
     def current_frame(self) -> int:
@@ -158,17 +173,46 @@ class FFMpegVideoFrameExtractor:
         """Pipes the raw frames to stdout, converts the bytes to NumPy arrays of RGB data.
         This is a generator so usage is (for Frame in self._GetRawFrames(Video))"""
 
-        raw = self.ffmpeg.stdout.read(self._width * self._height * 3)
-        if not raw:
-            raise IndexError
+        """
+        Every frame gets it's own (uninitialized) array which ffmpeg's output is read directly into, rather than
+        being read into a bytes object, copied, and copied again into the frame. The array is owned by the returned
+        frame alone, so it's safe to hand to other threads.
+        """
+        frame_array = np.empty((self._height, self._width, 3), dtype=self._dtype)
+        buffer = memoryview(frame_array.reshape(-1))
+
+        bytes_read = 0
+        while bytes_read < len(buffer):
+            read = self.ffmpeg.stdout.readinto(buffer[bytes_read:])
+            if not read:
+                # End of the video (a truncated last frame is dropped, as it can't be a whole frame).
+                raise IndexError
 
-        raw = copy(raw)
+            bytes_read += read
 
         self.__count += 1
-        return D2xFrame(width=self._width,
-                        height=self._height,
-                        frame_name=f"frame{self.__count}",
-                        frame_array=np.frombuffer(raw, dtype=self._dtype).reshape((self._height, self._width, -1)))
+        frame = D2xFrame.from_ndarray(frame_array)
+        frame.frame_name = f"frame{self.__count}"
+        return frame
+
+
+def _grow_pipe(file_descriptor: int, frame_size: int) -> None:
+    """
+    On Linux, grow the pipe's capacity (64KiB by default) towards a frame's size, so a frame is read in far fewer
+    read calls. This is best effort, the kernel caps unprivileged pipes (usually at 1MiB).
+    """
+    if not sys.platform.startswith("linux"):
+        return
+
+    import fcntl
+    f_setpipe_sz = getattr(fcntl, "F_SETPIPE_SZ", 1031)
+
+    try:
+        with open("/proc/sys/fs/pipe-max-size") as pipe_max_size:
+            capacity = min(frame_size, int(pipe_max_size.read()))
+        fcntl.fcntl(file_descriptor, f_setpipe_sz, capacity)
+    except (OSError, ValueError):
+        pass
 
 
 if __name__ == "__main__":
@@ -1,42 +1,95 @@
+import logging
 import threading
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
+from PIL import Image
 
-from dandere2x.dandere2xlib.utils.dandere2x_utils import rename_file_wait, wait_on_file
-from dandere2x.dandere2xlib.utils.yaml_utils import load_executable_paths_yaml
-from dandere2x.dandere2xlib.wrappers.ffmpeg.ffmpeg import apply_noise_to_image
+from dandere2x.dandere2x_service.dandere2x_service_controller import Dandere2xController
+from dandere2x.dandere2xlib.utils.dandere2x_utils import rename_file_wait
+from dandere2x.dandere2xlib.utils.frame_store import get_frame_store
 
 
-class ProgressiveNoiseAdder(threading.Thread):
+def apply_uniform_noise(frame_array: np.ndarray, strength: int, seed) -> np.ndarray:
+    """
+    The numpy equivalent of ffmpeg's "noise=c0s=<strength>:c0f=u" on an rgb frame. ffmpeg's noise filter works on the
+    planar (gbrp) version of the frame, so component 0 is green, which gets a uniform integer in
+    [-strength / 2, strength / 2) added to it, saturating at 0 and 255. The other channels are untouched.
 
-    def __init__(self, extracted_frames_dir: str, noised_frames_dir: str, frame_count):
-        super().__init__()
-        self.extracted_frames_dir = extracted_frames_dir
-        self.noised_frames_dir = noised_frames_dir
+    The same seed (an int, or a sequence of ints) always produces the same noise. Returns a new array, frame_array
+    isn't modified.
+    """
+    rng = np.random.default_rng(seed)
+    noise = rng.integers(-(strength // 2), strength - strength // 2, size=frame_array.shape[:2], dtype=np.int16)
+
+    noised = frame_array.copy()
+    noised[:, :, 1] = np.clip(frame_array[:, :, 1] + noise, 0, 255)
+    return noised
+
+
+class ProgressiveNoiseAdder(threading.Thread):
+    """
+    Saves a noised copy of every extracted frame into noised_frames_dir, which is what the block matcher reads.
+    Frames are handed over in memory (by ProgressiveFrameExtractor) as they're decoded, and noised + saved on a
+    fixed amount of worker threads, so a fast extraction can't start an unbounded amount of work at once.
 
-        self.ffmpeg_path = load_executable_paths_yaml()['ffmpeg']
+    usage:
+    noise_adder = ProgressiveNoiseAdder(noised_frames_dir, frame_count, strength=8, seed=0, workers=2)
+    noise_adder.start()
+    noise_adder.add_frame(1, frame_array)
+    noise_adder.join()  # returns once every frame has been saved
+    """
 
+    def __init__(self, noised_frames_dir: str, frame_count, strength: int, seed: int, workers: int,
+                 controller: Dandere2xController = None):
+        super().__init__(name="ProgressiveNoiseAdder")
+        self.log = logging.getLogger(__name__)
+        self.controller = controller
+        self.noised_frames_dir = noised_frames_dir
         self.frame_count = frame_count
+        self.strength = strength
+        self.seed = seed
+        self.workers = max(1, workers)
+
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="NoiseWorker")
+        # Bounds how many frames can be waiting on a worker (each holds a full frame in memory).
+        self._pending = threading.BoundedSemaphore(self.workers * 2)
+        self._frames_done = threading.Semaphore(0)
 
     def join(self, timeout=None):
         threading.Thread.join(self, timeout)
 
-    def _noise_image_sub_thread(self, frame_number: int):
-        extracted_image = self.extracted_frames_dir + "frame%s.png" % frame_number
+    def add_frame(self, frame_number: int, frame_array: np.ndarray) -> None:
+        """ Queue frame_number to be noised and saved, blocking while the workers are too far behind. """
+        self._pending.acquire()
+        self._executor.submit(self._noise_frame, frame_number, frame_array)
+
+    def _noise_frame(self, frame_number: int, frame_array: np.ndarray):
         noise_extracted_image_temp = self.noised_frames_dir + "temp%s.png" % frame_number
         noise_extracted_image = self.noised_frames_dir + "frame%s.png" % frame_number
 
-        apply_noise_to_image(ffmpeg_dir=self.ffmpeg_path,
-                             input_image=extracted_image,
-                             output_file=noise_extracted_image_temp)
+        try:
+            # Seeding by frame number keeps the noise reproducible regardless of which worker gets which frame.
+            noised = apply_uniform_noise(frame_array, self.strength, seed=(self.seed, frame_number))
 
-        rename_file_wait(noise_extracted_image_temp, noise_extracted_image)
+            frame_store = get_frame_store(self.noised_frames_dir)
+            if frame_store is not None:
+                frame_store.put(frame_number, noised)
+            else:
+                Image.fromarray(noised).save(noise_extracted_image_temp)
+                rename_file_wait(noise_extracted_image_temp, noise_extracted_image)
+        except Exception as e:
+            # Nothing else would notice, the block matcher would just wait on this frame forever.
+            self.log.error("Could not noise frame %d, dandere2x will stop the current session." % frame_number,
+                           exc_info=True)
+            if self.controller is not None:
+                self.controller.report_error(e)
+        finally:
+            self._pending.release()
+            self._frames_done.release()
 
     def run(self):
         for count in range(1, self.frame_count + 1):
-            extracted_image = self.extracted_frames_dir + "frame%s.png" % count
-
-            wait_on_file(extracted_image)
-
-            noise_sub_thread = threading.Thread(target=self._noise_image_sub_thread, args=(count,))
-            noise_sub_thread.start()
+            self._frames_done.acquire()
 
+        self._executor.shutdown()
@@ -2,12 +2,12 @@
 # -*- coding: utf-8 -*-
 import logging
 import os
-import time
 from dataclasses import dataclass
 
 import imageio
 import numpy
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 from PIL import Image
 
 from dandere2x.dandere2xlib.utils.dandere2x_utils import rename_file, wait_on_file
@@ -57,6 +57,85 @@ def copy_from_fade(A, B, A_start, B_start, B_end, scalar):
         raise ValueError
 
 
+def _tiled_view(A, block_size):
+    """
+    Returns a (rows, block_size, columns, block_size, channels) view of A, so that view[row, :, column] addresses
+    an entire block without copying. Returns None if A can't be evenly tiled by block_size.
+    """
+    height, width = A.shape[0], A.shape[1]
+
+    if height % block_size != 0 or width % block_size != 0 or not A.flags['C_CONTIGUOUS']:
+        return None
+
+    return A.reshape((height // block_size, block_size, width // block_size, block_size) + A.shape[2:])
+
+
+def _is_block_aligned(xs, ys, block_size):
+    return not np.any(xs % block_size) and not np.any(ys % block_size)
+
+
+def gather_blocks(A, xs, ys, block_size):
+    """
+    Gathers every (block_size x block_size) block whose upper left corner is (xs[i], ys[i]) from A in one numpy call,
+    returning an array of shape (n, block_size, block_size, channels).
+
+    Block aligned coordinates are read through a tiled view of A, while arbitrary coordinates are read from a
+    strided window view of A, so in neither case is A copied.
+    """
+    if _is_block_aligned(xs, ys, block_size):
+        view = _tiled_view(A, block_size)
+        if view is not None:
+            return view[ys // block_size, :, xs // block_size]
+
+    windows = sliding_window_view(A, (block_size, block_size), axis=(0, 1))
+    return np.moveaxis(windows[ys, xs], 1, -1)
+
+
+def scatter_blocks(B, xs, ys, block_size, blocks):
+    """
+    The inverse of gather_blocks, writes blocks[i] into B with it's upper left corner at (xs[i], ys[i]).
+    Destination blocks are assumed to not overlap.
+    """
+    if _is_block_aligned(xs, ys, block_size):
+        view = _tiled_view(B, block_size)
+        if view is not None:
+            view[ys // block_size, :, xs // block_size] = blocks
+            return
+
+    offsets = np.arange(block_size)
+    rows = ys[:, None] + offsets
+    columns = xs[:, None] + offsets
+    B[rows[:, :, None], columns[:, None, :]] = blocks
+
+
+def add_scalars_saturated(blocks, scalars):
+    """
+    Adds scalars[i] to every value in blocks[i] in place, saturating at [0, 255]. Unlike copy_from_fade, this
+    stays in uint8 the whole way, using
+
+        min(value, 255 - scalar) + scalar  for positive scalars
+        max(value, -scalar) + scalar       for negative scalars
+
+    so no widened integer copy of the blocks is made.
+    """
+    scalars = np.clip(scalars, -255, 255)
+    magnitudes = np.abs(scalars).astype(np.uint8).reshape((-1,) + (1,) * (blocks.ndim - 1))
+
+    positive = scalars > 0
+    if np.any(positive):
+        faded = blocks[positive]
+        np.minimum(faded, 255 - magnitudes[positive], out=faded)
+        faded += magnitudes[positive]
+        blocks[positive] = faded
+
+    negative = scalars < 0
+    if np.any(negative):
+        faded = blocks[negative]
+        np.maximum(faded, magnitudes[negative], out=faded)
+        faded -= magnitudes[negative]
+        blocks[negative] = faded
+
+
 # A vector class
 @dataclass
 class DisplacementVector:
@@ -105,18 +184,20 @@ class Frame:
         self.width = self.frame.shape[1]
         self.string_name = input_string
 
+    def load_from_array(self, frame_array):
+        """
+        Use frame_array itself (it's not copied) as this frame's image, i.e a frame from a FrameStore.
+        """
+        self.frame = frame_array
+        self.height = self.frame.shape[0]
+        self.width = self.frame.shape[1]
+        self.string_name = ''
+
     from dandere2x.dandere2x_service.dandere2x_service_controller import Dandere2xController
     def load_from_string_controller(self, input_string, controller=Dandere2xController()):
 
         logger = logging.getLogger(__name__)
-        exists = exists = os.path.isfile(input_string)
-        count = 0
-        while not exists:
-            if count % 10000 == 0:
-                logger.debug(input_string + " dne")
-            exists = os.path.isfile(input_string)
-            count += 1
-            time.sleep(.2)
+        wait_on_file(input_string)
 
         loaded = False
         while not loaded:
@@ -152,7 +233,7 @@ class Frame:
         return (self.width, self.height)
 
     def get_pil_image(self):
-        return Image.fromarray(self.frame.astype(np.uint8))
+        return Image.fromarray(self.frame.astype(np.uint8, copy=False))
 
     def save_image_temp(self, out_location, temp_location):
         """
@@ -216,6 +297,22 @@ class Frame:
                   (other_y, other_x), (this_y, this_x),
                   (this_y + block_size - 1, this_x + block_size - 1))
 
+    def copy_blocks(self, frame_other, block_size, other_xs, other_ys, this_xs, this_ys):
+        """
+        The batched version of copy_block. Copies every block (other_xs[i], other_ys[i]) in frame_other into
+        (this_xs[i], this_ys[i]) in this frame, where each argument is an integer array of equal length.
+
+        The bounds of every block are validated once for the whole batch, and the blocks are moved with a single
+        gather and scatter rather than a python call per block.
+        """
+        if len(this_xs) == 0:
+            return
+
+        self.check_if_valid_blocks(frame_other, block_size, other_xs, other_ys, this_xs, this_ys)
+
+        blocks = gather_blocks(frame_other.frame, other_xs, other_ys, block_size)
+        scatter_blocks(self.frame, this_xs, this_ys, block_size, blocks)
+
     def fade_block(self, this_x, this_y, block_size, scalar):
         """
         Apply a scalar value to the RGB values for a given block. The values are then clipped to ensure
@@ -226,6 +323,20 @@ class Frame:
                        (this_y, this_x), (this_y, this_x),
                        (this_y + block_size - 1, this_x + block_size - 1), scalar)
 
+    def fade_blocks(self, this_xs, this_ys, block_size, scalars):
+        """
+        The batched version of fade_block. Applies scalars[i] to the block at (this_xs[i], this_ys[i]), where each
+        argument is an integer array of equal length. The blocks are gathered, faded and written back in one pass.
+        """
+        if len(this_xs) == 0:
+            return
+
+        self.check_if_valid_blocks(self, block_size, this_xs, this_ys, this_xs, this_ys)
+
+        blocks = gather_blocks(self.frame, this_xs, this_ys, block_size)
+        add_scalars_saturated(blocks, scalars)
+        scatter_blocks(self.frame, this_xs, this_ys, block_size, blocks)
+
     def check_if_valid(self, frame_other, block_size, other_x, other_y, this_x, this_y):
         """
         Provide detailed reasons why a copy_block will not work before it's called. This method should access
@@ -266,6 +377,29 @@ class Frame:
         if other_x < 0 or other_y < 0:
             raise ValueError('Input dimensions invalid for copy block')
 
+    def check_if_valid_blocks(self, frame_other, block_size, other_xs, other_ys, this_xs, this_ys):
+        """
+        The batched version of check_if_valid. Every vector is checked at once, and the first offending vector (if
+        any) is logged before raising.
+        """
+
+        invalid = (this_xs < 0) | (this_ys < 0) | \
+                  (this_xs + block_size > self.width) | (this_ys + block_size > self.height) | \
+                  (other_xs < 0) | (other_ys < 0) | \
+                  (other_xs + block_size > frame_other.width) | (other_ys + block_size > frame_other.height)
+
+        if np.any(invalid):
+            index = int(np.argmax(invalid))
+            self.logger.error('Input Dimensions Invalid for Copy Blocks Function, printing variables. Send Tyler this!')
+            self.logger.error('%d of %d vectors are invalid, first invalid vector is #%d' %
+                              (int(np.count_nonzero(invalid)), len(invalid), index))
+            self.logger.error('this: (%d, %d) in %dx%d' % (this_xs[index], this_ys[index], self.width, self.height))
+            self.logger.error('other: (%d, %d) in %dx%d' % (other_xs[index], other_ys[index],
+                                                            frame_other.width, frame_other.height))
+            self.logger.error('block_size: %d' % block_size)
+
+            raise ValueError('Invalid Dimensions for Dandere2x Image, See Log. ')
+
     def create_bleeded_image(self, bleed):
         """
         For residuals processing, pixels may or may not exist when trying to create an residual image based
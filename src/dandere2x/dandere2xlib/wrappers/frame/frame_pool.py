@@ -0,0 +1,64 @@
+import threading
+from collections import deque
+
+from dandere2x.dandere2xlib.wrappers.frame.frame import Frame
+
+
+class FramePool:
+    """
+    A fixed amount of preallocated, equally sized Frames that are rotated between threads, so that steady-state
+    processing (i.e merging and piping) doesn't allocate a new full-resolution buffer for every frame.
+
+    Ownership is explicit and reference counted:
+        - acquire() hands out a free Frame holding one reference, blocking until one is available.
+        - Every additional owner (i.e the pipe, when a frame is handed off to it) is accounted for with retain().
+        - Every owner calls release() once it's done, and the Frame returns to the pool after the last release.
+
+    A Frame's contents are undefined after it's acquired, the caller is expected to overwrite it.
+
+    usage:
+    pool = FramePool(1920, 1080, 4)
+    frame = pool.acquire()
+    pool.retain(frame)  # handing it off to another thread
+    pool.release(frame)
+    """
+
+    def __init__(self, width: int, height: int, size: int):
+        self.width = width
+        self.height = height
+        self.size = size
+
+        self._condition = threading.Condition()
+        self._free = deque()
+        self._references = {}
+
+        for x in range(size):
+            frame = Frame()
+            frame.create_new(width, height)
+            self._free.append(frame)
+
+    def acquire(self) -> Frame:
+        with self._condition:
+            while not self._free:
+                self._condition.wait()
+
+            frame = self._free.popleft()
+            self._references[id(frame)] = 1
+            return frame
+
+    def retain(self, frame: Frame) -> None:
+        with self._condition:
+            self._references[id(frame)] += 1
+
+    def release(self, frame: Frame) -> None:
+        with self._condition:
+            self._references[id(frame)] -= 1
+
+            if self._references[id(frame)] == 0:
+                del self._references[id(frame)]
+                self._free.append(frame)
+                self._condition.notify()
+
+    def owns(self, frame: Frame) -> bool:
+        with self._condition:
+            return id(frame) in self._references
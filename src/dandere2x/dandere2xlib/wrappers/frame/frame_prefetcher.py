@@ -0,0 +1,80 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from dandere2x.dandere2x_service.dandere2x_service_controller import Dandere2xController
+from dandere2x.dandere2xlib.utils.file_readiness import get_file_readiness_service
+from dandere2x.dandere2xlib.wrappers.frame.frame import Frame
+
+
+class FramePrefetcher:
+    """
+    Loads a numbered sequence of images (i.e residual_upscaled/output_000001.png, output_000002.png, ...) in order,
+    up to `lookahead` frames ahead of whoever is consuming them, on a small pool of long-lived threads.
+
+    Image decoding releases the GIL, so this lets decoding overlap with the consumer's own work by several frames,
+    rather than by one frame (and one new thread) at a time. At most `lookahead` decoded frames are held at once,
+    besides the one the consumer currently has.
+
+    usage:
+    prefetcher = FramePrefetcher(lambda x: "output_" + get_lexicon_value(6, x) + ".png", 1, 200,
+                                 lookahead=4, workers=2, controller=controller)
+    frame = prefetcher.get(1)  # blocks until output_000001.png exists and is decoded
+    prefetcher.shutdown()
+    """
+
+    # How often (in seconds) a worker waiting on an image checks whether the session is still alive.
+    WAIT_INTERVAL = 0.5
+
+    def __init__(self, image_path, first: int, last: int, lookahead: int, workers: int,
+                 controller: Dandere2xController):
+        """
+        Args:
+            image_path: Maps a frame number to the path of it's image.
+            first: The first frame number to be requested.
+            last: The last frame number to be requested, inclusive.
+        """
+        self.log = logging.getLogger(__name__)
+        self.image_path = image_path
+        self.last = last
+        self.lookahead = max(1, lookahead)
+        self.controller = controller
+
+        self._lock = threading.Lock()
+        self._futures = {}  # frame number -> Future of it's Frame
+        self._next_submit = first
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="FramePrefetcher")
+
+    def get(self, frame_number: int):
+        """
+        Blocks until frame_number's image is loaded and returns it as a Frame, or None if the session was killed
+        while waiting. Frames are expected to be requested in order, each at most once.
+        """
+        with self._lock:
+            self._submit_up_to(frame_number + self.lookahead)
+            future = self._futures.pop(frame_number)
+
+        return future.result()
+
+    def shutdown(self) -> None:
+        """ Stop loading frames, dropping any that were loaded ahead but never requested. """
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+        with self._lock:
+            self._futures.clear()
+
+    def _submit_up_to(self, frame_number: int) -> None:
+        while self._next_submit <= min(frame_number, self.last):
+            self._futures[self._next_submit] = self._executor.submit(self._load, self.image_path(self._next_submit))
+            self._next_submit += 1
+
+    def _load(self, input_image: str):
+        readiness = get_file_readiness_service()
+
+        while not readiness.wait_for_file(input_image, timeout=self.WAIT_INTERVAL):
+            if not self.controller.is_alive():
+                return None
+
+        frame = Frame()
+        frame.load_from_string_controller(input_image, self.controller)
+        return frame
@@ -1,4 +1,5 @@
 import logging
+import multiprocessing
 import time
 
 from dandere2x import Dandere2x, set_dandere2x_logger
@@ -47,4 +48,7 @@ def main():
     print("Total runtime duration:", time.time() - start)
 
 
-main()
+if __name__ == "__main__":
+    # Process pool workers import this module too (they're never forked), they mustn't start a session of their own.
+    multiprocessing.freeze_support()
+    main()